@@ -15,6 +15,7 @@ from pixel_clusterizer.clusterizer import HitClusterizer
 from tjmonopix2.system import logger
 from tjmonopix2.analysis import analysis_utils as au
 from tjmonopix2.analysis.interpreter import RawDataInterpreter
+from tjmonopix2.analysis.tot_calibration import TotCalibration
 
 import datetime
 
@@ -22,7 +23,7 @@ import datetime
 class Analysis(object):
     def __init__(self, raw_data_file=None, analyzed_data_file=None,
                  store_hits=True, cluster_hits=False, analyze_tdc=False, use_tdc_trigger_dist=False,
-                 build_events=False, chunk_size=1000000, **_):
+                 build_events=False, chunk_size=1000000, tot_calibration_file=None, **_):
         self.log = logger.setup_derived_logger('Analysis')
 
         self.raw_data_file = raw_data_file
@@ -32,6 +33,8 @@ class Analysis(object):
         self.chunk_size = chunk_size
         self.analyze_tdc = analyze_tdc
         self.use_tdc_trigger_dist = use_tdc_trigger_dist
+        # Optional per pixel ToT to charge calibration, adds a charge column to the hits
+        self.tot_calibration = TotCalibration.load(tot_calibration_file) if tot_calibration_file else None
 
         if not os.path.isfile(raw_data_file):
             raise IOError('Raw data file %s does not exist.', raw_data_file)
@@ -160,7 +163,7 @@ class Analysis(object):
                     out_file.copy_children(in_file.root.configuration_in, out_file.root.configuration_in, recursive=True)
 
                 if self.store_hits:
-                    hit_table = self._create_hit_table(out_file, dtype=au.hit_dtype)
+                    hit_table = self._create_hit_table(out_file, dtype=au.hit_dtype if self.tot_calibration is None else au.hit_charge_dtype)
 
                 interpreter = RawDataInterpreter(n_scan_params=n_scan_params)
                 self.last_chunk = False
@@ -175,6 +178,8 @@ class Analysis(object):
                         scan_param_id
                     )
                     upd = words.shape[0]
+                    if self.tot_calibration is not None:
+                        hit_dat = self.tot_calibration.add_charge(hit_dat)
 
                     if self.store_hits:
                         hit_table.append(hit_dat)
@@ -195,6 +200,47 @@ class Analysis(object):
 
         # self._create_additional_hit_data(hist_occ, hist_tot)
 
+    def get_scurve_hist(self):
+        ''' Return the occupancy histogram (column, row, scan parameter id) from the stored hits
+            and the injected charge (vcal_high - vcal_low) per scan parameter id
+
+            If the scan stored the injected pixels per scan parameter id (e.g. adaptive threshold scan),
+            the scan parameter ids a pixel was not injected at are filled (see analysis_utils.fill_scurves).
+        '''
+        with tb.open_file(self.analyzed_data_file, 'r') as in_file:
+            scan_node = in_file.root.configuration_in.scan
+            charges = au.get_scan_param_charges(scan_node.scan_params[:])
+            hist_occ = au.hist_scan_param_cube(in_file.root.Dut, charges.shape[0], chunk_size=self.chunk_size)
+            if 'injected' in scan_node:
+                hist_occ = au.fill_scurves(hist_occ, scan_node.injected[..., :charges.shape[0]], charges, self.scan_config['n_injections'])
+        return hist_occ, charges
+
+    def fit_scurves(self, start_values=None, fit_window=None):
+        ''' Fit the S-curves of a threshold scan and store threshold, noise and chi2 map
+
+            start_values: tuple of numpy arrays
+                Threshold and noise map used as per pixel fit start values (e.g. from the threshold cache)
+            fit_window: float
+                Fit first only the data within the start threshold +- fit_window times the start noise
+        '''
+        self.log.info('Fitting S-curves...')
+        hist_occ, charges = self.get_scurve_hist()
+        # Fit less start values expect increasing, equidistant charges
+        order = np.argsort(charges)
+        hist_scurve = hist_occ[:, :, order].reshape((self.columns * self.rows, -1))
+        self.threshold_map, self.noise_map, self.chi2_map = au.fit_scurves_multithread(hist_scurve, charges[order], self.scan_config['n_injections'],
+                                                                                       start_values=start_values, fit_window=fit_window)
+
+        with tb.open_file(self.analyzed_data_file, 'r+') as out_file:
+            for name, title, obj in [('ThresholdMap', 'Threshold Map', self.threshold_map),
+                                     ('NoiseMap', 'Noise Map', self.noise_map),
+                                     ('Chi2Map', 'Chi2 / ndf Map', self.chi2_map)]:
+                if name in out_file.root:
+                    out_file.remove_node(out_file.root, name)
+                out_file.create_carray(out_file.root, name=name, title=title, obj=obj,
+                                       filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        return self.threshold_map, self.noise_map, self.chi2_map
+
     def _create_additional_hit_data(self, hist_occ, hist_tot):
         with tb.open_file(self.analyzed_data_file, 'r+') as out_file:
             scan_id = self.run_config['scan_id']
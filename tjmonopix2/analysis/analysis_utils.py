@@ -29,6 +29,8 @@ hit_dtype = np.dtype([
     ("scan_param_id", "<i2"),
 ])
 
+hit_charge_dtype = np.dtype(hit_dtype.descr + [("charge", "<f4")])
+
 
 class ConfigDict(dict):
     ''' Dictionary with different value data types:
@@ -95,6 +97,74 @@ def imap_bar(func, args, n_processes=None, unit='it', unit_scale=False):
     return res_list
 
 
+def get_scan_param_charges(scan_params):
+    ''' Injected charge (vcal_high - vcal_low) per scan parameter id from the scan_params table '''
+    charges = np.full(np.max(scan_params['scan_param_id']) + 1, np.nan)
+    charges[scan_params['scan_param_id']] = scan_params['vcal_high'].astype(float) - scan_params['vcal_low']
+    return charges
+
+
+def hist_scan_param_cube(hit_table, n_scan_params, chunk_size=1000000, tot=False):
+    ''' Histogram hits per (column, row, scan parameter id)
+
+        Returns the hit count and, if tot is True, also the ToT sum histogram.
+    '''
+    n_bins = 512 * 512 * n_scan_params
+    hist_hits = np.zeros(n_bins, dtype=np.uint32)
+    hist_tot = np.zeros(n_bins, dtype=np.float64) if tot else None
+    for i in range(0, hit_table.shape[0], chunk_size):
+        hits = hit_table[i:i + chunk_size]
+        hits = hits[(hits['col'] >= 0) & (hits['col'] < 512) & (hits['row'] >= 0) & (hits['row'] < 512) & (hits['scan_param_id'] < n_scan_params)]
+        index = (hits['col'].astype(np.int64) * 512 + hits['row']) * n_scan_params + hits['scan_param_id']
+        hist_hits += np.bincount(index, minlength=n_bins).astype(np.uint32)
+        if tot:
+            hist_tot += np.bincount(index, weights=(hits['te'].astype(np.int16) - hits['le']) & 0x7f, minlength=n_bins)
+    if tot:
+        return hist_hits.reshape(512, 512, n_scan_params), hist_tot.reshape(512, 512, n_scan_params)
+    return hist_hits.reshape(512, 512, n_scan_params)
+
+
+def fill_scurves(hist_occ, injected, scan_params, n_injections, chunk_size=10000):
+    ''' Fill the scan parameter ids a pixel was not injected at (e.g. outside of its window in an adaptive threshold scan)
+
+        The points that were not injected are far from the threshold. They are set to n_injections or 0,
+        depending on the occupancy of the nearest injected charge, so that the S-curve fits and fit less
+        estimates see complete S-curves. Pixels without any injection are not changed.
+
+        Parameters
+        ----------
+        hist_occ : numpy array
+            Occupancy histogram with the scan parameter id as last dimension
+        injected : numpy array
+            Boolean mask of the same shape, True where the pixel was injected
+        scan_params : numpy array like
+            Injected charge per scan parameter id
+        n_injections : integer
+            Number of injections
+    '''
+    scan_params = np.asarray(scan_params, dtype=float)
+    order = np.argsort(scan_params)
+    x = scan_params[order]
+    n_steps = x.shape[0]
+    scurves = hist_occ.reshape(-1, n_steps)[:, order]
+    injected = np.asarray(injected, dtype=bool).reshape(-1, n_steps)[:, order]
+    steps = np.arange(n_steps)
+    pixels = np.flatnonzero(np.any(injected, axis=1) & ~np.all(injected, axis=1))
+    for i in range(0, pixels.shape[0], chunk_size):
+        sel = pixels[i:i + chunk_size]
+        inj = injected[sel]
+        # Index of the last injected charge below and the first above every point
+        below = np.maximum.accumulate(np.where(inj, steps, -1), axis=1)
+        above = np.minimum.accumulate(np.where(inj, steps, n_steps)[:, ::-1], axis=1)[:, ::-1]
+        use_above = (above < n_steps) & ((below < 0) | (x[np.minimum(above, n_steps - 1)] - x < x - x[np.maximum(below, 0)]))
+        nearest = np.where(use_above, above, below)
+        nearest_occ = np.take_along_axis(scurves[sel], nearest, axis=1)
+        scurves[sel] = np.where(inj, scurves[sel], np.where(nearest_occ >= n_injections / 2., n_injections, 0))
+    filled = np.empty_like(scurves)
+    filled[:, order] = scurves
+    return filled.reshape(hist_occ.shape)
+
+
 def get_threshold(x, y, n_injections):
     ''' Fit less approximation of threshold from s-curve.
 
@@ -132,17 +202,24 @@ def get_noise(x, y, n_injections):
     mu = get_threshold(x, y, n_injections)
     d = np.abs(np.diff(x)[0])
 
-    mu1 = y[x < mu].sum()
-    mu2 = (n_injections - y[x > mu]).sum()
+    # Broadcast threshold over last dimension to support 1D and 2D hists
+    mu = np.asarray(mu)[..., np.newaxis]
+    mu1 = np.where(x < mu, y, 0).sum(axis=-1)
+    mu2 = np.where(x > mu, n_injections - y, 0).sum(axis=-1)
 
     return d * (mu1 + mu2).astype(float) / n_injections * np.sqrt(np.pi / 2.)
 
 
-def fit_scurve(scurve_data, scan_params, n_injections, sigma_0):
+def fit_scurve(scurve_data, scan_params, n_injections, sigma_0, mu_0=None, fit_window=None):
     '''
         Fit one pixel data with Scurve.
         Has to be global function for the multiprocessing module.
 
+        If a threshold start value mu_0 is given it is used instead of the fit less estimate.
+        If additionally a fit_window is given, the fit is first done only on the data
+        within mu_0 +- fit_window. If this fit fails or the result is outside the window,
+        the full range is fitted with the default start values.
+
         Returns:
             (mu, sigma, chi2/ndf)
     '''
@@ -152,6 +229,14 @@ def fit_scurve(scurve_data, scan_params, n_injections, sigma_0):
     # Scipy bug: fit does not work on float32 values, without any error message
     scan_params = np.array(scan_params, dtype=float)
 
+    if mu_0 is not None and fit_window is not None:
+        in_window = np.abs(scan_params - mu_0) <= fit_window
+        if np.count_nonzero(in_window & ~np.isnan(scurve_data)) >= 3:
+            result = fit_scurve(np.where(in_window, scurve_data, np.nan), scan_params, n_injections, sigma_0, mu_0=mu_0)
+            if result[1] > 0 and np.abs(result[0] - mu_0) <= fit_window:
+                return result
+        return fit_scurve(scurve_data, scan_params, n_injections, sigma_0)
+
     # Deselect masked values (== nan)
     x = scan_params[~np.isnan(scurve_data)]
     y = scurve_data[~np.isnan(scurve_data)]
@@ -175,7 +260,7 @@ def fit_scurve(scurve_data, scan_params, n_injections, sigma_0):
     mu = get_threshold(x=x, y=y, n_injections=n_injections)
 
     # Set fit start values
-    p0 = [mu, sigma_0]
+    p0 = [mu if mu_0 is None else mu_0, sigma_0]
 
     # Bounds makes the optimizer 5 times slower and are therefore deactivated.
     # TODO: Maybe we find a better package?
@@ -315,7 +400,16 @@ def _mask_bad_data(scurve, n_injections):
     return scurve_mask
 
 
-def fit_scurves_multithread(scurves, scan_params, n_injections=None, invert_x=False, optimize_fit_range=False):
+def _fit_scurve_start_values(args, scan_params, n_injections, sigma_0, fit_window):
+    ''' Fit one pixel with per pixel start values (scurve, mu_0, sigma_0) given in args '''
+    scurve_data, mu_0, sigma_0_pixel = args
+    if not np.isfinite(mu_0) or not np.isfinite(sigma_0_pixel) or sigma_0_pixel <= 0:  # No valid start values for this pixel
+        return fit_scurve(scurve_data, scan_params, n_injections, sigma_0)
+    window = None if fit_window is None else max(fit_window * sigma_0_pixel, 2. * np.min(np.abs(np.diff(scan_params))))
+    return fit_scurve(scurve_data, scan_params, n_injections, sigma_0_pixel, mu_0=mu_0, fit_window=window)
+
+
+def fit_scurves_multithread(scurves, scan_params, n_injections=None, invert_x=False, optimize_fit_range=False, start_values=None, fit_window=None):
     ''' Fit Scurves on all available cores in parallel.
 
         Parameters
@@ -331,6 +425,12 @@ def fit_scurves_multithread(scurves, scan_params, n_injections=None, invert_x=Fa
         optimize_fit_range: boolean
             Reduce fit range of each S-curve independently to the S-Curve like range. Take full
             range if false
+        start_values: tuple of numpy arrays
+            Threshold and noise map (e.g. from a previous scan) used as per pixel fit start values.
+            Pixels with a non positive noise value use the default start values.
+        fit_window: float
+            Only with start_values. Fit first only data within the start threshold +- fit_window times
+            the start noise (at least two scan steps), fall back to the full range if that fails.
     '''
 
     scan_params = np.array(scan_params)  # Make sure it is numpy array
@@ -345,11 +445,13 @@ def fit_scurves_multithread(scurves, scan_params, n_injections=None, invert_x=Fa
         scurves_masked = np.ma.masked_array(scurves, scurve_mask)
     else:
         scurves_masked = np.ma.masked_array(scurves)
+    # S-curves without data cannot be fitted (result 0), e.g. pixels outside of the scanned area
+    has_data = np.any(scurves_masked.filled(0) != 0, axis=1)
 
     # Calculate noise median for better fit start value
     logger.info("Calculate S-curve fit start parameters")
     sigmas = []
-    for curve in tqdm(scurves_masked, unit=' S-curves', unit_scale=True):
+    for curve in tqdm(scurves_masked[has_data], unit=' S-curves', unit_scale=True):
         # Calculate from pixels with valid data (maximum = n_injections)
         if curve.max() == n_injections:
             if np.all(curve.mask == np.ma.nomask):
@@ -363,13 +465,27 @@ def fit_scurves_multithread(scurves, scan_params, n_injections=None, invert_x=Fa
     sigma_0 = np.max([sigma_0, np.diff(scan_params).min() * 0.01])  # Prevent sigma = 0
 
     logger.info("Start S-curve fit on %d CPU core(s)", mp.cpu_count())
-    partialfit_scurve = partial(fit_scurve,
-                                scan_params=scan_params,
-                                n_injections=n_injections,
-                                sigma_0=sigma_0)
-
-    result_list = imap_bar(partialfit_scurve, scurves_masked.tolist(), unit=' Fits', unit_scale=True)  # Masked array entries to list leads to NaNs
-    result_array = np.array(result_list)
+    if start_values is None:
+        partialfit_scurve = partial(fit_scurve,
+                                    scan_params=scan_params,
+                                    n_injections=n_injections,
+                                    sigma_0=sigma_0)
+        args = scurves_masked[has_data].tolist()  # Masked array entries to list leads to NaNs
+    else:
+        logger.info("Use per pixel start values")
+        mu_0 = np.ravel(start_values[0]).astype(float)
+        if invert_x:
+            mu_0 = -mu_0
+        partialfit_scurve = partial(_fit_scurve_start_values,
+                                    scan_params=scan_params,
+                                    n_injections=n_injections,
+                                    sigma_0=sigma_0,
+                                    fit_window=fit_window)
+        args = list(zip(scurves_masked[has_data].tolist(), mu_0[has_data].tolist(), np.ravel(start_values[1]).astype(float)[has_data].tolist()))
+
+    result_array = np.zeros((scurves_masked.shape[0], 3))
+    if args:
+        result_array[has_data] = imap_bar(partialfit_scurve, args, unit=' Fits', unit_scale=True)
     logger.info("S-curve fit finished")
 
     thr = result_array[:, 0]
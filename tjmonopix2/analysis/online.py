@@ -9,11 +9,11 @@
     Online data analysis functions
 '''
 
+import copy
 import ctypes
 import logging
 import multiprocessing
 import time
-import queue
 from functools import reduce
 
 import numpy as np
@@ -37,156 +37,578 @@ def gray2bin(gray):
     return b6 + b5 + b4 + b3 + b2 + b1 + b0
 
 
+# Decoder state, kept in a small array between readouts
+IS_SOF, IS_EOF, DATA_FLAG, COL, ROW, LE, TE = range(7)
+
+
+def get_decoder_state():
+    ''' Initial decoder state for decode() '''
+    state = np.zeros(7, dtype=np.int64)
+    state[IS_SOF] = -1
+    state[IS_EOF] = -1
+    return state
+
+
+def get_hit_buffer(hits, n_words):
+    ''' Hit buffer for the hits of n_words data words, hits is reused if it is large enough '''
+    n_hits = n_words * 3 // 4 + 1  # Every word has 3 symbols, a hit has 4 symbols
+    if hits is None or hits.shape[0] < n_hits:
+        return np.zeros(n_hits, dtype=au.hit_dtype)
+    return hits
+
+
 @numba.njit(cache=True, fastmath=True)
-def histogram(raw_data, occ_hist, hit_data, is_sof, is_eof, tj_data_flag):
-    ''' Raw data to 2D occupancy histogram '''
+def decode(raw_data, hits, state):
+    ''' Decode raw data words into the preallocated hit buffer (see get_hit_buffer)
 
+        The decoder state (see get_decoder_state) is updated in place, so hits can be split between readouts.
+        Returns the number of decoded hits.
+    '''
+    n_hits = 0
     for word in raw_data:
         if not is_tjmono(word):
             continue
 
         # Split 32bit FPGA word into single data words
-        dat = np.zeros(3, dtype=np.uint16)
-        dat[0] = (word & 0x7FC0000) >> 18
-        dat[1] = (word & 0x003FE00) >> 9
-        dat[2] = (word & 0x00001FF)
-    
-        for d in dat:
+        for shift in (18, 9, 0):
+            d = (word >> shift) & 0x1ff
             if d == 0x1bc:
-                is_sof = 1
-                tj_data_flag = 0
+                state[IS_SOF] = 1
+                state[DATA_FLAG] = 0
             elif d == 0x17c:
-                is_eof = 1
+                state[IS_EOF] = 1
             elif d == 0x13c:
                 pass
             else:
-                if tj_data_flag == 0:
-                    tj_data_flag = 1
-                    hit_data[0]['col'] = (d & 0xff) << 1
-                elif tj_data_flag == 1:
-                    tj_data_flag = 2
-                    hit_data[0]['le'] = gray2bin((d & 0xfe) >> 1)
-                    hit_data[0]['te'] = (d & 0x01) << 6
-                elif tj_data_flag == 2:
-                    tj_data_flag = 3
-                    hit_data[0]['te'] = gray2bin(hit_data[0]['te'] | ((d & 0xfc) >> 2))
-                    hit_data[0]['row'] = (d & 0x01) << 8
-                    hit_data[0]['col'] = hit_data[0]['col'] + ((d & 0x02) >> 1)
-                elif tj_data_flag == 3:
-                    tj_data_flag = 0
-                    hit_data[0]['row'] = hit_data[0]['row'] | (d & 0xff)
-
-                    # Hit is complete, add to histogram
-                    if hit_data[0]['col'] < 512 and hit_data[0]['row'] < 512:
-                        occ_hist[hit_data[0]['col'], hit_data[0]['row']] += 1
-
-    return hit_data, is_sof, is_eof, tj_data_flag
+                if state[DATA_FLAG] == 0:
+                    state[DATA_FLAG] = 1
+                    state[COL] = (d & 0xff) << 1
+                elif state[DATA_FLAG] == 1:
+                    state[DATA_FLAG] = 2
+                    state[LE] = gray2bin((d & 0xfe) >> 1)
+                    state[TE] = (d & 0x01) << 6
+                elif state[DATA_FLAG] == 2:
+                    state[DATA_FLAG] = 3
+                    state[TE] = gray2bin(state[TE] | ((d & 0xfc) >> 2))
+                    state[ROW] = (d & 0x01) << 8
+                    state[COL] = state[COL] + ((d & 0x02) >> 1)
+                elif state[DATA_FLAG] == 3:
+                    state[DATA_FLAG] = 0
+                    state[ROW] = state[ROW] | (d & 0xff)
+
+                    # Hit is complete
+                    hits[n_hits]['col'] = state[COL]
+                    hits[n_hits]['row'] = state[ROW]
+                    hits[n_hits]['le'] = state[LE]
+                    hits[n_hits]['te'] = state[TE]
+                    n_hits += 1
+
+    return n_hits
+
+
+@numba.njit(cache=True, fastmath=True)
+def fill_occupancy(hits, occ_hist):
+    ''' Hits to 2D occupancy histogram '''
+    for hit in hits:
+        if hit['col'] < 512 and hit['row'] < 512:
+            occ_hist[hit['col'], hit['row']] += 1
+
+
+@numba.njit(cache=True, fastmath=True)
+def fill_scan_param_occupancy(hits, occ_hist, scan_param_id):
+    ''' Hits to 3D occupancy histogram (column, row, scan parameter id) '''
+    if scan_param_id < 0 or scan_param_id >= occ_hist.shape[2]:
+        return
+    for hit in hits:
+        if hit['col'] < 512 and hit['row'] < 512:
+            occ_hist[hit['col'], hit['row'], scan_param_id] += 1
+
+
+@numba.njit(cache=True, fastmath=True)
+def fill_tot(hits, tot_hist):
+    ''' Hits to per pixel ToT sum (tot_hist[..., 0]) and hit count (tot_hist[..., 1]) '''
+    for hit in hits:
+        if hit['col'] < 512 and hit['row'] < 512:
+            tot_hist[hit['col'], hit['row'], 0] += (hit['te'] - hit['le']) & 0x7f
+            tot_hist[hit['col'], hit['row'], 1] += 1
+
+
+@numba.njit(cache=True, fastmath=True)
+def fill_tot_spectrum(hits, tot_hist):
+    ''' Hits to ToT histogram of all pixels '''
+    for hit in hits:
+        if hit['col'] < 512 and hit['row'] < 512:
+            tot_hist[(hit['te'] - hit['le']) & 0x7f] += 1
+
+
+def histogram(raw_data, occ_hist, hits, state):
+    ''' Raw data to 2D occupancy histogram, returns the (possibly new) hit buffer and the decoder state '''
+    hits = get_hit_buffer(hits, raw_data.shape[0])
+    n_hits = decode(raw_data, hits, state)
+    fill_occupancy(hits[:n_hits], occ_hist)
+    return hits, state
+
+
+@numba.njit(cache=True)
+def get_frame_boundary_symbols(raw_data):
+    ''' First and last data symbol (not idle) of a readout, -1 if there is none '''
+    first_symbol = -1
+    for i in range(raw_data.shape[0]):
+        if not is_tjmono(raw_data[i]):
+            continue
+        for shift in (18, 9, 0):
+            d = (raw_data[i] >> shift) & 0x1ff
+            if d != 0x13c:
+                first_symbol = d
+                break
+        if first_symbol != -1:
+            break
+    last_symbol = -1
+    for i in range(raw_data.shape[0] - 1, -1, -1):
+        if not is_tjmono(raw_data[i]):
+            continue
+        for shift in (0, 9, 18):
+            d = (raw_data[i] >> shift) & 0x1ff
+            if d != 0x13c:
+                last_symbol = d
+                break
+        if last_symbol != -1:
+            break
+    return first_symbol, last_symbol
+
+
+RESET_DECODER = 0x1  # Chunk flag: reset the decoder state of the worker before the chunk
+
+
+class RawDataRingBuffer(object):
+    ''' Single producer, single consumer ring buffer of raw data words in shared memory
+
+        The readout side copies every readout into the preallocated buffer and the
+        worker process decodes it in place, without pickling and piping the data.
+        Every readout is stored as a chunk with an integer tag (e.g. the scan parameter id, -1 for none)
+        and flags (e.g. RESET_DECODER), ticket (sequence number of the readout) and timestamp.
+        Head and tail are counted in words since the start and only increase.
+
+        size: int
+            Buffer size in 32 bit words
+        max_chunks: int
+            Maximum number of readouts in the buffer
+        n_values: int
+            Number of additional float values stored per chunk (e.g. meta data), see read_values()
+    '''
+    _HEAD, _TAIL, _CHUNK_HEAD, _CHUNK_TAIL, _OVERFLOW_CHUNKS, _OVERFLOW_WORDS, _BACK_PRESSURE, _MAX_FILL = range(8)
+
+    def __init__(self, size=2 ** 22, max_chunks=2 ** 14, n_values=0):
+        self.size = size
+        self.max_chunks = max_chunks
+        self.n_values = n_values
+        self._data_base = multiprocessing.RawArray(ctypes.c_uint32, size)
+        self._chunks_base = multiprocessing.RawArray(ctypes.c_int64, 4 * max_chunks)  # (end, tag, flags, ticket) per chunk
+        self._timestamps_base = multiprocessing.RawArray(ctypes.c_double, max_chunks)
+        self._values_base = multiprocessing.RawArray(ctypes.c_double, max_chunks * n_values)
+        self._control_base = multiprocessing.RawArray(ctypes.c_uint64, 8)
+        self.data_available = multiprocessing.Event()
+        self._init_views()
+
+    def _init_views(self):
+        self._data = np.ctypeslib.as_array(self._data_base)
+        self._chunks = np.ctypeslib.as_array(self._chunks_base).reshape(self.max_chunks, 4)
+        self._timestamps = np.ctypeslib.as_array(self._timestamps_base)
+        self._values = np.frombuffer(self._values_base, dtype=np.float64).reshape(self.max_chunks, self.n_values)
+        self._control = np.ctypeslib.as_array(self._control_base)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['_data', '_chunks', '_timestamps', '_values', '_control']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_views()
+
+    def fill(self):
+        ''' Number of words in the buffer '''
+        return int(self._control[self._HEAD]) - int(self._control[self._TAIL])
+
+    def _has_space(self, n_words):
+        return (self.size - self.fill() >= n_words and
+                int(self._control[self._CHUNK_HEAD]) - int(self._control[self._CHUNK_TAIL]) < self.max_chunks)
+
+    def empty(self):
+        ''' True if all chunks were released by the consumer '''
+        return int(self._control[self._CHUNK_HEAD]) == int(self._control[self._CHUNK_TAIL])
+
+    def write(self, raw_data, tag=-1, flags=0, ticket=0, timestamp=0., timeout=0., values=()):
+        ''' Copy raw data into the buffer (producer side)
+
+            If the buffer is full, wait up to timeout seconds for the consumer (back-pressure).
+            Returns False and drops the data if there is still no space (overflow).
+        '''
+        n_words = raw_data.shape[0]
+        if not self._has_space(n_words):
+            self._control[self._BACK_PRESSURE] += 1
+            deadline = time.time() + timeout
+            while n_words <= self.size and not self._has_space(n_words) and time.time() < deadline:
+                time.sleep(0.0005)
+            if not self._has_space(n_words):
+                self._control[self._OVERFLOW_CHUNKS] += 1
+                self._control[self._OVERFLOW_WORDS] += n_words
+                return False
+
+        head = int(self._control[self._HEAD])
+        start = head % self.size
+        first = min(n_words, self.size - start)
+        self._data[start:start + first] = raw_data[:first]
+        self._data[:n_words - first] = raw_data[first:]
+        chunk = int(self._control[self._CHUNK_HEAD]) % self.max_chunks
+        self._chunks[chunk] = (head + n_words, tag, flags, ticket)
+        self._timestamps[chunk] = timestamp
+        if self.n_values:
+            self._values[chunk] = values
+        # Publish chunk after the data is written
+        self._control[self._HEAD] = head + n_words
+        self._control[self._CHUNK_HEAD] += 1
+        self._control[self._MAX_FILL] = max(int(self._control[self._MAX_FILL]), self.fill())
+        self.data_available.set()
+        return True
+
+    def read(self):
+        ''' Oldest chunk as (list of views into the buffer, tag, flags, ticket, timestamp), None if empty (consumer side)
+
+            A chunk that wraps around the end of the buffer is returned as two views.
+            The views are valid until release() is called.
+        '''
+        chunk_tail = int(self._control[self._CHUNK_TAIL])
+        if chunk_tail == int(self._control[self._CHUNK_HEAD]):
+            return None
+        end, tag, flags, ticket = self._chunks[chunk_tail % self.max_chunks]
+        timestamp = self._timestamps[chunk_tail % self.max_chunks]
+        tail = int(self._control[self._TAIL])
+        start = tail % self.size
+        n_words = int(end) - tail
+        first = min(n_words, self.size - start)
+        segments = [self._data[start:start + first]]
+        if n_words > first:
+            segments.append(self._data[:n_words - first])
+        return segments, int(tag), int(flags), int(ticket), float(timestamp)
+
+    def read_values(self):
+        ''' Additional values of the oldest chunk (consumer side, call after read() returned a chunk) '''
+        return self._values[int(self._control[self._CHUNK_TAIL]) % self.max_chunks].copy()
+
+    def release(self):
+        ''' Free the oldest chunk after processing (consumer side) '''
+        chunk_tail = int(self._control[self._CHUNK_TAIL])
+        self._control[self._TAIL] = self._chunks[chunk_tail % self.max_chunks, 0]
+        self._control[self._CHUNK_TAIL] = chunk_tail + 1
+
+    def get_status(self):
+        ''' Fill level and overflow / back-pressure counters '''
+        return {'size': self.size,
+                'fill': self.fill(),
+                'max_fill': int(self._control[self._MAX_FILL]),
+                'chunks': int(self._control[self._CHUNK_HEAD]) - int(self._control[self._CHUNK_TAIL]),
+                'overflow_chunks': int(self._control[self._OVERFLOW_CHUNKS]),
+                'overflow_words': int(self._control[self._OVERFLOW_WORDS]),
+                'back_pressure': int(self._control[self._BACK_PRESSURE])}
 
 
 class OnlineHistogrammingBase():
     ''' Base class to do online analysis with raw data from chip.
 
         The output data is a histogram of a given shape.
+        The raw data is passed to the histogramming processes with shared memory ring buffers.
+        With several workers every worker fills its own partial histogram and get() returns the sum.
+        With double buffering every worker has two histogram buffers, get(reset=True) and reset() switch
+        the worker to the other (empty) buffer and clear the previous one without blocking the worker.
+        A readout is only given to another worker if it starts at a frame boundary, so that no hit
+        is split between two workers.
+        add() returns a ticket (sequence number) for every readout, the workers acknowledge the processed
+        tickets and get(until=ticket) waits exactly until the readouts up to this ticket are histogrammed.
+        The workers record throughput, processing time and lag of the readouts, see get_metrics().
     '''
     _queue_timeout = 0.01  # max blocking time to delete object [s]
-
-    def __init__(self, shape):
-        self._raw_data_queue = multiprocessing.Queue()
+    _n_latencies = 1024  # number of readouts per worker used for the latency percentiles
+    uses_scan_param_id = False  # analysis function gets [raw_data, {'scan_param_id': tag}] instead of raw_data, tag -1 if not given
+
+    def __init__(self, shape, n_workers=1, double_buffer=True, ring_size=2 ** 22, add_timeout=1.):
+        self.n_workers = n_workers
+        self._n_buffers = 2 if double_buffer else 1
+        self._rings = [RawDataRingBuffer(size=ring_size) for _ in range(n_workers)]
+        self.add_timeout = add_timeout  # max blocking time of add() if the ring buffer is full [s]
         self.stop = multiprocessing.Event()
-        self.lock = multiprocessing.Lock()
+        self.locks = [multiprocessing.Lock() for _ in range(n_workers)]
         self.last_add = None  # time of last add to queue
         self.shape = shape
         self.analysis_function_kwargs = {}
-        self.p = None  # process
+        self.processes = []
+        self._worker = 0  # worker of the last readout
+        self._ticket = 0  # ticket of the last readout
+        self._assigned = [0] * n_workers  # ticket of the last readout per worker
+        self._acked = multiprocessing.RawArray(ctypes.c_int64, n_workers)  # ticket of the last processed readout per worker
+        self._acked_event = multiprocessing.Event()
+        # Per worker number of processed words and readouts
+        self._counters = multiprocessing.RawArray(ctypes.c_int64, 2 * n_workers)
+        # Per worker history of processing time and lag (histogram update time - readout timestamp)
+        self._latencies = multiprocessing.RawArray(ctypes.c_double, 2 * self._n_latencies * n_workers)
+        self._last_metrics = (time.time(), 0)  # time and number of words of the last get_metrics() call
+        self._last_symbol = -1  # last data symbol of the previous readouts
+        self._n_overflow_words = 0  # already reported dropped words
+        self._errors = multiprocessing.RawArray(ctypes.c_int64, n_workers)  # Per worker number of readouts with analysis errors
+        self._n_errors = 0  # already reported errors
 
     def init(self):
-        # Create shared memory 32 bit unsigned int numpy array
+        # Create shared memory 32 bit unsigned int numpy arrays, one (or two) partial histograms per worker
         n_values = reduce(lambda x, y: x * y, self.shape)
-        shared_array_base = multiprocessing.Array(ctypes.c_uint, n_values)
-        shared_array = np.ctypeslib.as_array(shared_array_base.get_obj())
-        self.hist = shared_array.reshape(*self.shape)
-        self.idle_worker = multiprocessing.Event()
-        self.p = multiprocessing.Process(target=self.worker,
-                                         args=(self._raw_data_queue, shared_array_base,
-                                               self.lock, self.stop, self.idle_worker))
-        self.p.start()
-        logger.info('Starting process %d', self.p.pid)
+        shared_array_bases = [[multiprocessing.Array(ctypes.c_uint, n_values) for _ in range(self._n_buffers)] for _ in range(self.n_workers)]
+        self._hists = [[np.ctypeslib.as_array(base.get_obj()).reshape(*self.shape) for base in bases] for bases in shared_array_bases]
+        self._active = multiprocessing.RawArray(ctypes.c_int, self.n_workers)  # Buffer filled by the worker, changed with the worker lock
+        for worker, (ring, bases, lock) in enumerate(zip(self._rings, shared_array_bases, self.locks)):
+            p = multiprocessing.Process(target=self.worker, args=(ring, bases, lock, self._active, self._acked, self._acked_event,
+                                                                  self._counters, self._latencies, self._errors, worker, self.stop))
+            p.start()
+            logger.info('Starting process %d', p.pid)
+            self.processes.append(p)
 
     def analysis_function(self, raw_data, hist, *args):
         raise NotImplementedError("You have to implement the analysis_funtion")
 
+    def _select_worker(self):
+        ''' Worker with the least pending data, round robin if equal '''
+        workers = [(self._worker + 1 + i) % self.n_workers for i in range(self.n_workers)]
+        return min(workers, key=lambda w: self._rings[w].fill())
+
     def add(self, raw_data, meta_data=None):
-        ''' Add raw data to be histogrammed '''
+        ''' Add raw data to be histogrammed
+
+            Only the scan parameter id of the meta data is passed to the analysis function.
+            The timestamp_stop of the meta data (default: now) is used for the lag metric.
+            Returns the ticket of the readout for get(until=ticket).
+        '''
         self.last_add = time.time()  # time of last add to queue
-        self.idle_worker.clear()  # after addding data worker cannot be idle
-        if meta_data is None:
-            self._raw_data_queue.put(raw_data)
-        else:
-            self._raw_data_queue.put([raw_data, meta_data])
+        self._ticket += 1
+        raw_data = np.asarray(raw_data, dtype=np.uint32)
+        meta_data = meta_data or {}
+        tag = int(meta_data.get('scan_param_id', -1))
+        timestamp = float(meta_data.get('timestamp_stop', self.last_add))
+        flags = 0
+        if self.n_workers > 1:
+            first_symbol, last_symbol = get_frame_boundary_symbols(raw_data)
+            # Decoding of the readout does not depend on the previous readouts at a frame boundary
+            if first_symbol == 0x1bc or (first_symbol != -1 and self._last_symbol == 0x17c):
+                worker = self._select_worker()
+                if worker != self._worker and first_symbol != 0x1bc:
+                    flags = RESET_DECODER  # SOF resets the decoder anyway
+                self._worker = worker
+            if last_symbol != -1:
+                self._last_symbol = last_symbol
+        if self._rings[self._worker].write(raw_data, tag=tag, flags=flags, ticket=self._ticket, timestamp=timestamp, timeout=self.add_timeout):
+            self._assigned[self._worker] = self._ticket
+        # Dropped readouts are not waited for, they are reported as ring buffer overflow
+        return self._ticket
+
+    def get_status(self):
+        ''' Status of the raw data ring buffer of every worker, see RawDataRingBuffer.get_status '''
+        return [ring.get_status() for ring in self._rings]
+
+    def get_metrics(self):
+        ''' Throughput and latency of the online analysis
+
+            queue_words, queue_readouts: data waiting for the workers
+            words, readouts: total number of processed words and readouts
+            words_per_second: processed words per second since the last call
+            latency_p50/p90/p99: processing time per readout [s] (last readouts of every worker)
+            lag_p50/p90/p99: time from the readout timestamp to the histogram update [s]
+        '''
+        now = time.time()
+        status = self.get_status()
+        counters = np.ctypeslib.as_array(self._counters).reshape(self.n_workers, 2)
+        words, readouts = int(counters[:, 0].sum()), int(counters[:, 1].sum())
+        latencies = np.ctypeslib.as_array(self._latencies).reshape(self.n_workers, self._n_latencies, 2)
+        latencies = np.concatenate([latencies[w, :min(int(counters[w, 1]), self._n_latencies)] for w in range(self.n_workers)])
+        last_time, last_words = self._last_metrics
+        self._last_metrics = (now, words)
+
+        metrics = {'queue_words': sum(s['fill'] for s in status),
+                   'queue_readouts': sum(s['chunks'] for s in status),
+                   'words': words,
+                   'readouts': readouts,
+                   'words_per_second': (words - last_words) / (now - last_time) if now > last_time else 0.}
+        for i, name in enumerate(['latency', 'lag']):
+            percentiles = np.percentile(latencies[:, i], [50, 90, 99]) if latencies.shape[0] else [np.nan] * 3
+            metrics.update({'%s_p%d' % (name, q): float(v) for q, v in zip([50, 90, 99], percentiles)})
+        return metrics
+
+    def log_metrics(self):
+        ''' Log the metrics of get_metrics() '''
+        metrics = self.get_metrics()
+        logger.info('Online analysis: %d words (%d readouts) queued, %1.2e words/s, latency p50/p99 %1.1f/%1.1f ms, lag p50/p99 %1.1f/%1.1f ms',
+                    metrics['queue_words'], metrics['queue_readouts'], metrics['words_per_second'],
+                    metrics['latency_p50'] * 1e3, metrics['latency_p99'] * 1e3, metrics['lag_p50'] * 1e3, metrics['lag_p99'] * 1e3)
+        return metrics
+
+    def _check_overflow(self):
+        n_overflow_words = sum(status['overflow_words'] for status in self.get_status())
+        if n_overflow_words > self._n_overflow_words:
+            logger.warning('Raw data ring buffer overflow, %d words were not histogrammed', n_overflow_words - self._n_overflow_words)
+            self._n_overflow_words = n_overflow_words
+
+    def _check_errors(self):
+        n_errors = sum(self._errors)
+        if n_errors > self._n_errors:
+            logger.error('Online analysis failed for %d readouts, they were not histogrammed', n_errors - self._n_errors)
+            self._n_errors = n_errors
+
+    def is_done(self, until=None):
+        ''' True if all readouts up to the ticket (default: all added readouts) are histogrammed '''
+        if until is None:
+            until = self._ticket
+        # The tickets of a worker are processed in order, so the worker is done with all tickets <= until
+        # if it acknowledged until or its last ticket
+        return all(self._acked[worker] >= min(until, self._assigned[worker]) for worker in range(self.n_workers))
+
+    def wait(self, until=None, timeout=None):
+        ''' Wait until all readouts up to the ticket (default: all added readouts) are histogrammed
+
+            Returns False on timeout.
+        '''
+        start = time.time()
+        while True:
+            self._acked_event.clear()
+            if self.is_done(until):
+                return True
+            if not all(p.is_alive() for p in self.processes):
+                raise RuntimeError('Online histogramming process stopped with pending data')
+            remaining = None if timeout is None else timeout - (time.time() - start)
+            if remaining is not None and remaining <= 0:
+                return False
+            self._acked_event.wait(self._queue_timeout if remaining is None else min(remaining, self._queue_timeout))
+
+    @property
+    def hist(self):
+        ''' Histogram buffer that is filled by the first worker '''
+        return self._hists[0][self._active[0]]
+
+    def _swap(self, worker):
+        ''' Let the worker continue in its next buffer, return the previous buffer '''
+        with self.locks[worker]:
+            active = self._active[worker]
+            self._active[worker] = (active + 1) % self._n_buffers
+        return self._hists[worker][active]
+
+    def _get_partial(self, worker, reset):
+        ''' Copy of the partial histogram of a worker, optionally reset '''
+        if reset and self._n_buffers > 1:
+            # The inactive buffer is always empty and not used by the worker
+            partial_hist = self._swap(worker)
+            hist = partial_hist.copy()
+            partial_hist.fill(0)  # No overwrite with a new zero array due to shared memory
+            return hist
+        with self.locks[worker]:
+            partial_hist = self._hists[worker][self._active[worker]]
+            hist = partial_hist.copy()
+            if reset:
+                partial_hist.fill(0)
+        return hist
 
     def _reset_hist(self):
-        with self.lock:
-            self.hist = self.hist.reshape(-1)
-            for i in range(self.hist.shape[0]):
-                self.hist[i] = 0
-            self.hist = self.hist.reshape(self.shape)
+        for worker in range(self.n_workers):
+            if self._n_buffers > 1:
+                self._swap(worker).fill(0)
+            else:
+                with self.locks[worker]:
+                    self._hists[worker][0].fill(0)
 
-    def reset(self, wait=True, timeout=0.5):
+    def reset(self, wait=True, timeout=0.5, until=None):
         ''' Reset histogram '''
         if not wait:
-            if not self._raw_data_queue.empty() or not self.idle_worker.is_set():
+            if not self.is_done(until):
                 logger.warning('Resetting histogram while filling data')
         else:
-            if not self.idle_worker.wait(timeout):
+            if not self.wait(until, timeout):
                 logger.warning('Resetting histogram while filling data')
         self._reset_hist()
 
-    def get(self, wait=True, timeout=None, reset=True):
-        ''' Get the result histogram '''
+    def get(self, wait=True, timeout=None, reset=True, until=None):
+        ''' Get the result histogram
+
+            Waits until the readouts up to the ticket until (default: all added readouts) are histogrammed.
+            Without reset and with one worker the shared histogram itself is returned.
+        '''
         if not wait:
-            if not self._raw_data_queue.empty() or not self.idle_worker.is_set():
+            if not self.is_done(until):
                 logger.warning('Getting histogram while analyzing data')
         else:
-            if not self.idle_worker.wait(timeout):
+            if not self.wait(until, timeout):
                 logger.warning('Getting histogram while analyzing data. Consider increasing the timeout.')
+        self._check_overflow()
+        self._check_errors()
 
-        if reset:
-            hist = self.hist.copy()
-            # No overwrite with a new zero array due to shared memory
-            self._reset_hist()
-            return hist
-        else:
+        if not reset and self.n_workers == 1:
             return self.hist
-
-    def worker(self, raw_data_queue, shared_array_base, lock, stop, idle):
-        ''' Histogramming in seperate process '''
-        hist = np.ctypeslib.as_array(shared_array_base.get_obj()).reshape(self.shape)
+        hist = self._get_partial(0, reset)
+        for worker in range(1, self.n_workers):
+            hist += self._get_partial(worker, reset)
+        return hist
+
+    def worker(self, ring, shared_array_bases, lock, active, acked, acked_event, counters, latencies, errors, worker, stop):
+        ''' Histogramming in seperate process
+
+            An exception of the analysis function is logged and counted in errors, the readout is skipped
+            and the decoder state reset, so that the process continues and the parent is not blocked.
+        '''
+        hists = [np.ctypeslib.as_array(base.get_obj()).reshape(self.shape) for base in shared_array_bases]
+        counters = np.ctypeslib.as_array(counters).reshape(-1, 2)[worker]
+        latencies = np.ctypeslib.as_array(latencies).reshape(-1, self._n_latencies, 2)[worker]
+        initial_kwargs = copy.deepcopy(self.analysis_function_kwargs)
         while not stop.is_set():
             try:
-                data = raw_data_queue.get(timeout=self._queue_timeout)
-                idle.clear()
-                with lock:
-                    return_values = self.analysis_function(data, hist, **self.analysis_function_kwargs)
-                    self.analysis_function_kwargs.update(zip(self.analysis_function_kwargs, return_values))
-            except queue.Empty:
-                idle.set()
-                continue
+                ring.data_available.clear()
+                chunk = ring.read()
+                if chunk is None:
+                    ring.data_available.wait(self._queue_timeout)
+                    continue
+                segments, tag, flags, ticket, timestamp = chunk
+                start = time.time()
+                if flags & RESET_DECODER:
+                    self.analysis_function_kwargs = copy.deepcopy(initial_kwargs)
+                try:
+                    with lock:
+                        hist = hists[active[worker]]
+                        for raw_data in segments:  # Analysis functions keep their state between segments
+                            data = [raw_data, {'scan_param_id': tag}] if self.uses_scan_param_id else raw_data
+                            return_values = self.analysis_function(data, hist, **self.analysis_function_kwargs)
+                            self.analysis_function_kwargs.update(zip(self.analysis_function_kwargs, return_values))
+                except Exception:
+                    logger.exception('Online analysis of readout %d failed in worker %d', ticket, worker)
+                    errors[worker] += 1
+                    self.analysis_function_kwargs = copy.deepcopy(initial_kwargs)
+                end = time.time()
+                latencies[counters[1] % self._n_latencies] = (end - start, end - timestamp)
+                counters[0] += sum(raw_data.shape[0] for raw_data in segments)
+                counters[1] += 1
+                acked[worker] = ticket
+                ring.release()
+                acked_event.set()
             except KeyboardInterrupt:  # Need to catch KeyboardInterrupt from main process
                 stop.set()
-        idle.set()
 
     def close(self):
-        ''' Close process and wait till done. Likely needed to give access to pytable file handle.'''
-        logger.info('Stopping process %d', self.p.pid)
-        self._raw_data_queue.close()
-        self._raw_data_queue.join_thread()  # Needed otherwise IOError: [Errno 232] The pipe is being closed
+        ''' Close processes and wait till done. Likely needed to give access to pytable file handle.'''
         self.stop.set()
-        self.p.join()
-        del self.p  # explicit delete required to free memory
-        self.p = None
+        for p in self.processes:
+            logger.info('Stopping process %d', p.pid)
+            p.join()
+        self.processes = []  # explicit delete required to free memory
+        self._check_errors()
+        for status in self.get_status():
+            if status['overflow_chunks'] or status['back_pressure']:
+                logger.warning('Raw data ring buffer: %d readouts (%d words) dropped, %d times full, max. fill %d of %d words',
+                               status['overflow_chunks'], status['overflow_words'], status['back_pressure'], status['max_fill'], status['size'])
 
     def __del__(self):
-        if self.p and self.p.is_alive():
+        if any(p.is_alive() for p in self.processes):
             logger.warning('Process still running. Was close() called?')
             self.close()
 
@@ -197,12 +619,138 @@ class OccupancyHistogramming(OnlineHistogrammingBase):
         No event building.
     '''
 
-    def __init__(self):
-        super().__init__(shape=(512, 512))
-        self.analysis_function_kwargs = {'hit_data': np.zeros(1, dtype=au.hit_dtype), 'is_sof': -1, 'is_eof': -1, 'tj_data_flag': 0}
+    def __init__(self, n_workers=1):
+        super().__init__(shape=(512, 512), n_workers=n_workers)
+        self.analysis_function_kwargs = {'hits': None, 'state': get_decoder_state()}
 
-        def analysis_function(self, raw_data, hist, hit_data, is_sof, is_eof, tj_data_flag):
-            return histogram(raw_data, hist, hit_data, is_sof, is_eof, tj_data_flag)
+        def analysis_function(self, raw_data, hist, hits, state):
+            return histogram(raw_data, hist, hits, state)
         setattr(OccupancyHistogramming, 'analysis_function', analysis_function)
 
         self.init()
+
+
+class TotHistogramming(OnlineHistogrammingBase):
+    ''' Fast histogramming of raw data to the per pixel ToT sum and hit count
+
+        The histogram has the shape (512, 512, 2) with the ToT sum in [..., 0] and the hit count in [..., 1],
+        see get_mean_tot(). No event building.
+    '''
+
+    def __init__(self, n_workers=1):
+        super().__init__(shape=(512, 512, 2), n_workers=n_workers)
+        self.analysis_function_kwargs = {'hits': None, 'state': get_decoder_state()}
+
+        def analysis_function(self, raw_data, hist, hits, state):
+            hits = get_hit_buffer(hits, raw_data.shape[0])
+            n_hits = decode(raw_data, hits, state)
+            fill_tot(hits[:n_hits], hist)
+            return hits, state
+        setattr(TotHistogramming, 'analysis_function', analysis_function)
+
+        self.init()
+
+
+class TotSpectrumHistogramming(OnlineHistogrammingBase):
+    ''' Fast histogramming of raw data to a ToT histogram of all pixels (128 ToT values)
+
+        No event building.
+    '''
+
+    def __init__(self, n_workers=1):
+        super().__init__(shape=(128,), n_workers=n_workers)
+        self.analysis_function_kwargs = {'hits': None, 'state': get_decoder_state()}
+
+        def analysis_function(self, raw_data, hist, hits, state):
+            hits = get_hit_buffer(hits, raw_data.shape[0])
+            n_hits = decode(raw_data, hits, state)
+            fill_tot_spectrum(hits[:n_hits], hist)
+            return hits, state
+        setattr(TotSpectrumHistogramming, 'analysis_function', analysis_function)
+
+        self.init()
+
+
+class ScurveHistogramming(OnlineHistogrammingBase):
+    ''' Fast histogramming of raw data to a 3D hit histogramm (column, row, scan parameter id)
+
+        The scan parameter id has to be given with every readout as meta data:
+        add(raw_data, meta_data={'scan_param_id': scan_param_id}).
+        No event building.
+    '''
+    uses_scan_param_id = True
+
+    def __init__(self, n_scan_params, n_workers=1):
+        # No double buffering, the large histogram is read without reset
+        super().__init__(shape=(512, 512, n_scan_params), n_workers=n_workers, double_buffer=False)
+        self.analysis_function_kwargs = {'hits': None, 'state': get_decoder_state()}
+
+        def analysis_function(self, data, hist, hits, state):
+            raw_data, meta_data = data
+            hits = get_hit_buffer(hits, raw_data.shape[0])
+            n_hits = decode(raw_data, hits, state)  # Also untagged readouts to keep the decoder state
+            if meta_data['scan_param_id'] < 0:
+                if n_hits:
+                    logger.warning('Skipping %d hits of a readout without scan parameter id', n_hits)
+                return hits, state
+            fill_scan_param_occupancy(hits[:n_hits], hist, meta_data['scan_param_id'])
+            return hits, state
+        setattr(ScurveHistogramming, 'analysis_function', analysis_function)
+
+        self.init()
+
+
+def get_mean_tot(tot_hist):
+    ''' Mean ToT map from a TotHistogramming histogram, NaN for pixels without hits '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(tot_hist[..., 1] > 0, tot_hist[..., 0] / tot_hist[..., 1], np.nan)
+
+
+def get_scurve_maps(occ_hist, scan_params, n_injections, n_steps=None):
+    ''' Fit less threshold and noise maps from a (partially filled) 3D occupancy histogram
+
+        Parameters
+        ----------
+        occ_hist : numpy array
+            Occupancy histogram with the scan parameter id as last dimension
+        scan_params : numpy array like
+            Injected charge per scan parameter id, has to be equidistant
+        n_injections : integer
+            Number of injections per scan parameter id
+        n_steps : integer
+            Number of completed scan parameter ids to use. All are used if None.
+
+        Returns
+        -------
+        Threshold and noise map in units of the scan parameter
+    '''
+    if n_steps is None:
+        n_steps = occ_hist.shape[-1]
+    x = np.asarray(scan_params, dtype=float)[:n_steps]
+    y = occ_hist[..., :n_steps]
+    if n_steps < 2:
+        return np.full(occ_hist.shape[:-1], x.max()), np.zeros(occ_hist.shape[:-1])
+    # Fit less formulas expect increasing charge
+    order = np.argsort(x)
+    x, y = x[order], y[..., order]
+    return au.get_threshold(x, y, n_injections), au.get_noise(x, y, n_injections)
+
+
+def is_saturated(occ_hist, n_injections, sel=None, n_steps=None, tolerance=0.02, min_fraction=0.99):
+    ''' Check if the S-curves of the selected pixels reached the plateau in the last completed scan parameter id
+
+        A pixel is saturated if its occupancy is within the relative tolerance of n_injections.
+        Only a fraction min_fraction of the selected pixels has to be saturated,
+        so that a few dead pixels do not prevent the check from succeeding.
+    '''
+    if n_steps is None:
+        n_steps = occ_hist.shape[-1]
+    if n_steps < 1:
+        return False
+    occ = occ_hist[..., n_steps - 1]
+    if sel is not None:
+        occ = occ[sel]
+    if occ.size == 0:
+        return False
+    saturated = occ >= n_injections * (1. - tolerance)
+    return np.count_nonzero(saturated) >= min_fraction * occ.size
@@ -0,0 +1,189 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Synthetic TJ-Monopix2 raw data for benchmarks and tests.
+
+    Hits are generated in clusters per event and encoded like the chip does it: every event with hits
+    is one frame of 9 bit symbols (SOF, 4 symbols per hit with Gray coded LE / TE, EOF), padded with IDLE
+    and packed into data words with three symbols each. TLU, TDC and timestamp words are inserted
+    before the frame of an event. write_raw_data_file() stores the data like a scan does.
+'''
+
+import numpy as np
+import tables as tb
+
+SOF, EOF, IDLE = 0x1bc, 0x17c, 0x13c
+
+hit_dtype = np.dtype([('event', '<i8'), ('col', '<u2'), ('row', '<u2'), ('le', '<u1'), ('te', '<u1')])
+
+# Pixel offsets of the cluster hits, ordered by distance to the seed pixel
+_CLUSTER_OFFSETS = np.array([(0, 0), (1, 0), (0, 1), (1, 1), (-1, 0), (0, -1), (-1, -1), (1, -1), (-1, 1)])
+
+
+def bin2gray(value):
+    return value ^ (value >> 1)
+
+
+def generate_hits(n_events, n_clusters=1., cluster_size=1., tot=10., cols=(0, 512), rows=(0, 512), seed=None):
+    ''' Random hits (hit_dtype), sorted by event
+
+        n_clusters: float
+            Mean number of clusters per event (Poisson distributed)
+        cluster_size: float
+            Mean number of hits per cluster (1 + Poisson distributed, max. 9)
+        tot: float
+            Mean ToT of the hits (1 + Poisson distributed, max. 127)
+        cols, rows: tuple
+            Range of the seed pixels
+    '''
+    rng = np.random.default_rng(seed)
+    clusters_per_event = rng.poisson(n_clusters, n_events)
+    n_cluster = clusters_per_event.sum()
+    sizes = np.minimum(1 + rng.poisson(cluster_size - 1., n_cluster), _CLUSTER_OFFSETS.shape[0])
+    cluster_event = np.repeat(np.arange(n_events), clusters_per_event)
+    seed_col = rng.integers(cols[0], cols[1], n_cluster)
+    seed_row = rng.integers(rows[0], rows[1], n_cluster)
+
+    n_hits = sizes.sum()
+    cluster_index = np.repeat(np.arange(n_cluster), sizes)
+    hit_in_cluster = np.arange(n_hits) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    hits = np.zeros(n_hits, dtype=hit_dtype)
+    hits['event'] = cluster_event[cluster_index]
+    hits['col'] = np.clip(seed_col[cluster_index] + _CLUSTER_OFFSETS[hit_in_cluster, 0], 0, 511)
+    hits['row'] = np.clip(seed_row[cluster_index] + _CLUSTER_OFFSETS[hit_in_cluster, 1], 0, 511)
+    hits['le'] = rng.integers(0, 128, n_hits)
+    hits['te'] = (hits['le'] + np.minimum(1 + rng.poisson(tot - 1., n_hits), 127)) & 0x7f
+    return hits
+
+
+def encode_hit_symbols(col, row, le, te):
+    ''' The four 9 bit symbols per hit, shape (n_hits, 4) '''
+    col, row = np.asarray(col, dtype=np.uint32), np.asarray(row, dtype=np.uint32)
+    le_gray, te_gray = bin2gray(np.asarray(le, dtype=np.uint32)), bin2gray(np.asarray(te, dtype=np.uint32))
+    return np.column_stack(((col >> 1) & 0xff,
+                            (le_gray << 1) | (te_gray >> 6),
+                            ((te_gray & 0x3f) << 2) | ((col & 0x01) << 1) | (row >> 8),
+                            row & 0xff))
+
+
+def pack_symbols(symbols):
+    ''' Data words with three 9 bit symbols each, padded with IDLE '''
+    symbols = np.asarray(symbols, dtype=np.uint32)
+    symbols = np.append(symbols, np.full(-symbols.shape[0] % 3, IDLE, dtype=np.uint32)).reshape(-1, 3)
+    return 0x40000000 | (symbols[:, 0] << 18) | (symbols[:, 1] << 9) | symbols[:, 2]
+
+
+def encode_events(hits, n_events=None, tlu_rate=0., tdc_rate=0., timestamp_rate=0., seed=None):
+    ''' Raw data words of the hits (hit_dtype, sorted by event)
+
+        Every event with hits is one frame that starts at a word boundary.
+        tlu_rate, tdc_rate, timestamp_rate: float
+            Fraction of events with a TLU word (trigger number = event number), a TDC word (random value)
+            and a timestamp word (timestamp = event number) before the frame.
+    '''
+    rng = np.random.default_rng(seed)
+    if n_events is None:
+        n_events = int(hits['event'][-1]) + 1 if hits.shape[0] else 0
+    hits_per_event = np.bincount(hits['event'], minlength=n_events)
+    frame_symbols = np.where(hits_per_event > 0, 2 + 4 * hits_per_event, 0)
+    frame_symbols += -frame_symbols % 3
+    frame_words = frame_symbols // 3
+
+    has_tlu = rng.random(n_events) < tlu_rate
+    has_tdc = rng.random(n_events) < tdc_rate
+    has_timestamp = rng.random(n_events) < timestamp_rate
+    n_extra = has_tlu.astype(np.int64) + has_tdc + has_timestamp
+    event_words = n_extra + frame_words
+    event_start = np.cumsum(event_words) - event_words
+    raw_data = np.zeros(event_words.sum(), dtype=np.uint32)
+
+    events = np.arange(n_events, dtype=np.uint32)
+    raw_data[event_start[has_tlu]] = 0x80000000 | ((events[has_tlu] & 0x7fff) << 16) | (events[has_tlu] & 0xffff)
+    raw_data[event_start[has_tdc] + has_tlu[has_tdc]] = 0x20000000 | rng.integers(0, 4096, np.count_nonzero(has_tdc)).astype(np.uint32)
+    raw_data[event_start[has_timestamp] + n_extra[has_timestamp] - 1] = 0x48000000 | (events[has_timestamp] & 0x7ffffff)
+
+    # Symbol stream of all frames
+    symbol_start = np.cumsum(frame_symbols) - frame_symbols
+    symbols = np.full(frame_symbols.sum(), IDLE, dtype=np.uint32)
+    with_hits = hits_per_event > 0
+    symbols[symbol_start[with_hits]] = SOF
+    symbols[symbol_start[with_hits] + 1 + 4 * hits_per_event[with_hits]] = EOF
+    hit_rank = np.arange(hits.shape[0]) - (np.cumsum(hits_per_event) - hits_per_event)[hits['event']]
+    hit_position = symbol_start[hits['event']] + 1 + 4 * hit_rank
+    symbols[hit_position[:, np.newaxis] + np.arange(4)] = encode_hit_symbols(hits['col'], hits['row'], hits['le'], hits['te'])
+
+    frame_word_start = np.cumsum(frame_words) - frame_words
+    word_position = np.repeat(event_start + n_extra - frame_word_start, frame_words) + np.arange(frame_words.sum())
+    raw_data[word_position] = pack_symbols(symbols)
+    return raw_data
+
+
+def generate_raw_data(n_events, seed=None, tlu_rate=0., tdc_rate=0., timestamp_rate=0., **kwargs):
+    ''' Hits (see generate_hits for the kwargs) and their raw data words '''
+    rng = np.random.default_rng(seed)
+    hits = generate_hits(n_events, seed=rng, **kwargs)
+    return hits, encode_events(hits, n_events=n_events, tlu_rate=tlu_rate, tdc_rate=tdc_rate, timestamp_rate=timestamp_rate, seed=rng)
+
+
+def iter_raw_data(n_events=10000, seed=None, **kwargs):
+    ''' Endless raw data chunks of n_events events, e.g. as source of the DAQ emulator '''
+    rng = np.random.default_rng(seed)
+    while True:
+        yield generate_raw_data(n_events, seed=rng, **kwargs)[1]
+
+
+def write_raw_data_file(filename, raw_data, readout_words=100000, readout_interval=0.05, scan_id='synthetic',
+                        scan_config=None, chip_settings=None, scan_params=None):
+    ''' Write raw data with the nodes of a scan raw data file (see ScanBase._init_files)
+
+        raw_data: numpy array or list of numpy arrays
+            Raw data words, a list has the data of the scan parameter ids 0, 1, ...
+        readout_words: int
+            Number of words per readout (meta data row)
+        scan_config, chip_settings: dict
+            Stored in the configuration nodes
+        scan_params: numpy structured array
+            Scan parameter values per scan parameter id (configuration_out.scan.scan_params)
+    '''
+    from tjmonopix2.system.raw_data_writer import RawDataBatch
+    from tjmonopix2.system.scan_base import FILTER_RAW_DATA, FILTER_TABLES, MetaTable, RunConfigTable
+
+    if isinstance(raw_data, np.ndarray):
+        raw_data = [raw_data]
+    configuration = {'run_config': {'scan_id': scan_id, 'run_name': scan_id, 'software_version': 'synthetic', 'chip_sn': 'synthetic'},
+                     'scan_config': scan_config or {},
+                     'settings': chip_settings or {}}
+
+    with tb.open_file(filename, mode='w', title=scan_id) as h5_file:
+        for node_name, title in [('configuration_in', 'Configuration before scan'), ('configuration_out', 'Configuration after scan step')]:
+            node = h5_file.create_group(h5_file.root, node_name, title)
+            scan_node = h5_file.create_group(node, 'scan', 'Scan configuration')
+            chip_node = h5_file.create_group(node, 'chip', 'Chip configuration')
+            for parent, name in [(scan_node, 'run_config'), (scan_node, 'scan_config'), (chip_node, 'settings')]:
+                table = h5_file.create_table(parent, name=name, description=RunConfigTable)
+                for attribute, value in configuration[name].items():
+                    table.row['attribute'] = attribute
+                    table.row['value'] = value if isinstance(value, str) else repr(value)
+                    table.row.append()
+                table.flush()
+            if node_name == 'configuration_out' and scan_params is not None:
+                h5_file.create_table(scan_node, name='scan_params', title='Scan parameter values per scan parameter id', obj=scan_params)
+
+        raw_data_earray = h5_file.create_earray(h5_file.root, name='raw_data', atom=tb.UIntAtom(),
+                                                shape=(0,), title='raw_data', filters=FILTER_RAW_DATA)
+        meta_data_table = h5_file.create_table(h5_file.root, name='meta_data', description=MetaTable,
+                                               title='meta_data', filters=FILTER_TABLES)
+        batch = RawDataBatch(max_words=10 * readout_words, max_time=np.inf)
+        timestamp = 0.
+        for scan_param_id, data in enumerate(raw_data):
+            for start in range(0, max(data.shape[0], 1), readout_words):
+                readout = data[start:start + readout_words]
+                if batch.add((readout, timestamp, timestamp + readout_interval, 0, scan_param_id, readout_interval), scan_param_id):
+                    batch.write(raw_data_earray, meta_data_table)
+                timestamp += readout_interval
+        batch.write(raw_data_earray, meta_data_table)
@@ -0,0 +1,112 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Per chip cache of fitted threshold and noise maps.
+
+    The maps are stored in a h5 file next to the chip configuration and are
+    keyed by the front-end register settings and the TDAC mask. They are used as
+    per pixel start values for the S-curve fit of the next threshold scan.
+'''
+
+import hashlib
+import os
+import time
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.system import logger
+
+# Registers that change the threshold or noise of the pixels
+THRESHOLD_REGISTERS = ['ITHR', 'IBIAS', 'VRESET', 'ICASN', 'VCASP', 'VCASC', 'IDB', 'ITUNE', 'VCLIP', 'IDEL']
+
+
+class ThresholdCache(object):
+    ''' Store and look up the last fitted threshold and noise maps of a chip
+
+        directory: str
+            Directory of the chip configuration (chip output directory)
+        chip_sn: str
+            Serial number of the chip, used for the file name
+        max_entries: int
+            Number of register settings kept in the cache, the oldest entries are removed first
+    '''
+
+    def __init__(self, directory, chip_sn, max_entries=16):
+        self.log = logger.setup_derived_logger('ThresholdCache')
+        self.filename = os.path.join(directory, '%s_threshold_cache.h5' % chip_sn)
+        self.max_entries = max_entries
+
+    @staticmethod
+    def get_registers(registers):
+        ''' Select the threshold relevant registers from a dict like register name -> value '''
+        return {name: int(registers[name]) for name in THRESHOLD_REGISTERS if name in registers}
+
+    @staticmethod
+    def _get_tdac_hash(tdac):
+        return hashlib.sha1(np.ascontiguousarray(tdac, dtype=np.uint8).tobytes()).hexdigest()
+
+    @staticmethod
+    def _get_key(registers, tdac_hash):
+        key = ','.join('%s=%d' % (name, value) for name, value in sorted(registers.items())) + ',TDAC=' + tdac_hash
+        return 'entry_' + hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    def load(self, registers, tdac):
+        ''' Return threshold and noise map for the given settings
+
+            If there is no entry with the same settings, the entry with the most similar
+            settings (sum of absolute register differences, same TDAC mask preferred) is returned.
+            Returns None if the cache is empty.
+        '''
+        registers = self.get_registers(registers)
+        if not os.path.isfile(self.filename):
+            return None
+        tdac_hash = self._get_tdac_hash(tdac)
+        key = self._get_key(registers, tdac_hash)
+        with tb.open_file(self.filename, 'r') as in_file:
+            best, best_distance = None, None
+            for group in in_file.root:
+                if group._v_name == key:
+                    best = group
+                    break
+                cached_registers = group._v_attrs.registers
+                if set(cached_registers) != set(registers):
+                    continue
+                distance = sum(abs(cached_registers[name] - value) for name, value in registers.items())
+                if group._v_attrs.tdac_hash != tdac_hash:
+                    distance += 1e6  # Prefer entries with the same TDAC mask
+                if best_distance is None or distance < best_distance:
+                    best, best_distance = group, distance
+            if best is None:
+                return None
+            if best._v_name == key:
+                self.log.info('Use cached threshold and noise maps')
+            else:
+                self.log.info('Use cached threshold and noise maps of most similar settings %s', best._v_attrs.registers)
+            return best.threshold[:], best.noise[:]
+
+    def store(self, registers, tdac, threshold_map, noise_map):
+        ''' Store threshold and noise map for the given settings, replaces an existing entry '''
+        registers = self.get_registers(registers)
+        tdac_hash = self._get_tdac_hash(tdac)
+        key = self._get_key(registers, tdac_hash)
+        with tb.open_file(self.filename, 'a') as out_file:
+            if key in out_file.root:
+                out_file.remove_node(out_file.root, key, recursive=True)
+            group = out_file.create_group(out_file.root, key)
+            group._v_attrs.registers = registers
+            group._v_attrs.tdac_hash = tdac_hash
+            group._v_attrs.timestamp = time.time()
+            filters = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+            out_file.create_carray(group, name='threshold', title='Threshold Map', obj=np.asarray(threshold_map, dtype=np.float32), filters=filters)
+            out_file.create_carray(group, name='noise', title='Noise Map', obj=np.asarray(noise_map, dtype=np.float32), filters=filters)
+
+            # Remove oldest entries
+            groups = sorted(out_file.root, key=lambda g: g._v_attrs.timestamp)
+            for group in groups[:max(0, len(groups) - self.max_entries)]:
+                out_file.remove_node(group, recursive=True)
@@ -0,0 +1,158 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Per pixel ToT to charge calibration from threshold scan data.
+
+    The mean ToT of every pixel is described by the surrogate function
+        ToT(Q) = a * Q + b - c / (Q - t)
+    with the pixel threshold t. For a fixed threshold the function is linear in a, b and c,
+    so all pixels are fitted at once with a weighted linear least squares fit.
+    The charge is in units of the injection DAC (VCAL_HIGH - VCAL_LOW).
+'''
+
+import logging
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.analysis import analysis_utils as au
+
+logger = logging.getLogger('Analysis')
+
+
+def fit_tot_calibration(hist_hits, hist_tot, charges, n_injections, threshold=None, min_occupancy=0.9):
+    ''' Fit ToT(Q) = a * Q + b - c / (Q - t) for all pixels at once
+
+        Parameters
+        ----------
+        hist_hits, hist_tot : numpy array
+            Hit count and ToT sum with the scan parameter id in the last dimension
+        charges : numpy array like
+            Injected charge per scan parameter id
+        n_injections : integer
+            Number of injections per scan parameter id
+        threshold : numpy array
+            Threshold map t. Fit less estimate from the hit count if None.
+        min_occupancy : float
+            Only use charges where the pixel sees at least this fraction of the injections.
+            The mean ToT close to threshold is biased.
+
+        Returns
+        -------
+        a, b, c, t maps. Pixels with less than three usable charges are NaN.
+    '''
+    charges = np.asarray(charges, dtype=float)
+    if threshold is None:
+        order = np.argsort(charges)
+        threshold = au.get_threshold(charges[order], hist_hits[..., order], n_injections)
+    t = np.asarray(threshold, dtype=float)[..., np.newaxis]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_tot = hist_tot / hist_hits
+        inv = 1. / (charges - t)
+    valid = (hist_hits >= min_occupancy * n_injections) & (charges > t) & np.isfinite(inv)
+    w = np.where(valid, hist_hits, 0).astype(float)
+    mean_tot = np.where(valid, mean_tot, 0.)
+    inv = np.where(valid, inv, 0.)
+
+    # Weighted normal equations for the basis (Q, 1, -1 / (Q - t)), one 3x3 system per pixel
+    s_qq, s_q, s_1 = (w * charges ** 2).sum(axis=-1), (w * charges).sum(axis=-1), w.sum(axis=-1)
+    s_qi, s_i, s_ii = -(w * charges * inv).sum(axis=-1), -(w * inv).sum(axis=-1), (w * inv ** 2).sum(axis=-1)
+    lhs = np.stack([np.stack([s_qq, s_q, s_qi], axis=-1),
+                    np.stack([s_q, s_1, s_i], axis=-1),
+                    np.stack([s_qi, s_i, s_ii], axis=-1)], axis=-2)
+    rhs = np.stack([(w * charges * mean_tot).sum(axis=-1), (w * mean_tot).sum(axis=-1), -(w * inv * mean_tot).sum(axis=-1)], axis=-1)
+
+    n_valid = np.count_nonzero(valid, axis=-1)
+    sel = (n_valid >= 3) & (np.abs(np.linalg.det(lhs)) > 1e-12)
+    params = np.full(lhs.shape[:-1], np.nan)
+    params[sel] = np.linalg.solve(lhs[sel], rhs[sel][..., np.newaxis])[..., 0]
+    logger.info('ToT calibration fitted for %d pixels', np.count_nonzero(sel))
+
+    t = np.where(sel, t[..., 0], np.nan)
+    return params[..., 0], params[..., 1], params[..., 2], t
+
+
+class TotCalibration(object):
+    ''' Per pixel ToT to charge calibration stored as compact float32 maps '''
+
+    def __init__(self, a, b, c, t):
+        self.a = np.asarray(a, dtype=np.float32)
+        self.b = np.asarray(b, dtype=np.float32)
+        self.c = np.asarray(c, dtype=np.float32)
+        self.t = np.asarray(t, dtype=np.float32)
+
+    @classmethod
+    def from_threshold_scan(cls, interpreted_file, min_occupancy=0.9, chunk_size=1000000):
+        ''' Fit the calibration from the hits of an interpreted threshold scan file '''
+        with tb.open_file(interpreted_file, 'r') as in_file:
+            n_injections = au.ConfigDict(in_file.root.configuration_in.scan.scan_config[:])['n_injections']
+            threshold = in_file.root.ThresholdMap[:] if 'ThresholdMap' in in_file.root else None
+            charges = au.get_scan_param_charges(in_file.root.configuration_in.scan.scan_params[:])
+            hist_hits, hist_tot = au.hist_scan_param_cube(in_file.root.Dut, charges.shape[0], chunk_size=chunk_size, tot=True)
+            if threshold is None and 'injected' in in_file.root.configuration_in.scan:  # Fit less threshold needs complete S-curves
+                order = np.argsort(charges)
+                threshold = au.get_threshold(charges[order], au.fill_scurves(hist_hits, in_file.root.configuration_in.scan.injected[..., :charges.shape[0]],
+                                                                             charges, n_injections)[..., order], n_injections)
+        if threshold is not None:
+            threshold = np.where(threshold > 0, threshold, np.nan)  # Failed fits
+        return cls(*fit_tot_calibration(hist_hits, hist_tot, charges, n_injections, threshold=threshold, min_occupancy=min_occupancy))
+
+    @classmethod
+    def load(cls, filename):
+        with tb.open_file(filename, 'r') as in_file:
+            node = in_file.root.TotCalibration
+            return cls(node.a[:], node.b[:], node.c[:], node.t[:])
+
+    def store(self, filename, mode='a'):
+        ''' Store the calibration maps in the TotCalibration group of a h5 file '''
+        with tb.open_file(filename, mode) as out_file:
+            if 'TotCalibration' in out_file.root:
+                out_file.remove_node(out_file.root, 'TotCalibration', recursive=True)
+            node = out_file.create_group(out_file.root, 'TotCalibration', 'ToT(Q) = a * Q + b - c / (Q - t)')
+            filters = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+            for name in ['a', 'b', 'c', 't']:
+                out_file.create_carray(node, name=name, obj=getattr(self, name), filters=filters)
+
+    def get_charge(self, col, row, tot):
+        ''' Charge for ToT values of the given pixels, NaN for uncalibrated pixels
+
+            Inverse of ToT(Q): a * Q**2 + (b - a * t - ToT) * Q + t * (ToT - b) - c = 0,
+            the larger root above threshold is the solution.
+        '''
+        a, b, c, t = self.a[col, row], self.b[col, row], self.c[col, row], self.t[col, row]
+        tot = np.asarray(tot, dtype=np.float32)
+        p = b - a * t - tot
+        q = t * (tot - b) - c
+        with np.errstate(divide='ignore', invalid='ignore'):
+            charge = (-p + np.sqrt(p * p - 4. * a * q)) / (2. * a)
+        return np.where(a > 0, charge, np.nan).astype(np.float32)
+
+    def add_charge(self, hits):
+        ''' Return a copy of the hits with a charge column (analysis_utils.hit_charge_dtype) '''
+        out = np.empty(hits.shape[0], dtype=au.hit_charge_dtype)
+        for name in hits.dtype.names:
+            out[name] = hits[name]
+        valid = (hits['col'] < 512) & (hits['row'] < 512) & (hits['col'] >= 0) & (hits['row'] >= 0)
+        tot = (hits['te'].astype(np.int16) - hits['le']) & 0x7f
+        out['charge'] = np.nan
+        out['charge'][valid] = self.get_charge(hits['col'][valid], hits['row'][valid], tot[valid])
+        return out
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Fit a per pixel ToT calibration from an interpreted threshold scan file.')
+    parser.add_argument('input_file', help='The _threshold_scan_interpreted.h5 file')
+    parser.add_argument('-o', '--output_file', help='Output h5 file, default is the input file name with _tot_calibration.h5')
+    parser.add_argument('--min_occupancy', type=float, default=0.9, help='Minimum occupancy (fraction of injections) of a charge to be used in the fit')
+    args = parser.parse_args()
+
+    output_file = args.output_file or args.input_file.replace('_interpreted.h5', '').replace('.h5', '') + '_tot_calibration.h5'
+    TotCalibration.from_threshold_scan(args.input_file, min_occupancy=args.min_occupancy).store(output_file, mode='w')
@@ -1,3 +1,5 @@
+import time
+
 import numpy as np
 
 from online_monitor.converter.transceiver import Transceiver
@@ -43,6 +45,8 @@ class TJMonopix2(Transceiver):
         self.fps = 0.  # Readouts per second
         self.hps = 0.  # Hits per second
         self.tps = 0.  # Triggers per second
+        self.ipt = 0.  # Interpretation time per readout
+        self.lag = 0.  # Time from readout to interpreted histogram
         self.total_trigger_words = 0
 
     def deserialize_data(self, data):
@@ -81,7 +85,10 @@ class TJMonopix2(Transceiver):
     def interpret_data(self, data):
         ''' Called for every chunk received '''
         raw_data, meta_data = data[0][1]
+        if meta_data.get('name') == 'ScurveMaps':  # Result maps of online S-curve analysis, no raw data
+            return [{'meta_data': meta_data, 'maps': dict(zip(meta_data['maps'], raw_data))}]
         meta_data = self._add_to_meta_data(meta_data)
+        ts_start = time.time()
 
         hit_buffer = np.zeros(4 * len(raw_data), dtype=au.hit_dtype)
         hits = self.interpreter.interpret(raw_data, hit_buffer)
@@ -104,6 +111,12 @@ class TJMonopix2(Transceiver):
             sel = occupancy_hist > self.noisy_threshold * np.median(occupancy_hist[occupancy_hist > 0])
             occupancy_hist[sel] = 0
 
+        # Interpretation time and lag with smoothing
+        ts_stop = time.time()
+        self.ipt = self.ipt * 0.95 + (ts_stop - ts_start) * 0.05
+        self.lag = self.lag * 0.95 + (ts_stop - float(meta_data['timestamp_stop'])) * 0.05
+        meta_data.update({'ipt': self.ipt, 'lag': self.lag})
+
         interpreted_data = {
             'meta_data': meta_data,
             'occupancy': occupancy_hist,
@@ -42,7 +42,9 @@ class TJMonopix2(Receiver):
         self.trigger_rate_label = QtWidgets.QLabel("Trigger Rate\n0 Hz")
         self.timestamp_label = QtWidgets.QLabel("Data Timestamp\n")
         self.plot_delay_label = QtWidgets.QLabel("Plot Delay\n")
+        self.interpretation_label = QtWidgets.QLabel("Interpretation / Lag\n")
         self.scan_parameter_label = QtWidgets.QLabel("Parameter ID\n")
+        self.scurve_label = QtWidgets.QLabel("Threshold / Noise\n")
         self.spin_box = QtWidgets.QSpinBox(value=0)
         self.spin_box.setMaximum(1000000)
         self.spin_box.setSuffix(" Readouts")
@@ -50,13 +52,15 @@ class TJMonopix2(Receiver):
         self.noisy_checkbox = QtWidgets.QCheckBox('Mask noisy pixels')
         layout.addWidget(self.timestamp_label, 0, 0, 0, 1)
         layout.addWidget(self.plot_delay_label, 0, 1, 0, 1)
-        layout.addWidget(self.rate_label, 0, 2, 0, 1)
-        layout.addWidget(self.hit_rate_label, 0, 3, 0, 1)
-        layout.addWidget(self.trigger_rate_label, 0, 4, 0, 1)
-        layout.addWidget(self.scan_parameter_label, 0, 5, 0, 1)
-        layout.addWidget(self.spin_box, 0, 6, 0, 1)
-        layout.addWidget(self.noisy_checkbox, 0, 7, 0, 1)
-        layout.addWidget(self.reset_button, 0, 8, 0, 1)
+        layout.addWidget(self.interpretation_label, 0, 2, 0, 1)
+        layout.addWidget(self.rate_label, 0, 3, 0, 1)
+        layout.addWidget(self.hit_rate_label, 0, 4, 0, 1)
+        layout.addWidget(self.trigger_rate_label, 0, 5, 0, 1)
+        layout.addWidget(self.scan_parameter_label, 0, 6, 0, 1)
+        layout.addWidget(self.scurve_label, 0, 7, 0, 1)
+        layout.addWidget(self.spin_box, 0, 8, 0, 1)
+        layout.addWidget(self.noisy_checkbox, 0, 9, 0, 1)
+        layout.addWidget(self.reset_button, 0, 10, 0, 1)
         dock_status.addWidget(cw)
 
         # Connect widgets
@@ -104,7 +108,17 @@ class TJMonopix2(Receiver):
             self.hit_rate_label.setText("Hit Rate\n%d Hz" % int(hps))
             self.trigger_rate_label.setText("Trigger Rate\n%d Hz" % int(tps))
 
+    def _update_scurve_maps(self, maps, scan_par_id):
+        threshold, noise = maps['threshold'], maps['noise']
+        sel = np.isfinite(threshold) & (noise > 0)
+        if np.any(sel):
+            self.scurve_label.setText("Threshold / Noise (ID %d)\n%1.1f / %1.2f DAC" % (scan_par_id, np.mean(threshold[sel]), np.mean(noise[sel])))
+
     def handle_data(self, data):
+        if 'maps' in data:  # Online S-curve analysis result
+            self._update_scurve_maps(data['maps'], data['meta_data']['scan_par_id'])
+            return
+
         # Histogram data
         self.occupancy_data = data['occupancy']
         self.tot_data = data['tot_hist']
@@ -117,6 +131,8 @@ class TJMonopix2(Receiver):
                           data['meta_data']['total_hits'],
                           data['meta_data']['total_triggers'])
 
+        if 'ipt' in data['meta_data']:
+            self.interpretation_label.setText("Interpretation / Lag\n%1.2f / %1.2f ms" % (data['meta_data']['ipt'] * 1.e3, data['meta_data']['lag'] * 1.e3))
         self.timestamp_label.setText("Data Timestamp\n%s" % time.asctime(time.localtime(data['meta_data']['timestamp_stop'])))
         # self.scan_parameter_label.setText("Parameter ID\n%d" % data['meta_data']['scan_param_id'])
         now = time.time()
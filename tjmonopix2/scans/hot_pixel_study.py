@@ -6,6 +6,8 @@
 #
 """Enables some pixels, inject a fixed charge only on one."""
 
+import numpy as np
+
 from tjmonopix2.analysis import analysis
 from tjmonopix2.system.scan_base import ScanBase
 
@@ -142,15 +144,8 @@ class HotPixelScan(ScanBase):
         for col in [85, 109, 131, 145, 157, 163, 204, 205, 279, 282, 295, 327, 335]:
             dcol = col // 2
             reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        for i, v in enumerate(reg_values):
-            # EN_RO_CONF
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF
-            self.chip._write_register(171+i, v)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
+        # EN_RO_CONF (155-170), EN_BCID_CONF (171-186), EN_RO_RST_CONF (187-202), EN_FREEZE_CONF (203-218)
+        self.chip.write_registers(np.add.outer([155, 171, 187, 203], np.arange(16)), np.tile(reg_values, 4))
 
         self.chip.masks.apply_disable_mask()
         self.chip.masks.update(force=True)
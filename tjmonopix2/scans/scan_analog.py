@@ -61,7 +61,7 @@ class AnalogScan(ScanBase):
 
         pbar = tqdm(total=get_scan_loop_mask_steps(self), unit='Mask steps', delay=0.1)
         with self.readout(scan_param_id=0):
-            shift_and_inject(scan=self, n_injections=n_injections, pbar=pbar, scan_param_id=0)
+            shift_and_inject(scan=self, n_injections=n_injections, pbar=pbar, scan_param_id=0, cache=True)
         self.update_pbar_with_word_rate(pbar)
         pbar.close()
 
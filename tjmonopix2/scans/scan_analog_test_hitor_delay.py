@@ -180,20 +180,15 @@ class AnalogScan(ScanBase):
             # Enable HITOR general output (active low)
             self.chip.registers["SEL_PULSE_EXT_CONF"].write(0)
             # Disable HITOR (active high) on all columns, all rows - needed to reset this for next step
-            for i in range(512//16):
-                self.chip._write_register(18+i, 0)
-                self.chip._write_register(50+i, 0)
+            self.chip.write_registers(np.add.outer([18, 50], np.arange(512//16)), 0)  # EN_HITOR_COL, EN_HITOR_ROW
             # Enable HITOR (active high) on all columns, all rows
             # for i in range(512//16):
             #     self.chip._write_register(18+i, 0xffff)
             #     self.chip._write_register(50+i, 0xffff)
             # Enable HITOR (active high) on col 300 (18+ int 300//16=18+18 , 2**(300%16) and row 2 (50+2//16=50+0, 2**(2%16) )
             # or row x (50+(x//16), 2**(x%16)
-            for i in range(512//16):
-                # self.chip._write_register(18+i,  0xffff)
-                # self.chip._write_register(50+i, 0xffff)
-                self.chip._write_register(18+(300//16), 2**(300%16))
-                self.chip._write_register(50+(509//16), 2**(509%16))
+            # self.chip.write_registers(np.add.outer([18, 50], np.arange(512//16)), 0xffff)
+            self.chip.write_registers([18+(300//16), 50+(509//16)], [2**(300%16), 2**(509%16)])
             # # Enable HITOR (active high) on col 300 (18+ int 300/16=18+18 , 2**(300%16) and row 2 (50+2/16=50+0, 2**(2%16) )
             # self.chip._write_register(18+18, 2**(300%16))
             # self.chip._write_register(50, 2**(2%16))
@@ -315,15 +315,9 @@ class SourceScan(ScanBase):
         #for col in [511]:
             dcol = col // 2
             reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        for i, v in enumerate(reg_values):
-            # EN_RO_CONF
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF (to disable BCID distribution, use 0 instead of v)
-            self.chip._write_register(171+i, v)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
+        # EN_RO_CONF (155-170), EN_BCID_CONF (171-186), EN_RO_RST_CONF (187-202), EN_FREEZE_CONF (203-218)
+        # (to disable BCID distribution, use 0 instead of reg_values for EN_BCID_CONF)
+        self.chip.write_registers(np.add.outer([155, 171, 187, 203], np.arange(16)), np.tile(reg_values, 4))
 
 
         self.chip.masks.apply_disable_mask()
@@ -338,20 +332,14 @@ class SourceScan(ScanBase):
                 self.scan_registers[r] = self.register_overrides[r]
 
         # Disable HITOR (active high) on all columns, all rows - needed to reset this for next step
-        for i in range(512//16):
-            self.chip._write_register(18+i, 0)
-            self.chip._write_register(50+i, 0)
+        self.chip.write_registers(np.add.outer([18, 50], np.arange(512//16)), 0)  # EN_HITOR_COL, EN_HITOR_ROW
             # Enable HITOR (active high) on all columns, all rows
             # for i in range(512//16):
             #     self.chip._write_register(18+i, 0xffff)
             #     self.chip._write_register(50+i, 0xffff)
         # Enable HITOR (active high) on col 300 (18+ int 300/16=18+18 , 2**(300%16) and row 2 (50+2/16=50+0, 2**(2%16) )
-        for i in range(512//16):
-            # self.chip._write_register(18+i, 0xffff) # Cols
-            self.chip._write_register(50+i, 0xffff) # Rows
-        self.chip._write_register(18+17, 0xffff)
-        self.chip._write_register(18+18, 0xffff)
-        self.chip._write_register(18+19, 0xffff)
+        # self.chip.write_registers(18 + np.arange(512//16), 0xffff) # Cols
+        self.chip.write_registers(np.concatenate([50 + np.arange(512//16), [18+17, 18+18, 18+19]]), 0xffff) # Rows, cols 272 - 319
         # self.chip._write_register(50+(509//16), 2**((509+i)%16))
         # Enable HITOR (active high) on col 300 (18+ int 300/16=18+18 , 2**(300%16) and row 2 (50+2/16=50+0, 2**(2%16) )
         #self.chip._write_register(18+(300//16), 2**(300%16))
@@ -5,14 +5,18 @@
 # ------------------------------------------------------------
 #
 
+import os
 import time
 
 import tables as tb
 import numpy as np
 
 from tjmonopix2.analysis import analysis
-from tjmonopix2.scans.shift_and_inject import get_scan_loop_mask_steps, shift_and_inject
-from tjmonopix2.system.scan_base import ScanBase
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis.threshold_cache import ThresholdCache
+from tjmonopix2.analysis import online as oa
+from tjmonopix2.scans.shift_and_inject import get_scan_loop_mask_steps, shift_and_inject, shift_and_inject_scan_params
+from tjmonopix2.system.scan_base import ScanBase, send_maps
 from tqdm import tqdm
 
 scan_configuration = {
@@ -35,6 +39,15 @@ scan_configuration = {
 
     'reset_bcid': True,  # Reset BCID counter before every injection
     'inj_pulse_start_delay':1,  # Delay between BCID reset and inj pulse in 320 MHz clock cycles (there is also an offset of about 80 cycles)
+    'online_scurve': False,  # Update threshold and noise maps after every VCAL step
+    'stop_on_saturation': False,  # Stop the scan when all S-curves reached the plateau (needs online_scurve and increasing charge)
+    'adaptive': False,  # Locate the thresholds with a coarse scan and inject only charges around them afterwards
+    'adaptive_coarse_factor': 4,  # Every n-th VCAL_LOW step is used for the coarse scan
+    'mask_outer_loop': False,  # Loop over VCAL_LOW inside of every mask step, masks are written only once
+    'mask_pattern': 'default',  # Mask shift pattern: 'default' (one front-end after the other), 'parallel' (all front-ends together, no skipped steps) or 'interleaved' (4 columns at a time, 4 times faster)
+    'mask_step': 4,  # Row distance of the pixels injected at the same time
+    'fit_scurves': False,  # Fit the S-curves in the analysis and store threshold, noise and chi2 maps
+    'use_threshold_cache': True,  # Start the fits from the last results of this chip with similar register settings
     #'load_tdac_from': None,  # Optional h5 file to load the TDAC values from
 
     #region LOAD TDAC
@@ -255,7 +268,9 @@ register_overrides = {
 class ThresholdScan(ScanBase):
     scan_id = 'threshold_scan'
 
-    def _configure(self, start_column=0, stop_column=512, start_row=0, stop_row=512, load_tdac_from=None, **_):
+    def _configure(self, start_column=0, stop_column=512, start_row=0, stop_row=512, load_tdac_from=None, mask_pattern='default', mask_step=4, **_):
+        self.chip.masks.shift_pattern = mask_pattern
+        self.chip.masks.mask_step = mask_step
         # Setting the enable mask to False is equivalent to setting tdac to 0 = 0b000
         # This prevents the discriminator from firing, but we are not sure whether it disables the analog FE or not
         self.chip.masks['enable'][:,:] = False
@@ -359,15 +374,9 @@ class ThresholdScan(ScanBase):
         #for col in [511]:
             dcol = col // 2
             reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        for i, v in enumerate(reg_values):
-            # EN_RO_CONF
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF (to disable BCID distribution, use 0 instead of v)
-            self.chip._write_register(171+i, v)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
+        # EN_RO_CONF (155-170), EN_BCID_CONF (171-186), EN_RO_RST_CONF (187-202), EN_FREEZE_CONF (203-218)
+        # (to disable BCID distribution, use 0 instead of reg_values for EN_BCID_CONF)
+        self.chip.write_registers(np.add.outer([155, 171, 187, 203], np.arange(16)), np.tile(reg_values, 4))
 
         self.chip.masks.apply_disable_mask()
         self.chip.masks.update(force=True)
@@ -375,18 +384,14 @@ class ThresholdScan(ScanBase):
         for r in self.register_overrides:
             self.chip.registers[r].write(self.register_overrides[r])
         # Disable HITOR (active high) on all columns, all rows - needed to reset this for next step
-        for i in range(512//16):
-            self.chip._write_register(18+i, 0)
-            self.chip._write_register(50+i, 0)
+        self.chip.write_registers(np.add.outer([18, 50], np.arange(512//16)), 0)  # EN_HITOR_COL, EN_HITOR_ROW
         # Enable HITOR (active high) on all columns, all rows
         # for i in range(512//16):
         #     self.chip._write_register(18+i, 0xffff)
         #     self.chip._write_register(50+i, 0xffff)
         # Enable HITOR (active high) on col 300 (18+ int 300//16=18+18 , 2**(300%16) and row 2 (50+2//16=50+0, 2**(2%16) )
         # or row x (50+(x//16), 2**(x%16)
-        for i in range(512//16):
-            self.chip._write_register(18+i, 0xffff)
-            self.chip._write_register(50+i, 0xffff)
+        self.chip.write_registers(np.add.outer([18, 50], np.arange(512//16)), 0xffff)
             #self.chip._write_register(18+17,  0xffff)
             #self.chip._write_register(18+18,  0xffff)
             #self.chip._write_register(18+19,  0xffff)
@@ -404,29 +409,211 @@ class ThresholdScan(ScanBase):
 
         self.daq.rx_channels['rx0']['DATA_DELAY'] = 14
 
-    def _scan(self, n_injections=100, VCAL_HIGH=80, VCAL_LOW_start=80, VCAL_LOW_stop=40, VCAL_LOW_step=-1, reset_bcid=False, inj_pulse_start_delay=1, **_):
+    def _scan(self, n_injections=100, VCAL_HIGH=80, VCAL_LOW_start=80, VCAL_LOW_stop=40, VCAL_LOW_step=-1, reset_bcid=False, inj_pulse_start_delay=1,
+              online_scurve=False, stop_on_saturation=False, adaptive=False, adaptive_coarse_factor=4, adaptive_window=None, mask_outer_loop=False, **_):
         """
         Injects charges from VCAL_LOW_START to VCAL_LOW_STOP in steps of VCAL_LOW_STEP while keeping VCAL_HIGH constant.
+
+        With online_scurve the occupancy is histogrammed during the scan and fit-less threshold and noise maps
+        are updated after every scan parameter id. With stop_on_saturation the scan is stopped as soon as
+        the S-curves of all enabled pixels reached the plateau (only for increasing charge).
+
+        With adaptive the scan first injects all pixels at every adaptive_coarse_factor-th VCAL_LOW step to
+        locate the thresholds and afterwards injects only at the remaining steps within a window around the
+        thresholds. The window is common to the pixels of a mask step: from their lowest to their highest threshold
+        extended by +- adaptive_window DAC, or by one coarse step plus three times their median noise if not given.
+        Mask steps are only injected at the charges within their window, the masks of the other mask steps are
+        written from the cache without injection. Scan parameter ids are the same as for the regular scan. The injected pixels per scan parameter id are stored, the analysis fills the
+        S-curves outside of the windows.
+
+        With mask_outer_loop the VCAL_LOW loop runs inside of every mask step, so that the pixel masks are
+        written only once. All charges are recorded in one readout and tagged by scan parameter id.
+        The online maps are then only available at the end of the scan.
         """
 
         self.chip.registers["VH"].write(VCAL_HIGH)
         vcal_low_range = range(VCAL_LOW_start, VCAL_LOW_stop, VCAL_LOW_step)
+        charges = [VCAL_HIGH - v for v in vcal_low_range]
+
+        if adaptive and len(range(0, len(vcal_low_range), adaptive_coarse_factor)) < 3:
+            self.log.warning('Adaptive scan needs at least 3 coarse steps, using regular scan')
+            adaptive = False
+        if stop_on_saturation and (not online_scurve or adaptive or mask_outer_loop or VCAL_LOW_step > 0):
+            self.log.warning('Stop on saturation requires online_scurve, no adaptive scan, no mask_outer_loop and increasing charge, ignoring it')
+            stop_on_saturation = False
+        if online_scurve or adaptive:
+            self.data.hist_scurve = oa.ScurveHistogramming(n_scan_params=len(vcal_low_range))
+            self.data.scurve_sel = np.logical_and(self.chip.masks['enable'], self.chip.masks['injection'])
+            callback = self.analyze_data_online
+        else:
+            callback = self.handle_data
+
+        try:
+            if adaptive:
+                self._scan_adaptive(n_injections, VCAL_HIGH, vcal_low_range, charges, callback, adaptive_coarse_factor, adaptive_window,
+                                    reset_bcid=reset_bcid, inj_pulse_start_delay=inj_pulse_start_delay, mask_outer_loop=mask_outer_loop)
+            elif mask_outer_loop:
+                pbar = tqdm(total=get_scan_loop_mask_steps(self), unit=' mask steps', smoothing=0, delay=0.1)
+                for scan_param_id, vcal_low in enumerate(vcal_low_range):
+                    self.store_scan_par_values(scan_param_id=scan_param_id, vcal_high=VCAL_HIGH, vcal_low=vcal_low)
+                self._scan_mask_outer(range(len(vcal_low_range)), vcal_low_range, n_injections, callback, pbar, reset_bcid, inj_pulse_start_delay)
+                pbar.close()
+                if online_scurve:
+                    self._update_online_scurve_maps(charges, n_injections, n_steps=len(charges))
+            else:
+                pbar = tqdm(total=get_scan_loop_mask_steps(self) * len(vcal_low_range), unit=' mask steps', smoothing=0, delay=0.1)
+                for scan_param_id, vcal_low in enumerate(vcal_low_range):
+                    self.store_scan_par_values(scan_param_id=scan_param_id, vcal_high=VCAL_HIGH, vcal_low=vcal_low)
+                    self._scan_step(scan_param_id, vcal_low, n_injections, callback, pbar, reset_bcid, inj_pulse_start_delay)
+
+                    if online_scurve:
+                        self._update_online_scurve_maps(charges, n_injections, n_steps=scan_param_id + 1)
+                        if stop_on_saturation and oa.is_saturated(self.data.hist_scurve.get(reset=False), n_injections,
+                                                                  sel=self.data.scurve_sel, n_steps=scan_param_id + 1):
+                            self.log.info('All S-curves saturated at VCAL_LOW = %d, stopping scan', vcal_low)
+                            break
+                pbar.close()
+        finally:
+            if online_scurve or adaptive:
+                self.data.hist_scurve.close()  # stop analysis process
 
-        pbar = tqdm(total=get_scan_loop_mask_steps(self) * len(vcal_low_range), unit=' mask steps', smoothing=0, delay=0.1)
-        for scan_param_id, vcal_low in enumerate(vcal_low_range):
-            self.chip.registers["VL"].write(vcal_low)
+        self.log.success('Scan finished')
 
+    def _scan_step(self, scan_param_id, vcal_low, n_injections, callback, pbar, reset_bcid, inj_pulse_start_delay, mask_steps=None):
+        self.chip.registers["VL"].write(vcal_low)
+        with self.readout(scan_param_id=scan_param_id, callback=callback):
+            shift_and_inject(scan=self, n_injections=n_injections, pbar=pbar, scan_param_id=scan_param_id, reset_bcid=reset_bcid, PulseStartCnfg=inj_pulse_start_delay,
+                             cache=True, mask_steps=mask_steps)  # Same masks in every step
+        self.update_pbar_with_word_rate(pbar)
+
+    def _scan_mask_outer(self, scan_param_ids, vcal_low_range, n_injections, callback, pbar, reset_bcid, inj_pulse_start_delay):
+        def set_vcal_low(scan_param_id):
+            self.chip.registers["VL"].write(vcal_low_range[scan_param_id])
+
+        with self.readout(scan_param_id=scan_param_ids[0], callback=callback):
+            shift_and_inject_scan_params(scan=self, n_injections=n_injections, scan_param_ids=scan_param_ids, set_scan_param=set_vcal_low,
+                                         pbar=pbar, reset_bcid=reset_bcid, PulseStartCnfg=inj_pulse_start_delay, cache=True)
+        self.update_pbar_with_word_rate(pbar)
+
+    def _scan_adaptive(self, n_injections, VCAL_HIGH, vcal_low_range, charges, callback, coarse_factor, window, reset_bcid, inj_pulse_start_delay, mask_outer_loop=False):
+        ''' Coarse scan of all pixels followed by a fine scan of the mask steps with a pixel threshold close to the charge '''
+        charges = np.array(charges)
+        coarse_ids = np.arange(0, len(vcal_low_range), coarse_factor)
+        fine_ids = np.setdiff1d(np.arange(len(vcal_low_range)), coarse_ids)
+        for scan_param_id, vcal_low in enumerate(vcal_low_range):
             self.store_scan_par_values(scan_param_id=scan_param_id, vcal_high=VCAL_HIGH, vcal_low=vcal_low)
-            with self.readout(scan_param_id=scan_param_id):
-                shift_and_inject(scan=self, n_injections=n_injections, pbar=pbar, scan_param_id=scan_param_id, reset_bcid=reset_bcid, PulseStartCnfg=inj_pulse_start_delay)
-            self.update_pbar_with_word_rate(pbar)
 
+        self.log.info('Coarse scan of all pixels at %d of %d charges', len(coarse_ids), len(charges))
+        if mask_outer_loop:
+            pbar = tqdm(total=get_scan_loop_mask_steps(self), unit=' mask steps', smoothing=0, delay=0.1)
+            self._scan_mask_outer(coarse_ids, vcal_low_range, n_injections, callback, pbar, reset_bcid, inj_pulse_start_delay)
+        else:
+            pbar = tqdm(total=get_scan_loop_mask_steps(self) * len(coarse_ids), unit=' mask steps', smoothing=0, delay=0.1)
+            for scan_param_id in coarse_ids:
+                self._scan_step(scan_param_id, vcal_low_range[scan_param_id], n_injections, callback, pbar, reset_bcid, inj_pulse_start_delay)
+
+        occ_hist = self.data.hist_scurve.get(reset=False)[..., coarse_ids]
+        threshold, noise = oa.get_scurve_maps(occ_hist, charges[coarse_ids], n_injections)
+        self.data.threshold_map, self.data.noise_map = threshold, noise
+        if self.socket:
+            send_maps(self.socket, {'threshold': threshold, 'noise': noise}, scan_par_id=int(coarse_ids[-1]))
+        coarse_step = abs(charges[coarse_ids[1]] - charges[coarse_ids[0]])
+
+        # Fine scan with a common window per mask step: a mask step is only injected at the charges within the
+        # window of any of its pixels. Per pixel windows would leave pixels in almost every mask step.
+        # The masks are the same as for the coarse scan, the command data of all mask steps comes from the cache.
+        step_map = self.chip.masks.get_mask_step_map()
+        sel = np.logical_and(self.data.scurve_sel, np.isfinite(threshold))
+        steps, step_low, step_high = self._get_step_windows(step_map[sel], threshold[sel], noise[sel], coarse_step, window)
+        n_steps = np.unique(step_map[self.data.scurve_sel]).shape[0]  # Mask steps with injections of the full scan
+        n_steps_injected = n_steps * len(coarse_ids)
+        injected = np.zeros(self.data.scurve_sel.shape + (len(charges),), dtype=bool)
+        injected[..., coarse_ids] = self.data.scurve_sel[..., np.newaxis]
+        self.log.info('Fine scan of the mask steps within the threshold windows at %d charges', len(fine_ids))
+        try:
+            for scan_param_id in fine_ids:
+                fine_steps = steps[np.logical_and(step_low <= charges[scan_param_id], charges[scan_param_id] <= step_high)]
+                if fine_steps.shape[0] == 0:
+                    continue
+                n_steps_injected += fine_steps.shape[0]
+                injected[..., scan_param_id] = np.logical_and(self.data.scurve_sel, np.isin(step_map, fine_steps))
+                pbar.total += get_scan_loop_mask_steps(self)
+                pbar.refresh()
+                self._scan_step(scan_param_id, vcal_low_range[scan_param_id], n_injections, callback, pbar, reset_bcid, inj_pulse_start_delay,
+                                mask_steps=set(fine_steps.tolist()))
+        finally:
+            # The analysis fills the S-curves at the charges outside of the window
+            for scan_param_id in range(len(charges)):
+                self.store_injected_pixels(scan_param_id, injected[..., scan_param_id])
         pbar.close()
-        self.log.success('Scan finished')
+        self.log.info('Injected %d of %d mask steps and %d of %d pixel charge combinations of the full scan',
+                      n_steps_injected, len(charges) * n_steps, np.count_nonzero(injected), len(charges) * np.count_nonzero(self.data.scurve_sel))
+        self._update_online_scurve_maps(charges, n_injections, n_steps=len(charges), injected=injected)
+
+    @staticmethod
+    def _get_step_windows(pixel_steps, threshold, noise, coarse_step, window=None):
+        ''' Charge window per mask step from the thresholds of its pixels
+
+            The window reaches from the lowest to the highest threshold of the mask step extended by window, or by
+            one coarse step plus three times the median noise of the mask step if not given. The noise of single
+            pixels from the coarse scan is not reliable.
+            Returns the mask steps, the lower and the upper limits.
+        '''
+        if pixel_steps.shape[0] == 0:
+            return pixel_steps, threshold, threshold
+        order = np.argsort(pixel_steps, kind='stable')
+        steps, first = np.unique(pixel_steps[order], return_index=True)
+        groups = np.split(order, first[1:])
+        step_low = np.array([threshold[g].min() for g in groups])
+        step_high = np.array([threshold[g].max() for g in groups])
+        if window is None:
+            window = coarse_step + 3 * np.array([np.median(noise[g]) for g in groups])
+        return steps, step_low - window, step_high + window
+
+    def analyze_data_online(self, data_tuple):
+        self.data.hist_scurve.add(data_tuple[0], meta_data={'scan_param_id': data_tuple[4], 'timestamp_stop': data_tuple[2]})
+        super(ThresholdScan, self).handle_data(data_tuple)
+
+    def _update_online_scurve_maps(self, charges, n_injections, n_steps, injected=None):
+        ''' Update fit-less threshold and noise maps from the online occupancy and publish them
+
+            injected: numpy array
+                Pixels injected per scan parameter id, the other points of the S-curves are filled (adaptive scan)
+        '''
+        occ_hist = self.data.hist_scurve.get(reset=False)
+        if injected is not None:
+            occ_hist = au.fill_scurves(occ_hist, injected, charges, n_injections)
+        self.store_online_metrics(self.data.hist_scurve, name='scurve_histogramming')
+        self.data.threshold_map, self.data.noise_map = oa.get_scurve_maps(occ_hist, charges, n_injections, n_steps=n_steps)
+        sel = self.data.scurve_sel
+        if np.any(sel):
+            self.log.info('Online S-curve analysis (scan parameter id %d): mean threshold = %1.2f DAC, mean noise = %1.2f DAC',
+                          n_steps - 1, np.mean(self.data.threshold_map[sel]), np.mean(self.data.noise_map[sel]))
+        if self.socket:
+            send_maps(self.socket, {'threshold': self.data.threshold_map, 'noise': self.data.noise_map}, scan_par_id=n_steps - 1)
 
     def _analyze(self):
         with analysis.Analysis(raw_data_file=self.output_filename + '.h5', **self.configuration['bench']['analysis']) as a:
             a.analyze_data()
+            if a.scan_config.get('fit_scurves', False):
+                self._fit_scurves(a, use_cache=a.scan_config.get('use_threshold_cache', True))
+
+    def _fit_scurves(self, a, use_cache=True):
+        ''' Fit the S-curves using the last results of this chip with similar settings as start values '''
+        with tb.open_file(a.analyzed_data_file) as in_file:
+            registers = au.ConfigDict(in_file.root.configuration_in.chip.registers[:])
+            tdac = in_file.root.configuration_in.chip.masks.tdac[:]
+        cache = ThresholdCache(os.path.dirname(self.output_filename), a.chip_settings['chip_sn'])
+        start_values = cache.load(registers, tdac) if use_cache else None
+
+        threshold_map, noise_map, _ = a.fit_scurves(start_values=start_values, fit_window=None if start_values is None else 5)
+
+        # Keep cached values of pixels without fit result (e.g. outside of the scanned area)
+        if start_values is not None:
+            failed = noise_map <= 0
+            threshold_map = np.where(failed, start_values[0], threshold_map)
+            noise_map = np.where(failed, start_values[1], noise_map)
+        cache.store(registers, tdac, threshold_map, noise_map)
 
 
 if __name__ == "__main__":
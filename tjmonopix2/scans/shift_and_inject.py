@@ -11,7 +11,8 @@
 '''
 
 
-def shift_and_inject(scan, n_injections, pbar=None, scan_param_id=0, masks=['injection', 'enable'], pattern='default', cache=False, skip_empty=True, reset_bcid=False, PulseStartCnfg=1):
+def shift_and_inject(scan, n_injections, pbar=None, scan_param_id=0, masks=['injection', 'enable'], pattern=None, cache=False, skip_empty=True, reset_bcid=False, PulseStartCnfg=1,
+                     mask_steps=None):
     ''' Regular mask shift and analog injection function.
 
     Parameters:
@@ -27,9 +28,49 @@ def shift_and_inject(scan, n_injections, pbar=None, scan_param_id=0, masks=['inj
         masks : list
             List of masks ('injection', 'enable', 'hitbus') which should be shifted during scan loop.
         pattern : string
-            Injection pattern ('default', 'hitbus', ...)
+            Mask shift pattern (see SHIFT_PATTERNS in tjmonopix2.system.tjmonopix2). Default is scan.chip.masks.shift_pattern.
         cache : boolean
-            If True use mask caching for speedup. Default is False.
+            If True reuse the command data of previous mask shifts with the same masks for speedup, use it if the masks repeat. Default is False.
+        skip_empty : boolean
+            If True skip empty mask steps for speedup. Default is True.
+        reset_bcid: boolean
+            If True, resets the BCID counter before every injection
+        mask_steps : set
+            Indices of the mask steps to inject (see MaskObject.get_mask_step_map), the masks of the other steps
+            are written without injection. Default is all mask steps.
+    '''
+    for step, (fe, active_pixels) in enumerate(scan.chip.masks.shift(masks=masks, pattern=pattern, cache=cache, skip_empty=skip_empty)):
+        if not fe == 'skipped' and (mask_steps is None or step in mask_steps):
+            scan.chip.inject(PulseStartCnfg=PulseStartCnfg, PulseStopCnfg=1500, repetitions=n_injections, latency=1400, reset_bcid=reset_bcid)
+        if pbar is not None:
+            pbar.update(1)
+
+
+def shift_and_inject_scan_params(scan, n_injections, scan_param_ids, set_scan_param, pbar=None, masks=['injection', 'enable'], pattern=None, cache=False, skip_empty=True, reset_bcid=False, PulseStartCnfg=1):
+    ''' Mask shift with the scan parameter loop inside of every mask step.
+
+    The masks are written only once per mask step instead of once per scan parameter.
+    Has to be called within a running readout, the data is tagged with the scan parameter id
+    using scan.set_scan_param_id().
+
+    Parameters:
+    ----------
+        scan : scan object
+            Scan object
+        n_injections : int
+            Number of injections per loop.
+        scan_param_ids : list
+            Scan parameter ids to loop over in every mask step
+        set_scan_param : function
+            Called with the scan parameter id to set the scan parameter (e.g. write a DAC) before injecting
+        pbar : tqdm progressbar
+            Tqdm progressbar, updated once per mask step
+        masks : list
+            List of masks ('injection', 'enable', 'hitbus') which should be shifted during scan loop.
+        pattern : string
+            Mask shift pattern (see SHIFT_PATTERNS in tjmonopix2.system.tjmonopix2). Default is scan.chip.masks.shift_pattern.
+        cache : boolean
+            If True reuse the command data of previous mask shifts with the same masks for speedup, use it if the masks repeat. Default is False.
         skip_empty : boolean
             If True skip empty mask steps for speedup. Default is True.
         reset_bcid: boolean
@@ -37,12 +78,15 @@ def shift_and_inject(scan, n_injections, pbar=None, scan_param_id=0, masks=['inj
     '''
     for fe, active_pixels in scan.chip.masks.shift(masks=masks, pattern=pattern, cache=cache, skip_empty=skip_empty):
         if not fe == 'skipped':
-            scan.chip.inject(PulseStartCnfg=PulseStartCnfg, PulseStopCnfg=1500, repetitions=n_injections, latency=1400, reset_bcid=reset_bcid)
+            for scan_param_id in scan_param_ids:
+                set_scan_param(scan_param_id)
+                scan.set_scan_param_id(scan_param_id)
+                scan.chip.inject(PulseStartCnfg=PulseStartCnfg, PulseStopCnfg=1500, repetitions=n_injections, latency=1400, reset_bcid=reset_bcid)
         if pbar is not None:
             pbar.update(1)
 
 
-def get_scan_loop_mask_steps(scan, pattern='default'):
+def get_scan_loop_mask_steps(scan, pattern=None):
     ''' Returns total number of mask steps for specific pattern
 
     Parameters:
@@ -50,7 +94,7 @@ def get_scan_loop_mask_steps(scan, pattern='default'):
         scan : scan object
             Scan object
         pattern : string
-            Injection pattern ('default', 'hitbus', ...)
+            Mask shift pattern (see SHIFT_PATTERNS in tjmonopix2.system.tjmonopix2). Default is scan.chip.masks.shift_pattern.
     '''
 
     return scan.chip.masks.get_mask_steps(pattern=pattern)
@@ -33,6 +33,7 @@ scan_configuration = {
     'VCAL_HIGH': 30+27,
 
     'bcid_reset': True,  # BCID reset before injection
+    'online_workers': 2,  # Number of online histogramming processes
     #'load_tdac_from': None,  # Optional h5 file to load the TDAC values from
     # File produced w BCID reset target=21 DAC psub/pwell=-3V cols=0-223 rows=0-511 ITUNE=175 redone disabling bad col 192-223
     #'load_tdac_from': '/home/labb2/tj-monopix2-daq/tjmonopix2/scans/output_data/module_0/chip_0/20221213_152510_local_threshold_tuning_interpreted.h5'
@@ -163,7 +164,7 @@ register_overrides = {
 class TDACTuning(ScanBase):
     scan_id = 'local_threshold_tuning'
 
-    def _configure(self, start_column=0, stop_column=512, start_row=0, stop_row=512, VCAL_LOW=30, VCAL_HIGH=60, load_tdac_from=None, **_):
+    def _configure(self, start_column=0, stop_column=512, start_row=0, stop_row=512, VCAL_LOW=30, VCAL_HIGH=60, load_tdac_from=None, online_workers=1, **_):
         '''
         Parameters
         ----------
@@ -180,6 +181,8 @@ class TDACTuning(ScanBase):
             Injection DAC low value.
         VCAL_HIGH : int
             Injection DAC high value.
+        online_workers : int
+            Number of processes for the online occupancy histogram.
         '''
 
 
@@ -244,15 +247,8 @@ class TDACTuning(ScanBase):
         #for col in [511]:
             dcol = col // 2
             reg_values[dcol//16] &= ~(1 << (dcol % 16))
-        for i, v in enumerate(reg_values):
-            # EN_RO_CONF
-            self.chip._write_register(155+i, v)
-            # EN_BCID_CONF
-            self.chip._write_register(171+i, v)
-            # EN_RO_RST_CONF
-            self.chip._write_register(187+i, v)
-            # EN_FREEZE_CONF
-            self.chip._write_register(203+i, v)
+        # EN_RO_CONF (155-170), EN_BCID_CONF (171-186), EN_RO_RST_CONF (187-202), EN_FREEZE_CONF (203-218)
+        self.chip.write_registers(np.add.outer([155, 171, 187, 203], np.arange(16)), np.tile(reg_values, 4))
 
         self.chip.masks.apply_disable_mask()
         self.chip.masks.update(force=True)
@@ -265,7 +261,7 @@ class TDACTuning(ScanBase):
 
         self.chip.registers["SEL_PULSE_EXT_CONF"].write(0)
 
-        self.data.hist_occ = oa.OccupancyHistogramming()
+        self.data.hist_occ = oa.OccupancyHistogramming(n_workers=online_workers)
 
     def _scan(self, start_column=0, stop_column=512, start_row=0, stop_row=512, n_injections=100, bcid_reset=True, **_):
         '''
@@ -314,6 +310,7 @@ class TDACTuning(ScanBase):
             self.update_pbar_with_word_rate(pbar)
             # Get hit occupancy using online analysis
             occupancy = self.data.hist_occ.get()
+            self.store_online_metrics(self.data.hist_occ)
             # print("Occupancy =", occupancy[start_column:stop_column, start_row:stop_row])
 
             # Calculate best (closest to target) TDAC setting and update TDAC setting according to hit occupancy
@@ -346,12 +343,12 @@ class TDACTuning(ScanBase):
 
     def analyze_data_online(self, data_tuple):
         raw_data = data_tuple[0]
-        self.data.hist_occ.add(raw_data)
+        self.data.hist_occ.add(raw_data, meta_data={'timestamp_stop': data_tuple[2]})
         super(TDACTuning, self).handle_data(data_tuple)
 
     def analyze_data_online_no_save(self, data_tuple):
         raw_data = data_tuple[0]
-        self.data.hist_occ.add(raw_data)
+        self.data.hist_occ.add(raw_data, meta_data={'timestamp_stop': data_tuple[2]})
 
     def _analyze(self):
         pass
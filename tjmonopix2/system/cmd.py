@@ -8,7 +8,49 @@
 from basil.HL.RegisterHardwareLayer import RegisterHardwareLayer
 
 
-class cmd(RegisterHardwareLayer):
+class CommandMemoryShadow(object):
+    ''' Shadow of the command memory and size of a command encoder driver
+
+        The shadow belongs to the driver, so that it is shared by all chips that use the driver.
+        It follows every set_data() and set_size() call and is unknown again after a reset.
+        The command encoder always sends the memory from address 0, commands cannot be placed
+        at another address.
+    '''
+
+    def _reset_shadow(self):
+        self._shadow = None  # Memory content, None if unknown
+        self._shadow_size = None
+
+    def _update_shadow(self, data, addr):
+        if self._shadow is None or addr > len(self._shadow):
+            self._shadow = list(data) if addr == 0 else None
+        else:
+            self._shadow[addr:addr + len(data)] = list(data)
+
+    def upload(self, data):
+        ''' Write data to the command memory and set the size, only the range that differs from the memory content is transferred '''
+        if not isinstance(data, list):
+            data = list(data)
+        memory = self._shadow
+        n = len(data)
+        if memory is None:
+            start, stop = 0, n
+        elif memory[:n] == data:
+            start = stop = n
+        else:
+            start = 0
+            while start < len(memory) and memory[start] == data[start]:
+                start += 1
+            stop = n
+            while stop <= len(memory) and memory[stop - 1] == data[stop - 1]:
+                stop -= 1
+        if stop > start:
+            self.set_data(data[start:stop], addr=start)
+        if n != self._shadow_size:
+            self.set_size(n)
+
+
+class cmd(RegisterHardwareLayer, CommandMemoryShadow):
     '''Implement master RD53 configuration and timing interface driver.
     '''
 
@@ -77,6 +119,7 @@ class cmd(RegisterHardwareLayer):
     def __init__(self, intf, conf):
         super(cmd, self).__init__(intf, conf)
         self._mem_offset = 16   # In bytes
+        self._reset_shadow()
 
     def init(self):
         super(cmd, self).init()
@@ -90,6 +133,7 @@ class cmd(RegisterHardwareLayer):
 
     def reset(self):
         self.RESET = 0
+        self._reset_shadow()
 
     def start(self):
         self.START = 0
@@ -97,6 +141,7 @@ class cmd(RegisterHardwareLayer):
     def set_size(self, value):
         ''' CMD buffer size '''
         self.SIZE = value
+        self._shadow_size = value
 
     def get_size(self):
         ''' CMD buffer size '''
@@ -156,6 +201,7 @@ class cmd(RegisterHardwareLayer):
         if self._mem_size < len(data):
             raise ValueError('Size of data (%d bytes) is too big for memory (%d bytes)' % (len(data), self._mem_size))
         self._intf.write(self._conf['base_addr'] + self._mem_offset + addr, data)
+        self._update_shadow(data, addr)
 
     def get_data(self, size=None, addr=0):
         if size and self._mem_size < size:
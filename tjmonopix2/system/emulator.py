@@ -0,0 +1,412 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Software stand-in for the BDAQ53 / MIO3 readout system.
+
+    The FIFO driver serves raw data words from a raw data h5 file or synthetic data at a configurable
+    rate and burst pattern. The command driver answers register reads from the values of the
+    register writes and optionally injections with hits of the injected pixels (InjectionResponse),
+    all other drivers accept every call and do nothing.
+    This allows to run complete scans and throughput benchmarks without hardware.
+
+    Enable with 'readout_system: emulator' and the emulator section in the testbench.yaml.
+'''
+
+import os
+import threading
+import time
+
+import numpy as np
+import tables as tb
+import yaml
+
+from tjmonopix2.analysis import raw_data_generator as rdg
+from tjmonopix2.analysis.analysis_utils import scurve
+from tjmonopix2.analysis.raw_data_generator import iter_raw_data
+from tjmonopix2.system import logger
+from tjmonopix2.system.cmd import CommandMemoryShadow, cmd
+
+# 8 bit command symbol -> 5 bit value
+_CMD_SYMBOL_VALUES = np.zeros(256, dtype=np.uint8)
+_CMD_SYMBOL_VALUES[list(cmd.cmd_data_map.values())] = list(cmd.cmd_data_map.keys())
+
+
+def read_raw_data_file(filename, chunk_size=1000000, loop=False):
+    ''' Yield the raw data of a raw data h5 file in chunks of chunk_size words '''
+    with tb.open_file(filename, 'r') as in_file:
+        raw_data = in_file.root.raw_data
+        if raw_data.nrows == 0:
+            raise ValueError('No raw data in %s' % filename)
+        while True:
+            for start in range(0, raw_data.nrows, chunk_size):
+                yield raw_data[start:start + chunk_size]
+            if not loop:
+                return
+
+
+class NoOpDriver(object):
+    ''' Driver that accepts every register access and method call '''
+
+    def __init__(self, name):
+        self.name = name
+        self._registers = {}
+
+    def __getitem__(self, name):
+        return self._registers.get(name, 0)
+
+    def __setitem__(self, name, value):
+        self._registers[name] = value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            return 0
+        return method
+
+
+class InjectionResponse(object):
+    ''' Hits of the pixels injected by the emulated command encoder
+
+        The injected pixels are given by the injection column and row enable registers (EN_INJ_COL, EN_INJ_ROW),
+        the charge by VH - VL. Every pixel sees round(n_injections * S-curve(charge)) hits, so that
+        the occupancy does not depend on the order of the injections.
+
+        threshold, threshold_spread, noise: float
+            Mean and spread of the pixel thresholds and the noise [DAC]
+        tot: int
+            ToT of all hits
+        delay: float
+            Time until the hits of an injection are in the FIFO [s]
+    '''
+
+    def __init__(self, threshold=50., threshold_spread=0., noise=2., tot=10, delay=0.01, seed=None):
+        rng = np.random.default_rng(seed)
+        self.threshold = threshold + threshold_spread * rng.standard_normal((512, 512))
+        self.noise = noise
+        self.tot = tot
+        self.delay = delay
+
+    def get_data(self, registers, n_injections):
+        ''' Raw data words of n_injections injections with the given register values '''
+        charge = float(registers[8] >> 8) - float(registers[8] & 0xff)  # VH - VL
+        cols = np.unpackbits(registers[82:114].astype('<u2').view(np.uint8), bitorder='little').astype(bool)
+        rows = np.unpackbits(registers[114:146].astype('<u2').view(np.uint8), bitorder='little').astype(bool)
+        col, row = np.nonzero(np.outer(cols, rows))
+        n_hits = np.round(scurve(charge, n_injections, self.threshold[col, row], self.noise)).astype(np.int64)
+        hits = np.zeros(n_hits.sum(), dtype=rdg.hit_dtype)
+        hits['event'] = np.arange(hits.shape[0])
+        hits['col'], hits['row'] = np.repeat(col, n_hits), np.repeat(row, n_hits)
+        hits['te'] = self.tot
+        return rdg.encode_events(hits)
+
+
+class EmulatedCmd(NoOpDriver, CommandMemoryShadow):
+    ''' Command encoder that is always ready
+
+        Register writes are kept in a shadow of the chip registers and register reads are
+        answered with register data words in the FIFO. Injections are answered with hits if an
+        injection response (InjectionResponse) is given. All other commands are ignored.
+    '''
+
+    def __init__(self, name='cmd', fifo=None, injection=None):
+        super(EmulatedCmd, self).__init__(name)
+        self.fifo = fifo
+        self.injection = injection
+        self.registers = np.zeros(256, dtype=np.uint16)  # register values by address
+        self.n_commands = 0
+        self.n_bytes = 0
+        self.n_uploaded_bytes = 0
+        self._memory = np.zeros(self.get_cmd_size(), dtype=np.uint8)
+        self._size = 0
+        self._repetitions = 1
+        self._reset_shadow()
+
+    def reset(self):
+        self._reset_shadow()
+
+    def set_data(self, data, addr=0):
+        self._update_shadow(data, addr)
+        data = np.asarray(data, dtype=np.uint8)
+        if addr + data.shape[0] > self._memory.shape[0]:
+            self._memory = np.concatenate([self._memory, np.zeros(addr + data.shape[0] - self._memory.shape[0], dtype=np.uint8)])
+        self._memory[addr:addr + data.shape[0]] = data
+        self.n_uploaded_bytes += data.shape[0]
+
+    def set_size(self, value):
+        self._size = value
+        self._shadow_size = value
+
+    def set_repetitions(self, value):
+        self._repetitions = value
+
+    def start(self):
+        data = self._memory[:self._size]
+        self.n_commands += 1
+        self.n_bytes += data.shape[0] * self._repetitions
+        reads = np.flatnonzero(data == cmd.CMD_RDREG)
+        writes = np.flatnonzero(data == cmd.CMD_REGISTER)
+        writes = writes[writes + 8 <= data.shape[0]]
+        if reads.shape[0] == 0:  # Only the last write to an address matters
+            addresses, values = self._decode_writes(data, writes)
+            last = addresses.shape[0] - 1 - np.unique(addresses[::-1], return_index=True)[1]
+            self.registers[addresses[last]] = values[last]
+            n_injections = np.count_nonzero(data == cmd.CMD_CAL) * self._repetitions
+            if self.injection is not None and self.fifo is not None and n_injections:
+                self.fifo.put(self.injection.get_data(self.registers, n_injections), delay=self.injection.delay)
+            return
+        for _ in range(self._repetitions):
+            for index in np.sort(np.concatenate([reads, writes])):
+                if data[index] == cmd.CMD_REGISTER:
+                    addresses, values = self._decode_writes(data, np.array([index]))
+                    self.registers[addresses] = values
+                elif index + 4 <= data.shape[0]:
+                    symbols = _CMD_SYMBOL_VALUES[data[index + 2:index + 4]]
+                    self._answer_read(((symbols[0] << 5) | symbols[1]) & 0xff)
+
+    @staticmethod
+    def _decode_writes(data, writes):
+        symbols = _CMD_SYMBOL_VALUES[data[writes[:, np.newaxis] + np.arange(2, 8)]].astype(np.uint32)
+        addresses = ((symbols[:, 0] << 5) | symbols[:, 1]) & 0xff
+        values = (symbols[:, 2] << 11) | (symbols[:, 3] << 6) | (symbols[:, 4] << 1) | (symbols[:, 5] >> 4)
+        return addresses, values.astype(np.uint16)
+
+    def _answer_read(self, address):
+        address, value = int(address), int(self.registers[address])
+        symbols = [0x1fc, address, value >> 8, value & 0xff, 0x15c, 0x13c]
+        words = [0x40000000 | (symbols[i] << 18) | (symbols[i + 1] << 9) | symbols[i + 2] for i in (0, 3)]
+        if self.fifo is not None:
+            self.fifo.put(np.array(words, dtype=np.uint32))
+
+    def is_done(self):
+        return True
+
+    def get_cmd_size(self):
+        return 4096
+
+
+class EmulatedRx(NoOpDriver):
+    ''' Receiver with the registers of tjmono2_rx, always ready and without errors '''
+
+    def __init__(self, name='rx0'):
+        super(EmulatedRx, self).__init__(name)
+        self._registers.update({'READY': 1, 'ENABLE': 0, 'DECODER_ERROR_COUNTER': 0, 'LOST_DATA_COUNTER': 0})
+
+    def reset(self):
+        self['DECODER_ERROR_COUNTER'] = 0
+        self['LOST_DATA_COUNTER'] = 0
+
+    def set_en(self, value):
+        self['ENABLE'] = int(value)
+
+    def is_done(self):
+        return True
+
+    @property
+    def is_ready(self):
+        return True
+
+    def get_decoder_error_counter(self):
+        return self['DECODER_ERROR_COUNTER']
+
+    def get_lost_data_counter(self):
+        return self['LOST_DATA_COUNTER']
+
+
+class EmulatedFifo(object):
+    ''' FIFO driver that serves raw data words from a source
+
+        source: iterable
+            Yields numpy arrays of raw data words, e.g. read_raw_data_file()
+        rate: float
+            Data rate [words/s]. None: one chunk of the source per read (as fast as possible)
+        burst_period, duty_cycle: float
+            Data is only produced during the first duty_cycle fraction of every burst period [s]
+        depth: int
+            FIFO depth in words, newer words are lost if the FIFO is full
+        rx_channels: dict
+            Data is only produced if one of the receivers is enabled (None: always)
+    '''
+
+    def __init__(self, source, rate=None, burst_period=1., duty_cycle=1., depth=2 ** 24, rx_channels=None):
+        self.source = iter(source)
+        self.rate = rate
+        self.burst_period = burst_period
+        self.duty_cycle = duty_cycle
+        self.depth = depth
+        self.rx_channels = rx_channels
+        self.lock = threading.Lock()
+        self.exhausted = False
+        self._pending = np.zeros(0, dtype=np.uint32)  # words from the source not yet in the FIFO
+        self._delayed = []  # (arrival time, words) added by put() with a delay
+        self._fifo = []  # words in the FIFO
+        self._fifo_size = 0
+        self._credit = 0.  # words that can be moved into the FIFO
+        self._start = time.time()
+        self._last_fill = self._start
+        self.n_words = 0  # served words
+        self.n_lost_words = 0
+
+    def _on_time(self, t):
+        ''' Time with data production since start '''
+        n_periods, rest = divmod(t - self._start, self.burst_period)
+        return n_periods * self.duty_cycle * self.burst_period + min(rest, self.duty_cycle * self.burst_period)
+
+    def _is_enabled(self):
+        return self.rx_channels is None or any(rx['ENABLE'] for rx in self.rx_channels.values())
+
+    def _next_chunk(self):
+        if self._pending.shape[0] == 0 and not self.exhausted:
+            try:
+                self._pending = np.asarray(next(self.source), dtype=np.uint32)
+            except StopIteration:
+                self.exhausted = True
+        return self._pending
+
+    def _push(self, n_words):
+        data = self._next_chunk()[:n_words]
+        self._pending = self._pending[data.shape[0]:]
+        n_accepted = min(data.shape[0], self.depth - self._fifo_size)
+        if n_accepted:
+            self._fifo.append(data[:n_accepted])
+            self._fifo_size += n_accepted
+        self.n_lost_words += data.shape[0] - n_accepted
+        if self.rx_channels and n_accepted < data.shape[0]:
+            for rx in self.rx_channels.values():
+                rx['LOST_DATA_COUNTER'] = min(255, rx['LOST_DATA_COUNTER'] + 1)
+        return data.shape[0]
+
+    def _fill(self):
+        ''' Move words from the source into the FIFO according to the elapsed time '''
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            data = self._delayed.pop(0)[1]
+            self._fifo.append(data)
+            self._fifo_size += data.shape[0]
+        enabled = self._is_enabled()
+        if self.rate is None:
+            if enabled and not self._fifo:
+                self._push(self._next_chunk().shape[0])
+        elif enabled:
+            self._credit += self.rate * (self._on_time(now) - self._on_time(self._last_fill))
+            while self._credit >= 1 and not self.exhausted:
+                n_words = self._push(int(self._credit))
+                self._credit -= n_words
+                if n_words == 0:
+                    break
+            self._credit = min(self._credit, self.rate * self.burst_period)  # No catch up after exhausted source
+        self._last_fill = now
+
+    def __getitem__(self, name):
+        if name == 'RESET':
+            self.reset()
+        elif name == 'FIFO_SIZE':
+            return self.get_FIFO_SIZE()
+        return 0
+
+    def __setitem__(self, name, value):
+        if name == 'RESET':
+            self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._fifo, self._fifo_size = [], 0
+            self._delayed = []
+
+    def put(self, data, delay=0.):
+        ''' Add words to the FIFO directly (e.g. register data), after delay seconds if given '''
+        with self.lock:
+            if delay > 0 or self._delayed:  # Keep the order of the words
+                self._delayed.append((max(time.time() + delay, self._delayed[-1][0] if self._delayed else 0.), data))
+                return
+            self._fifo.append(data)
+            self._fifo_size += data.shape[0]
+
+    def get_FIFO_SIZE(self):
+        ''' FIFO size in bytes '''
+        with self.lock:
+            self._fill()
+            return self._fifo_size * 4
+
+    def get_data(self):
+        with self.lock:
+            self._fill()
+            data = np.concatenate(self._fifo) if self._fifo else np.zeros(0, dtype=np.uint32)
+            self._fifo, self._fifo_size = [], 0
+            self.n_words += data.shape[0]
+            return data
+
+
+class DAQEmulator(object):
+    ''' Readout system with emulated drivers instead of hardware, see module doc
+
+        The settings are taken from the emulator section of the test bench configuration:
+        raw_data_file (replayed raw data, looped if loop is True) or synthetic (kwargs of raw_data_generator.iter_raw_data),
+        rate, burst_period, duty_cycle, fifo_depth and injection (kwargs of InjectionResponse, hits of injected pixels).
+        Alternatively a source of raw data arrays (e.g. a generator) can be given.
+    '''
+
+    def __init__(self, conf=None, bench_config=None, source=None):
+        self.log = logger.setup_main_logger()
+        self.proj_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.board_version = 'EMULATOR'
+        self.fw_version = '0.0'
+
+        if bench_config is None:
+            bench_config = os.path.join(self.proj_dir, 'testbench.yaml')
+        if isinstance(bench_config, str):
+            with open(bench_config) as f:
+                bench_config = yaml.full_load(f)
+        self.configuration = bench_config
+        settings = self.configuration.get('emulator') or {}
+
+        if source is None:
+            if settings.get('raw_data_file'):
+                source = read_raw_data_file(settings['raw_data_file'], loop=settings.get('loop', False))
+            elif settings.get('synthetic') is not None:
+                source = iter_raw_data(**settings['synthetic'])
+            elif settings.get('injection') is not None:  # Only hits of injections
+                source = []
+            else:
+                raise ValueError('The emulator needs a raw data source, set emulator: raw_data_file or synthetic in the test bench configuration')
+
+        self.receivers = ['rx0']
+        self.rx_channels = {'rx0': EmulatedRx('rx0')}
+        self.tlu_module_enabled = False
+        fifo = EmulatedFifo(source, rate=settings.get('rate'), burst_period=settings.get('burst_period', 1.),
+                            duty_cycle=settings.get('duty_cycle', 1.), depth=settings.get('fifo_depth', 2 ** 24), rx_channels=self.rx_channels)
+        injection = InjectionResponse(**settings['injection']) if settings.get('injection') is not None else None
+        self._drivers = {'FIFO': fifo, 'cmd': EmulatedCmd('cmd', fifo=fifo, injection=injection)}
+
+    def __getitem__(self, name):
+        if name not in self._drivers:
+            self._drivers[name] = NoOpDriver(name)
+        return self._drivers[name]
+
+    def init(self, **kwargs):
+        self.log.success('Found board %s running firmware version %s' % (self.board_version, self.fw_version))
+
+    def close(self):
+        pass
+
+    def set_cmd_clk(self, frequency=160.0, force=False):
+        pass
+
+    def get_chips_cfgs(self):
+        module_cfgs = {k: v for k, v in self.configuration['modules'].items() if 'identifier' in v.keys()}
+        return [v for mod_cfg in module_cfgs.values() for v in mod_cfg.values() if isinstance(v, dict) and 'chip_sn' in v]
+
+    def enable_tlu_module(self):
+        self.tlu_module_enabled = True
+
+    def disable_tlu_module(self):
+        self.tlu_module_enabled = False
+
+    def reset_fifo(self):
+        self['FIFO'].reset()
@@ -5,17 +5,23 @@
 # ------------------------------------------------------------
 #
 
+import os
 import sys
 import datetime
+import tempfile
 from time import sleep, time, mktime
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Condition
 from collections import deque
 from queue import Queue, Empty
 
+import numpy as np
+
 from tjmonopix2.system import logger
 
 
-data_iterable = ("data", "timestamp_start", "timestamp_stop", "error")
+data_iterable = ("data", "timestamp_start", "timestamp_stop", "error", "scan_param_id", "readout_interval")
+
+SETTLE_TIME = 0.1  # Time for the last data of a scan step to arrive in the FIFO [s]
 
 
 class FifoError(Exception):
@@ -38,8 +44,162 @@ class StopTimeout(Exception):
     pass
 
 
+class SpilledData(object):
+    ''' Raw data of a readout that was moved to a temporary file by ReadoutQueue '''
+
+    def __init__(self, data, directory=None):
+        fd, self.filename = tempfile.mkstemp(prefix='tjmonopix2_readout_', suffix='.dat', dir=directory)
+        os.close(fd)
+        self.dtype, self.shape, self.nbytes = data.dtype, data.shape, data.nbytes
+        spilled = np.memmap(self.filename, dtype=self.dtype, mode='w+', shape=self.shape)
+        spilled[:] = data
+        spilled.flush()
+        del spilled
+
+    def load(self):
+        ''' Read the data back into memory and delete the file '''
+        data = np.fromfile(self.filename, dtype=self.dtype).reshape(self.shape)
+        os.remove(self.filename)
+        return data
+
+
+class ReadoutQueue(object):
+    '''
+        FIFO queue to hand over the readouts from the readout thread to the worker thread.
+        The waiting worker is woken up as soon as a readout is added.
+
+        The queue is limited to maxsize readouts and max_bytes bytes of raw data (0: no limit).
+        If a limit is reached, the policy decides:
+            block: put() waits until the consumer took readouts
+            spill: the raw data is moved to a temporary file (spill_dir) until it is taken, put() waits only at maxsize
+            drop: the readout is dropped and counted
+
+        Like queue.Queue the consumer calls task_done() for every item it handled, join() waits for all of them.
+    '''
+
+    policies = ('block', 'spill', 'drop')
+
+    def __init__(self, maxsize=0, max_bytes=0, policy='block', spill_dir=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown readout queue policy %s, use one of %s' % (policy, ', '.join(self.policies)))
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.n_bytes = 0  # raw data bytes in memory
+        self.n_spilled_bytes = 0  # raw data bytes in temporary files
+        self.spilled_readouts = 0
+        self.dropped_readouts = 0
+        self.dropped_words = 0
+        self._unfinished = 0  # items put and not yet marked as done
+        self._items = deque()
+        self._condition = Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def _get_n_bytes(item):
+        if item is None or isinstance(item[0], SpilledData):
+            return 0
+        return item[0].nbytes
+
+    def _is_full(self, n_bytes):
+        if self.maxsize and len(self._items) >= self.maxsize:
+            return True
+        # A single readout larger than max_bytes is accepted into an empty queue, spilled readouts need no memory
+        return bool(self.max_bytes and n_bytes and self._items and self.n_bytes + n_bytes > self.max_bytes)
+
+    def put(self, item):
+        ''' Add a readout tuple (raw data first) or None. Returns False if the readout was dropped. '''
+        n_bytes = self._get_n_bytes(item)
+        with self._condition:
+            full = item is not None and self._is_full(n_bytes)
+            if full and self.policy == 'drop':
+                self.dropped_readouts += 1
+                self.dropped_words += item[0].shape[0]
+                return False
+        if full and self.policy == 'spill' and n_bytes > 0:  # the readout thread is the only producer
+            item = (SpilledData(item[0], self.spill_dir), ) + tuple(item[1:])
+            n_bytes = 0
+            with self._condition:
+                self.spilled_readouts += 1
+                self.n_spilled_bytes += item[0].nbytes
+        with self._condition:
+            while self._is_full(n_bytes):
+                self._condition.wait()
+            self._items.append(item)
+            self.n_bytes += n_bytes
+            self._unfinished += 1
+            self._condition.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        '''
+            Remove and return the oldest item, wait up to timeout seconds (forever if None) for an item.
+            Raises IndexError on timeout.
+        '''
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items, timeout):
+                raise IndexError('Readout queue is empty')
+            item = self._items.popleft()
+            self.n_bytes -= self._get_n_bytes(item)
+            if item is not None and isinstance(item[0], SpilledData):
+                self.n_spilled_bytes -= item[0].nbytes
+            self._condition.notify_all()
+        if item is not None and isinstance(item[0], SpilledData):
+            item = (item[0].load(), ) + tuple(item[1:])
+        return item
+
+    def task_done(self):
+        ''' Mark an item returned by get() as handled '''
+        with self._condition:
+            self._unfinished -= 1
+            self._condition.notify_all()
+
+    def join(self, timeout=None):
+        ''' Wait until all items are handled, returns False on timeout '''
+        with self._condition:
+            return self._condition.wait_for(lambda: self._unfinished <= 0, timeout)
+
+    def clear(self):
+        with self._condition:
+            for item in self._items:
+                if item is not None and isinstance(item[0], SpilledData):
+                    os.remove(item[0].filename)
+            self._unfinished -= len(self._items)
+            self._items.clear()
+            self.n_bytes = 0
+            self.n_spilled_bytes = 0
+            self._condition.notify_all()
+
+    def get_status(self):
+        return {'readouts': len(self._items),
+                'bytes': self.n_bytes,
+                'spilled_bytes': self.n_spilled_bytes,
+                'spilled_readouts': self.spilled_readouts,
+                'dropped_readouts': self.dropped_readouts,
+                'dropped_words': self.dropped_words}
+
+
 class FifoReadout(object):
-    def __init__(self, daq):
+    '''
+        Threaded FIFO readout
+
+        The FIFO is read every readout_interval seconds. With adaptive_interval the interval is adapted
+        to the data rate, so that about target_words are in the FIFO at every read:
+        it is shortened down to min_interval (0: back-to-back reads) if the FIFO fills up and
+        lengthened up to max_interval if there is little data.
+        The readouts are handed over to the callback in the worker thread with a ReadoutQueue limited to max_queue_size readouts
+        and max_queue_bytes bytes (0: unlimited) with the queue_policy block, spill or drop (see ReadoutQueue).
+        The software buffer (fill_buffer) has the same byte limit, it drops readouts instead of blocking.
+        The buffered readouts are available as deque (data) or as ReadoutQueue (buffer).
+        With continuous the readout is meant to run for a whole scan: the scan steps are separated
+        with set_scan_param_id() and drain() instead of stop() and start() (see ScanBase.readout).
+    '''
+
+    def __init__(self, daq, readout_interval=0.05, adaptive_interval=False, min_interval=0.0, max_interval=0.5, target_words=100000,
+                 max_queue_size=0, max_queue_bytes=0, queue_policy='block', spill_dir=None, continuous=False):
         self.log = logger.setup_derived_logger('FIFO Readout')
 
         self.daq = daq
@@ -49,11 +209,19 @@ class FifoReadout(object):
         self.worker_thread = None
         self.watchdog_thread = None
         self.fill_buffer = False
-        self.readout_interval = 0.05
+        self.readout_interval = readout_interval  # nominal interval, also used by worker and watchdog
+        self.adaptive_interval = adaptive_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_words = target_words
+        self.continuous = continuous
+        self.current_interval = readout_interval  # interval used by the readout thread
+        self._word_rate = 0.  # smoothed words per second for the adaptive interval
         self._moving_average_time_period = 10.0
-        self._data_deque = deque()
-        self._data_buffer = deque()
-        self._words_per_read = deque(maxlen=int(self._moving_average_time_period / self.readout_interval))
+        self._data_queue = ReadoutQueue(maxsize=max_queue_size, max_bytes=max_queue_bytes, policy=queue_policy, spill_dir=spill_dir)
+        self._data_buffer = ReadoutQueue(max_bytes=max_queue_bytes, policy='drop' if queue_policy == 'block' else queue_policy, spill_dir=spill_dir)
+        self._data_deque = deque()  # readouts taken from the software buffer by the data property
+        self._words_per_read = deque()  # (time, number of words) of the reads within the moving average time period
         self._result = Queue(maxsize=1)
         self._calculate = Event()
         self.stop_readout = Event()
@@ -61,6 +229,8 @@ class FifoReadout(object):
         self.timestamp = None
         self.update_timestamp()
         self._is_running = False
+        self._readout_lock = Lock()
+        self.scan_param_id = 0
         self.reset_rx()
         self.reset_sram_fifo()
         self._record_count = 0
@@ -78,6 +248,21 @@ class FifoReadout(object):
 
     @property
     def data(self):
+        ''' Software data buffer as deque, the buffered readouts are moved from the buffer queue to the deque '''
+        if self.fill_buffer:
+            while True:
+                try:
+                    self._data_deque.append(self._data_buffer.get(timeout=0))
+                except IndexError:
+                    break
+                self._data_buffer.task_done()
+            return self._data_deque
+        else:
+            self.log.warning('Data requested but software data buffer not active')
+
+    @property
+    def buffer(self):
+        ''' Software data buffer as ReadoutQueue (byte limit and status) '''
         if self.fill_buffer:
             return self._data_buffer
         else:
@@ -88,18 +273,19 @@ class FifoReadout(object):
             self._result.get()
         self._calculate.set()
         try:
-            result = self._result.get(timeout=2 * self.readout_interval)
+            result = self._result.get(timeout=2 * max(self.readout_interval, self.current_interval))
         except Empty:
             self._calculate.clear()
             return None
         return result / float(self._moving_average_time_period)
 
-    def start(self, callback=None, errback=None, reset_rx=False, reset_sram_fifo=False, clear_buffer=False, fill_buffer=False, no_data_timeout=None):
+    def start(self, callback=None, errback=None, reset_rx=False, reset_sram_fifo=False, clear_buffer=False, fill_buffer=False, no_data_timeout=None, scan_param_id=0):
         if self._is_running:
             raise RuntimeError('Readout already running: use stop() before start()')
 
         self._is_running = True
         self.log.debug('Starting FIFO readout...')
+        self.scan_param_id = scan_param_id
         self.callback = callback
         self.errback = errback
         self.fill_buffer = fill_buffer
@@ -113,9 +299,12 @@ class FifoReadout(object):
             if fifo_size != 0:
                 self.log.warning('FIFO not empty when starting FIFO readout: size = %i', fifo_size)
         self._words_per_read.clear()
+        self.current_interval = self.readout_interval
+        self._word_rate = 0.
         if clear_buffer:
-            self._data_deque.clear()
+            self._data_queue.clear()
             self._data_buffer.clear()
+            self._data_deque.clear()
         self.stop_readout.clear()
         self.force_stop.clear()
         if self.errback:
@@ -135,7 +324,7 @@ class FifoReadout(object):
             raise RuntimeError('Readout not running: use start() before stop()')
         self._is_running = False
         self.stop_readout.set()
-        sleep(0.1)
+        sleep(SETTLE_TIME)
         try:
             self.readout_thread.join(timeout=timeout)
             if self.readout_thread.is_alive():
@@ -159,41 +348,97 @@ class FifoReadout(object):
         self.errback = None
         self.log.debug('Stopped FIFO readout')
 
+    def set_scan_param_id(self, scan_param_id, settle_time=SETTLE_TIME):
+        '''
+            Change the scan parameter id the read data is tagged with while the readout is running.
+            The FIFO is read out settle_time seconds after the call (last data of the previous id on its way to the FIFO),
+            so that all data recorded so far is tagged with the previous id.
+            An empty readout with the new id marks the FIFO word index of the change in the meta data.
+        '''
+        if self._is_running and scan_param_id != self.scan_param_id:
+            sleep(settle_time)
+        with self._readout_lock:
+            if self._is_running and scan_param_id != self.scan_param_id:
+                data = self.read_data()
+                self._record_count += len(data)
+                if data.shape[0]:
+                    self._append_data(data)
+                self.scan_param_id = scan_param_id
+                self._append_data(np.zeros(0, dtype=np.uint32))
+            self.scan_param_id = scan_param_id
+
+    def drain(self, timeout=10.0, settle_time=SETTLE_TIME):
+        '''
+            Barrier within a running readout: read the words that are in the FIFO settle_time seconds after the call
+            and wait until the callback handled all readouts. Data that arrives later is read by the next reads,
+            so that the barrier is bounded also with continuous data. Returns False on timeout.
+        '''
+        if not self._is_running:
+            return True
+        deadline = time() + timeout
+        sleep(settle_time)  # last data of the step on its way to the FIFO
+        with self._readout_lock:
+            n_words = self.daq['FIFO']['FIFO_SIZE'] // 4
+            while True:
+                data = self.read_data()
+                self._record_count += len(data)
+                if data.shape[0]:
+                    self._append_data(data)
+                n_words -= data.shape[0]
+                if n_words <= 0:
+                    break
+                if time() > deadline:
+                    return False
+                sleep(min(settle_time, 0.001))
+        if self.callback and self.worker_thread.is_alive():
+            return self._data_queue.join(timeout=max(deadline - time(), 0.))
+        return True
+
     def print_readout_status(self):
         discard_count = self.get_rx_fifo_discard_count()
+        queue_status = self._data_queue.get_status()
 
         if any(discard_count):
-            try:
-                queue_size = len(self._data_deque)
-            except NotImplementedError as e:
-                self.log.warning(e)
-                queue_size = -1
             self.log.warning('RX errors detected')
             self.log.warning('Recived words:               %d', self._record_count)
-            self.log.warning('Data queue size:             %d', queue_size)
+            self.log.warning('Data queue size:             %d readouts, %d bytes (%d bytes spilled)',
+                             queue_status['readouts'], queue_status['bytes'], queue_status['spilled_bytes'])
             self.log.warning('FIFO size:                   %d', self.daq['FIFO']['FIFO_SIZE'])
             self.log.warning('Channel:                     %s', " | ".join([channel.name.rjust(3) for _, channel in sorted(self.daq.rx_channels.items())]))
             # self.log.warning('RX sync:                     %s', " | ".join(["YES".rjust(3) if status is True else "NO".rjust(3) for status in sync_status]))
             self.log.warning('RX FIFO discard counter:     %s', " | ".join([repr(count).rjust(3) for count in discard_count]))
             # self.log.warning('RX soft errors:              %s', " | ".join([repr(count).rjust(3) for count in soft_error_count]))
             # self.log.warning('RX hard errors:              %s', " | ".join([repr(count).rjust(3) for count in hard_error_count]))
+        else:
+            self.log.debug('Data queue size: %d readouts, %d bytes (%d bytes spilled)',
+                           queue_status['readouts'], queue_status['bytes'], queue_status['spilled_bytes'])
+        if queue_status['spilled_readouts']:
+            self.log.warning('%d readouts were spilled to disk, data handling too slow', queue_status['spilled_readouts'])
+        for name, status in [('Data queue', queue_status), ('Data buffer', self._data_buffer.get_status())]:
+            if status['dropped_readouts']:
+                self.log.error('%s full: %d readouts (%d words) dropped', name, status['dropped_readouts'], status['dropped_words'])
 
         return discard_count
 
     def readout(self, no_data_timeout=None):
         '''
-            Readout thread continuously reading FIFO. Uses read_data() and appends data to self._data_deque (collection.deque).
+            Readout thread continuously reading FIFO. Uses read_data() and appends data to self._data_queue (ReadoutQueue).
         '''
         self.log.debug('Starting %s', self.readout_thread.name)
         curr_time = self.get_float_time()
         time_wait = 0.0
-        while not self.force_stop.wait(time_wait if time_wait >= 0.0 else 0.0):
+        time_read = time()
+        while not self._wait_for_next_read(time_wait):
             try:
-                time_read = time()
+                time_last_read, time_read = time_read, time()
                 if no_data_timeout and curr_time + no_data_timeout < self.get_float_time():
                     raise NoDataTimeout('Received no data for %0.1f second(s)' % no_data_timeout)
-                data = self.read_data()
-                self._record_count += len(data)
+                with self._readout_lock:
+                    data = self.read_data()
+                    self._record_count += len(data)
+                    curr_time = self._append_data(data)
+                if self.adaptive_interval:
+                    self._adapt_interval(len(data), time_read - time_last_read)
             except Exception:
                 no_data_timeout = None  # raise exception only once
                 if self.errback:
@@ -203,44 +448,78 @@ class FifoReadout(object):
                 if self.stop_readout.is_set():
                     break
             else:
-                n_words = data.shape[0]
-                last_time, curr_time = self.update_timestamp()
-                status = 0
-                if self.callback:
-                    self._data_deque.append((data, last_time, curr_time, status))
-                if self.fill_buffer:
-                    self._data_buffer.append((data, last_time, curr_time, status))
-                self._words_per_read.append(n_words)
                 # FIXME: busy FE prevents scan termination? To be checked
                 if self.stop_readout.is_set():
                     break
             finally:
-                time_wait = self.readout_interval - (time() - time_read)
+                time_wait = self.current_interval - (time() - time_read)
             if self._calculate.is_set():
                 self._calculate.clear()
-                self._result.put(sum(self._words_per_read))
+                self._result.put(sum(n_words for _, n_words in self._words_per_read))
         if self.callback:
-            self._data_deque.append(None)  # last item, will stop worker
+            self._data_queue.put(None)  # last item, will stop worker
         self.log.debug('Stopped %s', self.readout_thread.name)
 
+    def _wait_for_next_read(self, time_wait):
+        '''
+            Wait time_wait seconds before the next read. Returns True if the readout is force stopped.
+            A stop shortens long (adaptive) intervals, so that the last read follows the stop within the nominal interval.
+        '''
+        time_end = time() + max(time_wait, 0.0)
+        self.stop_readout.wait(max(time_end - self.readout_interval - time(), 0.0))
+        time_end = min(time_end, time() + self.readout_interval)
+        return self.force_stop.wait(max(time_end - time(), 0.0))
+
+    def _adapt_interval(self, n_words, time_since_last_read):
+        '''
+            Choose the next readout interval from the data rate, so that about target_words are in the FIFO at the next read.
+            The number of read words is the FIFO fill level at the read, so a fill level above target_words
+            leads to back-to-back reads (min_interval).
+        '''
+        if time_since_last_read > 0:
+            self._word_rate = 0.7 * self._word_rate + 0.3 * n_words / time_since_last_read
+        if n_words >= self.target_words:
+            interval = self.min_interval
+        elif self._word_rate > 0:
+            interval = self.target_words / self._word_rate
+        else:
+            interval = self.max_interval
+        self.current_interval = min(max(interval, self.min_interval), self.max_interval)
+
+    def _append_data(self, data):
+        '''
+            Tag data with time stamps, status, scan parameter id and readout interval and hand it over to the worker and the buffer.
+            Returns the current time stamp.
+        '''
+        n_words = data.shape[0]
+        last_time, curr_time = self.update_timestamp()
+        status = 0
+        data_tuple = (data, last_time, curr_time, status, self.scan_param_id, self.current_interval)
+        if self.callback:
+            self._data_queue.put(data_tuple)
+        if self.fill_buffer:
+            self._data_buffer.put(data_tuple)
+        self._words_per_read.append((curr_time, n_words))
+        while self._words_per_read[0][0] < curr_time - self._moving_average_time_period:
+            self._words_per_read.popleft()
+        return curr_time
+
     def worker(self):
         '''
             Worker thread continuously calling callback function when data is available.
         '''
         self.log.debug('Starting %s', self.worker_thread.name)
         while True:
+            data = self._data_queue.get()  # wait for the next readout
+            if data is None:  # if None then exit
+                self._data_queue.task_done()
+                break
             try:
-                data = self._data_deque.popleft()
-            except IndexError:
-                self.stop_readout.wait(self.readout_interval)  # sleep a little bit, reducing CPU usage
-            else:
-                if data is None:  # if None then exit
-                    break
-                else:
-                    try:
-                        self.callback(data)
-                    except Exception:
-                        self.errback(sys.exc_info())
+                self.callback(data)
+            except Exception:
+                self.errback(sys.exc_info())
+            finally:
+                self._data_queue.task_done()
 
         self.log.debug('Stopped %s', self.worker_thread.name)
 
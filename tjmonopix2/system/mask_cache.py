@@ -0,0 +1,180 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Cache of the command data of mask shifts.
+
+    A mask shift (MaskObject.shift) writes the same command data whenever it starts from the same
+    masks, e.g. in every scan parameter step of a threshold scan or in every scan of a tuning campaign.
+    The command data of all mask steps is stored per key, a hash of everything the data depends on,
+    and later mask shifts with the same key only upload the stored commands. The entries are kept
+    in memory or as files in a directory that is shared by scans and processes.
+'''
+
+import collections
+import hashlib
+import itertools
+import os
+import tempfile
+
+import numpy as np
+
+from tjmonopix2.system import logger
+
+
+class MaskStreamEntry(object):
+    ''' Command data of all steps of a mask shift
+
+        labels: numpy array
+            Label of every step (front-end name, 'skipped' or 'reset')
+        step_stop: numpy array
+            Index of the first command chunk of the next step
+        chunk_stop: numpy array
+            End of every command chunk in data
+        data: numpy array
+            Command data of all chunks (uint8)
+    '''
+
+    def __init__(self, labels, step_stop, chunk_stop, data):
+        self.labels = labels
+        self.step_stop = step_stop
+        self.chunk_stop = chunk_stop
+        self.data = data
+
+    @classmethod
+    def from_steps(cls, steps):
+        ''' Entry from a list of (label, list of command chunks) '''
+        chunks = [chunk for _, data in steps for chunk in data]
+        chunk_stop = np.cumsum([len(chunk) for chunk in chunks], dtype=np.int64)
+        return cls(labels=np.array([label for label, _ in steps], dtype=str),
+                   step_stop=np.cumsum([len(data) for _, data in steps], dtype=np.int64),
+                   chunk_stop=chunk_stop,
+                   data=np.fromiter(itertools.chain.from_iterable(chunks), dtype=np.uint8, count=chunk_stop[-1] if chunks else 0))
+
+    @property
+    def nbytes(self):
+        return self.labels.nbytes + self.step_stop.nbytes + self.chunk_stop.nbytes + self.data.nbytes
+
+    def __iter__(self):
+        ''' Label and list of command chunks of every step '''
+        chunk_bounds = np.append(0, self.chunk_stop).tolist()
+        first_chunk = 0
+        for label, last_chunk in zip(self.labels.tolist(), self.step_stop.tolist()):
+            yield label, [self.data[chunk_bounds[i]:chunk_bounds[i + 1]].tolist() for i in range(first_chunk, last_chunk)]
+            first_chunk = last_chunk
+
+
+class MaskStreamCache(object):
+    ''' Least recently used cache of mask shift command data (MaskStreamEntry)
+
+        directory: str
+            Directory of the cache files, shared by scans and processes. None: keep the entries in memory
+        max_size: float
+            Maximum total size of the entries [MB], the least recently used entries are removed first
+        max_entries: int
+            Maximum number of entries
+    '''
+
+    def __init__(self, directory=None, max_size=50., max_entries=4):
+        self.log = logger.setup_derived_logger('MaskStreamCache')
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # In memory cache, least recently used first
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(arrays, **parameters):
+        ''' Hash of the arrays (content, dtype and shape) and parameters (repr) '''
+        sha = hashlib.sha1()
+        for name, value in sorted(parameters.items()):
+            sha.update(('%s=%r;' % (name, value)).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            sha.update(('%s%s;' % (array.dtype.str, array.shape)).encode())
+            sha.update(array.tobytes())
+        return sha.hexdigest()
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, 'mask_stream_%s.npz' % key)
+
+    def load(self, key):
+        ''' Return the entry with the given key or None '''
+        if self.directory is None:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        filename = self._get_filename(key)
+        try:
+            with np.load(filename) as in_file:
+                entry = MaskStreamEntry(labels=in_file['labels'], step_stop=in_file['step_stop'],
+                                        chunk_stop=in_file['chunk_stop'], data=in_file['data'])
+            os.utime(filename)  # Mark as recently used
+        except (OSError, KeyError, ValueError):  # Missing, removed by another process or damaged
+            return None
+        self.log.debug('Use cached mask shift command data %s', key)
+        return entry
+
+    def store(self, key, entry):
+        ''' Store the entry (MaskStreamEntry or list of (label, list of command chunks)) and remove old entries '''
+        if not isinstance(entry, MaskStreamEntry):
+            entry = MaskStreamEntry.from_steps(entry)
+        if self.directory is None:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or
+                                              sum(e.nbytes for e in self._entries.values()) > self.max_size * 1e6):
+                self._entries.popitem(last=False)
+            return
+
+        # Write to a temporary file first, other processes must not see a partial file
+        fd, tmp_filename = tempfile.mkstemp(suffix='.npz.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                np.savez_compressed(out_file, labels=entry.labels, step_stop=entry.step_stop, chunk_stop=entry.chunk_stop, data=entry.data)
+            os.replace(tmp_filename, self._get_filename(key))
+        except OSError:
+            self.log.warning('Cannot store mask shift command data in %s', self.directory)
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return
+        self._remove_old_entries()
+
+    def _remove_old_entries(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.startswith('mask_stream_') and name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+        files.sort()
+        n_files, total_size = len(files), sum(size for _, size, _ in files)
+        for _, size, name in files[:-1]:  # Keep the newest entry
+            if n_files <= self.max_entries and total_size <= self.max_size * 1e6:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:  # Removed by another process
+                pass
+            n_files -= 1
+            total_size -= size
+
+    def clear(self):
+        ''' Remove all entries '''
+        self._entries.clear()
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.startswith('mask_stream_') and name.endswith('.npz'):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
@@ -0,0 +1,230 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Persistence of the raw data and meta data of a scan.
+
+    RawDataBatch collects readouts and writes them to the raw_data and meta_data nodes in one call.
+    RawDataWriter does the same in a separate process, so that the blosc compression and the
+    HDF5 writes do not compete with the readout thread for the GIL.
+'''
+
+import ctypes
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.analysis.online import RawDataRingBuffer
+from tjmonopix2.system import logger
+
+
+class RawDataBatch(object):
+    ''' Readouts waiting to be written to the raw data file
+
+        The raw data of all readouts is appended with one call and the meta data rows
+        are built as one structured array. The batch should be written if add() returns True.
+
+        max_words: int
+            Number of raw data words in the batch that triggers a write (0: every readout)
+        max_time: float
+            Time since the last write that triggers a write [s]
+    '''
+
+    def __init__(self, max_words=1000000, max_time=1.0):
+        self.max_words = max_words
+        self.max_time = max_time
+        self.readouts = []
+        self.n_words = 0
+        self.last_write = time.time()
+
+    def __len__(self):
+        return len(self.readouts)
+
+    def add(self, data_tuple, scan_param_id):
+        ''' Add a readout, returns True if the batch should be written '''
+        self.readouts.append((data_tuple, scan_param_id))
+        self.n_words += data_tuple[0].shape[0]
+        return self.is_due()
+
+    def is_due(self):
+        return self.n_words >= self.max_words or time.time() - self.last_write >= self.max_time
+
+    def write(self, raw_data_earray, meta_data_table):
+        ''' Append the readouts to the raw data array and the meta data table and flush both '''
+        self.last_write = time.time()
+        if not self.readouts:
+            return
+        data_lengths = np.array([data_tuple[0].shape[0] for data_tuple, _ in self.readouts], dtype=np.int64)
+        index_stop = raw_data_earray.nrows + np.cumsum(data_lengths)
+
+        meta_data = np.zeros(len(self.readouts), dtype=meta_data_table.dtype)
+        meta_data['index_start'] = index_stop - data_lengths
+        meta_data['index_stop'] = index_stop
+        meta_data['data_length'] = data_lengths
+        meta_data['timestamp_start'] = [data_tuple[1] for data_tuple, _ in self.readouts]
+        meta_data['timestamp_stop'] = [data_tuple[2] for data_tuple, _ in self.readouts]
+        meta_data['error'] = [data_tuple[3] for data_tuple, _ in self.readouts]
+        meta_data['scan_param_id'] = [scan_param_id for _, scan_param_id in self.readouts]
+        meta_data['readout_interval'] = [data_tuple[5] if len(data_tuple) > 5 else 0. for data_tuple, _ in self.readouts]
+
+        raw_data_earray.append(np.concatenate([data_tuple[0] for data_tuple, _ in self.readouts]))
+        raw_data_earray.flush()
+        meta_data_table.append(meta_data)
+        meta_data_table.flush()
+        self.readouts = []
+        self.n_words = 0
+
+
+class RawDataWriter(object):
+    ''' Write the raw data and meta data of a scan file in a separate process
+
+        The readouts are passed with a shared memory ring buffer. While the writer is running it owns
+        the raw_data and meta_data nodes of the file, the file must not be open in the main process.
+        The main process only keeps count of the readouts, flush() waits until all of them are on disk.
+
+        filename: str
+            h5 file with the raw_data and meta_data nodes
+        ring_size: int
+            Size of the ring buffer in 32 bit words
+        write_timeout: float
+            Max. blocking time of write() if the ring buffer is full, the readout is dropped afterwards [s]
+        batch_words, batch_interval:
+            Write cadence of the writer process, see RawDataBatch
+    '''
+    _WRITTEN_WORDS, _FLUSHED = range(2)
+    _queue_timeout = 0.01  # max. idle time of the writer process [s]
+
+    def __init__(self, filename, ring_size=2 ** 24, write_timeout=10., batch_words=1000000, batch_interval=1.):
+        self.log = logger.setup_derived_logger('RawDataWriter')
+        self.filename = filename
+        self.write_timeout = write_timeout
+        self.batch_words = batch_words
+        self.batch_interval = batch_interval
+        self._ring = RawDataRingBuffer(size=ring_size, n_values=2)  # timestamp_start, readout_interval
+        self._commands = multiprocessing.Queue()
+        self._control = multiprocessing.RawArray(ctypes.c_int64, 2)
+        self._flushed_event = multiprocessing.Event()
+        self._n_flush = 0
+        self._n_words = 0  # words passed to the writer process
+        self.process = None
+
+    @property
+    def nrows(self):
+        ''' Number of raw data words written to the file '''
+        return int(self._control[self._WRITTEN_WORDS])
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self.worker, args=(self.filename, self._ring, self._commands, self._control, self._flushed_event))
+        self.process.start()
+        self.log.debug('Starting writer process %d for %s', self.process.pid, self.filename)
+
+    def write(self, data_tuple, scan_param_id):
+        ''' Pass a readout (FifoReadout data tuple) to the writer process, returns False if it was dropped '''
+        raw_data = data_tuple[0]
+        readout_interval = data_tuple[5] if len(data_tuple) > 5 else 0.
+        if not self._ring.write(raw_data, tag=scan_param_id, flags=data_tuple[3], timestamp=data_tuple[2],
+                                timeout=self.write_timeout, values=(data_tuple[1], readout_interval)):
+            self.log.error('Raw data writer too slow, %d words dropped', raw_data.shape[0])
+            return False
+        self._n_words += raw_data.shape[0]
+        return True
+
+    def append_table(self, name, rows, title=''):
+        ''' Append rows (structured numpy array) to a table in the file root, the table is created if needed '''
+        self._commands.put(('table', name, title, rows))
+
+    def flush(self, timeout=60.):
+        ''' Wait until all readouts passed to write() are written to the file '''
+        self._n_flush += 1
+        self._commands.put(('flush', self._n_flush))
+        deadline = time.time() + timeout
+        while self._control[self._FLUSHED] < self._n_flush:
+            if not self.process.is_alive():
+                raise RuntimeError('Raw data writer process died')
+            if time.time() > deadline:
+                raise TimeoutError('Raw data writer did not flush within %1.1f s (%d of %d words written)' % (timeout, self.nrows, self._n_words))
+            self._flushed_event.wait(self._queue_timeout)
+            self._flushed_event.clear()
+
+    def close(self, timeout=60.):
+        ''' Write all readouts and close the file and the writer process '''
+        if self.process is None:
+            return
+        try:
+            if self.process.is_alive():
+                self.flush(timeout=timeout)
+        finally:
+            self._commands.put(('close', ))
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+            status = self._ring.get_status()
+            if status['overflow_chunks'] or status['back_pressure']:
+                self.log.warning('Raw data writer: %d readouts (%d words) dropped, %d times full, max. fill %d of %d words',
+                                 status['overflow_chunks'], status['overflow_words'], status['back_pressure'], status['max_fill'], status['size'])
+
+    def worker(self, filename, ring, commands, control, flushed_event):
+        ''' Writing in seperate process '''
+        control = np.ctypeslib.as_array(control)
+        batch = RawDataBatch(max_words=self.batch_words, max_time=self.batch_interval)
+
+        with tb.open_file(filename, 'a') as h5_file:
+            raw_data_earray, meta_data_table = h5_file.root.raw_data, h5_file.root.meta_data
+            control[self._WRITTEN_WORDS] = raw_data_earray.nrows
+
+            def write_batch():
+                batch.write(raw_data_earray, meta_data_table)
+                control[self._WRITTEN_WORDS] = raw_data_earray.nrows
+
+            def read_ring():
+                ''' Move all readouts from the ring buffer to the batch '''
+                while True:
+                    ring.data_available.clear()
+                    chunk = ring.read()
+                    if chunk is None:
+                        return
+                    segments, scan_param_id, error, _, timestamp_stop = chunk
+                    timestamp_start, readout_interval = ring.read_values()
+                    raw_data = np.concatenate(segments)  # copy, the ring buffer space is freed
+                    ring.release()
+                    if batch.add((raw_data, timestamp_start, timestamp_stop, error, scan_param_id, readout_interval), scan_param_id):
+                        write_batch()
+
+            while True:
+                try:
+                    read_ring()
+                    if batch.is_due():
+                        write_batch()
+                    try:
+                        command = commands.get_nowait()
+                    except queue.Empty:
+                        ring.data_available.wait(self._queue_timeout)
+                        continue
+                    if command[0] == 'table':
+                        _, name, title, rows = command
+                        if name not in h5_file.root:
+                            h5_file.create_table(h5_file.root, name=name, description=rows.dtype, title=title,
+                                                 filters=tb.Filters(complib='zlib', complevel=5, fletcher32=False))
+                        table = h5_file.get_node(h5_file.root, name)
+                        table.append(rows)
+                        table.flush()
+                    elif command[0] == 'flush':
+                        read_ring()  # all readouts before the flush command
+                        write_batch()
+                        h5_file.flush()
+                        control[self._FLUSHED] = command[1]
+                        flushed_event.set()
+                    elif command[0] == 'close':
+                        read_ring()
+                        write_batch()
+                        break
+                except KeyboardInterrupt:  # Need to catch KeyboardInterrupt from main process
+                    pass
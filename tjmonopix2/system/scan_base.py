@@ -32,8 +32,11 @@ from tjmonopix2.system.tjmonopix2 import TJMonoPix2
 from tjmonopix2.system import logger, fifo_readout
 from tjmonopix2.system.mio3 import MIO3
 from tjmonopix2.system.bdaq53 import BDAQ53
+from tjmonopix2.system.emulator import DAQEmulator
 
 from tjmonopix2.system.fifo_readout import FifoReadout
+from tjmonopix2.system.mask_cache import MaskStreamCache
+from tjmonopix2.system.raw_data_writer import RawDataBatch, RawDataWriter
 
 # Compression for data files
 FILTER_RAW_DATA = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
@@ -73,6 +76,26 @@ def send_data(socket, data, scan_par_id, name='ReadoutData'):
         pass
 
 
+def send_maps(socket, maps, scan_par_id, name='ScurveMaps'):
+    '''Sends result maps of an online analysis (e.g. threshold and noise map)
+
+        via ZeroMQ to a specified socket. The maps are stacked into one array,
+        the map names are given in the meta data in the same order.
+    '''
+
+    meta_data = dict(
+        name=name,
+        timestamp_stop=time.time(),
+        maps=list(maps.keys()),
+        scan_par_id=scan_par_id
+    )
+    try:
+        data_ser = ou.simple_enc(np.stack([np.asarray(m, dtype=np.float32) for m in maps.values()]), meta=meta_data)
+        socket.send(data_ser, flags=zmq.NOBLOCK)
+    except zmq.Again:
+        pass
+
+
 class MetaTable(tb.IsDescription):
     index_start = tb.Int64Col(pos=0)
     index_stop = tb.Int64Col(pos=1)
@@ -82,6 +105,24 @@ class MetaTable(tb.IsDescription):
     scan_param_id = tb.UInt32Col(pos=5)
     error = tb.UInt32Col(pos=6)
     trigger = tb.Float64Col(pos=7)
+    readout_interval = tb.Float32Col(pos=8)
+
+
+class OnlineMetricsTable(tb.IsDescription):
+    timestamp = tb.Float64Col(pos=0)
+    name = tb.StringCol(64, pos=1)
+    scan_param_id = tb.UInt32Col(pos=2)
+    queue_words = tb.Int64Col(pos=3)
+    queue_readouts = tb.Int64Col(pos=4)
+    words = tb.Int64Col(pos=5)
+    readouts = tb.Int64Col(pos=6)
+    words_per_second = tb.Float64Col(pos=7)
+    latency_p50 = tb.Float64Col(pos=8)
+    latency_p90 = tb.Float64Col(pos=9)
+    latency_p99 = tb.Float64Col(pos=10)
+    lag_p50 = tb.Float64Col(pos=11)
+    lag_p90 = tb.Float64Col(pos=12)
+    lag_p99 = tb.Float64Col(pos=13)
 
 
 class MapTable(tb.IsDescription):
@@ -142,9 +183,11 @@ class ChipContainer:
         self.h5_file = None
         self.raw_data_earray = None
         self.meta_data_table = None
+        self.raw_data_writer = None
         # self.trigger_table = None
         # self.ptot_table = None
         self.scan_parameters = OrderedDict()
+        self.injected_pixels = OrderedDict()
         self.socket = None
 
     def __repr__(self):
@@ -293,7 +336,10 @@ class ScanBase(object):
                     # self.periphery.get_module_power(module=self.module_settings['name'], log=True)
                     self._set_receiver_enabled(receiver=self.chip.receiver, enabled=True)
                 self.daq.reset_fifo()
-                self._scan(**self.scan_config)
+                try:
+                    self._scan(**self.scan_config)
+                finally:
+                    self._stop_continuous_readout()
                 for _ in self.iterate_chips():
                     self._set_receiver_enabled(receiver=self.chip.receiver, enabled=False)
             else:
@@ -302,7 +348,10 @@ class ScanBase(object):
                     with self._logging_through_handler(self.log_fh):
                         # self.periphery.get_module_power(module=self.module_settings['name'], log=True)
                         self._set_receiver_enabled(receiver=self.chip.receiver, enabled=True)
-                        ret_values[i] = self._scan(**self.scan_config)
+                        try:
+                            ret_values[i] = self._scan(**self.scan_config)
+                        finally:
+                            self._stop_continuous_readout()
                         self._set_receiver_enabled(receiver=self.chip.receiver, enabled=False)
             # Finalize scan
             # Disable tlu module in case it was enabled.
@@ -312,6 +361,10 @@ class ScanBase(object):
             # Add status info
             self._set_readout_status()
             for _ in self.iterate_chips():
+                if self.raw_data_writer is not None:
+                    self.raw_data_writer.close()
+                    self.raw_data_writer = None
+                    self.h5_file = tb.open_file(self.output_filename + '.h5', mode='a')
                 # Add additional after scan data
                 self._add_chip_status()
                 node = self.h5_file.create_group(self.h5_file.root, 'configuration_out', 'Configuration after scan step')
@@ -458,6 +511,14 @@ class ScanBase(object):
             raise ValueError('You cannot change the scan parameter value of a scan parameter id')
         self.scan_parameters[scan_param_id] = kwargs
 
+    def store_injected_pixels(self, scan_param_id, injected):
+        '''
+            Manually store the pixels injected at the scan parameter id, if not all pixels of the scan are
+            injected at every scan parameter id (e.g. adaptive threshold scan). The analysis fills the S-curves
+            at the other scan parameter ids.
+        '''
+        self.injected_pixels[scan_param_id] = np.array(injected, dtype=bool)
+
     def iterate_chips(self):
         ''' Iterate through the chips and set all chip handles
 
@@ -533,6 +594,8 @@ class ScanBase(object):
                     readout_system = 'bdaq53'
                 if readout_system == "mio3":
                     self.daq = MIO3(conf=self.daq_conf_par, bench_config=self.configuration['bench'])
+                elif readout_system == "emulator":
+                    self.daq = DAQEmulator(conf=self.daq_conf_par, bench_config=self.configuration['bench'])
                 else:
                     self.daq = BDAQ53(conf=self.daq_conf_par, bench_config=self.configuration['bench'])
 
@@ -543,6 +606,9 @@ class ScanBase(object):
                     continue
                 else:
                     self.chip = TJMonoPix2(self.daq, chip_sn=self.chip_settings['chip_sn'], chip_id=self.chip_settings['chip_id'], receiver=self.chip_settings['receiver'], config=self.chip_conf)
+                    mask_cache_size = self.configuration['bench']['general'].get('mask_cache_size', 0)
+                    if mask_cache_size:  # Share the mask shift command data with later scans and other processes
+                        self.chip.masks.stream_cache = MaskStreamCache(os.path.join(self.working_dir, 'mask_cache'), max_size=mask_cache_size, max_entries=64)
 
     def _init_files(self):
         for _ in self.iterate_chips():
@@ -561,6 +627,14 @@ class ScanBase(object):
             # self.ptot_table = self.h5_file.create_table(self.h5_file.root, name='ptot_table', description=PtotTable,
             #                                             title='ptot_table', filters=FILTER_TABLES)
 
+            if self.configuration['bench']['general'].get('raw_data_writer', False):
+                # The writer process owns the data nodes until the end of the scan
+                self.h5_file.close()
+                self.raw_data_writer = RawDataWriter(self.output_filename + '.h5',
+                                                     batch_words=self.configuration['bench']['general'].get('write_batch_words', 1000000),
+                                                     batch_interval=self.configuration['bench']['general'].get('write_batch_interval', 1.0))
+                self.raw_data_writer.start()
+
             # Setup data sending
             socket_addr = self.chip_settings.get('send_data', None)
             if socket_addr:
@@ -991,6 +1065,13 @@ class ScanBase(object):
                 a[key] = np.float32(val)
             scan_par_table.append(a)
 
+        if self.injected_pixels:
+            injected = np.zeros((512, 512, max(list(self.scan_parameters) + list(self.injected_pixels)) + 1), dtype=bool)
+            for par_id, pixels in self.injected_pixels.items():
+                injected[..., par_id] = pixels
+            h5_file.create_carray(h5_file.root.configuration_out.scan, name='injected', title='Injected pixels per scan parameter id',
+                                  obj=injected, filters=FILTER_RAW_DATA)
+
     def _configure_masks(self):
         '''
             Masks configuring steps always needed after chip reset and before scan configure
@@ -1006,7 +1087,10 @@ class ScanBase(object):
         self.chip.masks.update(force=True)  # write all masks to chip
 
     def _configure_fifo_readout(self):
-        self.fifo_readout = FifoReadout(self.daq)
+        self.fifo_readout = FifoReadout(self.daq, **self.configuration['bench'].get('readout', {}))
+        self._data_batch = RawDataBatch(max_words=self.configuration['bench']['general'].get('write_batch_words', 1000000),
+                                        max_time=self.configuration['bench']['general'].get('write_batch_interval', 1.0))
+        self._data_batch_lock = Lock()  # flush_data() of a continuous readout runs while the worker adds readouts
         self._first_read = False
         # for receiver in self.daq.receivers:
         #     if self.daq.board_version != 'SIMULATION':  # Causes a timing issue in simulation
@@ -1023,6 +1107,9 @@ class ScanBase(object):
     def _close_h5_file(self):
         # Must be closed if already opened, otherwise access to file handle is only
         # possible using tb.file._open_files.close_all() (--> memory leak + file cannot be closed anymore)
+        if self.raw_data_writer is not None:
+            self.raw_data_writer.close()
+            self.raw_data_writer = None
         try:
             self.h5_file.close()
         except tb.exceptions.ClosedFileError:  # if scan was called the file is already closed
@@ -1086,8 +1173,12 @@ class ScanBase(object):
     # Readout methods
     @contextmanager
     def readout(self, scan_param_id=0, timeout=10.0, **kwargs):
-
-        self.scan_param_id = scan_param_id
+        '''
+            Record the data of a scan step.
+            With a continuous readout (readout: continuous) the FIFO readout is started at the first step and runs
+            until the end of the scan. The next step only changes the scan parameter id, the end of a step waits
+            until all data is read and handled (see drain_readout).
+        '''
 
         callback = kwargs.pop('callback', self.handle_data)
         errback = kwargs.pop('errback', self.handle_err)
@@ -1097,14 +1188,28 @@ class ScanBase(object):
         if kwargs:
             self.store_scan_par_values(scan_param_id, **kwargs)
 
-        self.start_readout(callback=callback, clear_buffer=clear_buffer, fill_buffer=fill_buffer, errback=errback, **kwargs)
+        if self.fifo_readout.is_running and self.fifo_readout.continuous and self.fifo_readout.readout_thread.is_alive():
+            self.fifo_readout.callback = callback
+            self.fifo_readout.errback = errback
+            self.fifo_readout.fill_buffer = fill_buffer
+            if clear_buffer and fill_buffer:
+                self.fifo_readout.data.clear()
+            self.set_scan_param_id(scan_param_id)
+        else:
+            if self.fifo_readout.is_running:  # continuous readout aborted
+                self.stop_readout(timeout=timeout)
+            self.scan_param_id = scan_param_id
+            self.start_readout(callback=callback, clear_buffer=clear_buffer, fill_buffer=fill_buffer, errback=errback, scan_param_id=scan_param_id, **kwargs)
         try:
             yield
         finally:
             if self.daq.board_version == 'SIMULATION':
                 for _ in range(100):
                     self.daq.rx_channels[self.chip.receiver].is_done()
-            self.stop_readout(timeout=timeout)
+            if self.fifo_readout.continuous:
+                self.drain_readout(timeout=timeout)
+            else:
+                self.stop_readout(timeout=timeout)
 
     def start_readout(self, **kwargs):
         # Pop parameters for fifo_readout.start
@@ -1114,38 +1219,91 @@ class ScanBase(object):
         reset_sram_fifo = kwargs.pop('reset_sram_fifo', True)
         errback = kwargs.pop('errback', self.handle_err)
         no_data_timeout = kwargs.pop('no_data_timeout', None)
+        scan_param_id = kwargs.pop('scan_param_id', getattr(self, 'scan_param_id', 0))
 
         self.fifo_readout.start(reset_sram_fifo=reset_sram_fifo, fill_buffer=fill_buffer, clear_buffer=clear_buffer,
-                                callback=callback, errback=errback, no_data_timeout=no_data_timeout)
+                                callback=callback, errback=errback, no_data_timeout=no_data_timeout, scan_param_id=scan_param_id)
 
     def stop_readout(self, timeout=10.0):
-        self.fifo_readout.stop(timeout=timeout)
+        try:
+            self.fifo_readout.stop(timeout=timeout)
+        finally:
+            self.flush_data()  # all data of the scan step is written to the file
 
-    def handle_data(self, data_tuple):
+    def drain_readout(self, timeout=10.0):
         '''
-            Handling of the data.
+            End of a scan step with continuous readout: all data of the step is read from the FIFO,
+            handled by the callback and written to the file.
         '''
+        try:
+            if not self.fifo_readout.drain(timeout=timeout):
+                self.log.warning('Readout not drained within %0.1f second(s)', timeout)
+        finally:
+            self.flush_data()  # all data of the scan step is written to the file
 
-        total_words = self.raw_data_earray.nrows
+    def _stop_continuous_readout(self):
+        ''' Stop a readout that is still running at the end of the scan '''
+        if self.fifo_readout.is_running:
+            self.stop_readout()
 
-        self.raw_data_earray.append(data_tuple[0])
-        self.raw_data_earray.flush()
+    def flush_data(self):
+        '''
+            Write the batched readouts to the raw data file.
+            Called at the end of every readout, call it if the data has to be on disk earlier.
+        '''
+        if self.raw_data_writer is not None:
+            self.raw_data_writer.flush()
+            return
+        with self._data_batch_lock:
+            if len(self._data_batch):
+                self._data_batch.write(self.raw_data_earray, self.meta_data_table)
+
+    def set_scan_param_id(self, scan_param_id):
+        '''
+            Change the scan parameter id within a running readout.
+            All data recorded before the call is stored with the previous scan parameter id.
+        '''
+        self.fifo_readout.set_scan_param_id(scan_param_id)
+        self.scan_param_id = scan_param_id
 
-        len_raw_data = data_tuple[0].shape[0]
-        self.meta_data_table.row['timestamp_start'] = data_tuple[1]
-        self.meta_data_table.row['timestamp_stop'] = data_tuple[2]
-        self.meta_data_table.row['error'] = data_tuple[3]
-        self.meta_data_table.row['data_length'] = len_raw_data
-        self.meta_data_table.row['index_start'] = total_words
-        total_words += len_raw_data
-        self.meta_data_table.row['index_stop'] = total_words
-        self.meta_data_table.row['scan_param_id'] = self.scan_param_id
+    def handle_data(self, data_tuple):
+        '''
+            Handling of the data.
+            The readouts are written to the raw data file in batches, see RawDataBatch and flush_data(),
+            optionally in a separate process (RawDataWriter).
+        '''
 
-        self.meta_data_table.row.append()
-        self.meta_data_table.flush()
+        scan_param_id = data_tuple[4] if len(data_tuple) > 4 else self.scan_param_id
+        if self.raw_data_writer is not None:
+            self.raw_data_writer.write(data_tuple, scan_param_id)
+        else:
+            with self._data_batch_lock:
+                if self._data_batch.add(data_tuple, scan_param_id):
+                    self._data_batch.write(self.raw_data_earray, self.meta_data_table)
 
         if self.socket:
-            send_data(self.socket, data=data_tuple, scan_par_id=self.scan_param_id)
+            send_data(self.socket, data=data_tuple, scan_par_id=scan_param_id)
+
+    def store_online_metrics(self, histogramming, name='online_analysis'):
+        '''
+            Log the metrics of an online histogramming object (see OnlineHistogrammingBase.get_metrics)
+            and append them to the online_metrics table of the raw data file.
+        '''
+        metrics = histogramming.log_metrics()
+        row = np.zeros(1, dtype=tb.description.dtype_from_descr(OnlineMetricsTable))
+        row['timestamp'] = time.time()
+        row['name'] = name
+        row['scan_param_id'] = self.scan_param_id
+        for key, value in metrics.items():
+            row[key] = value
+        if self.raw_data_writer is not None:
+            self.raw_data_writer.append_table('online_metrics', row, title='Online analysis metrics')
+            return
+        if 'online_metrics' not in self.h5_file.root:
+            self.h5_file.create_table(self.h5_file.root, name='online_metrics', description=OnlineMetricsTable,
+                                      title='Online analysis metrics', filters=FILTER_TABLES)
+        self.h5_file.root.online_metrics.append(row)
+        self.h5_file.root.online_metrics.flush()
 
     def handle_err(self, exc):
         ''' Handle errors when readout is started '''
@@ -1161,7 +1319,7 @@ class ScanBase(object):
         """Writes the current word rate in the postfix of the given progress bar (tqdm object)."""
         try:
             nrows_prev = self.nrows_last
-            nrows_now = self.raw_data_earray.nrows
+            nrows_now = self.raw_data_writer.nrows if self.raw_data_writer is not None else self.raw_data_earray.nrows
             if nrows_now < nrows_prev:
                 self.nrows_last = 0
                 return
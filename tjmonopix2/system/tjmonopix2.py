@@ -20,6 +20,7 @@ except ImportError:  # fallback to python parser
     from yaml import SafeLoader  # noqa
 
 from tjmonopix2.system import logger
+from tjmonopix2.system.mask_cache import MaskStreamCache
 
 FLAVOR_COLS = {'MONOPIX2': range(0, 224),
                'MONOPIX2_CASC': range(224, 448),
@@ -63,6 +64,33 @@ def encode_cmd(address, data):
     return [symbols[word_1], symbols[word_2], symbols[word_3], symbols[word_4], symbols[word_5], symbols[word_6]]
 
 
+_CMD_SYMBOLS = np.array([0b01101010, 0b01101100, 0b01110001, 0b01110010, 0b01110100, 0b10001011, 0b10001101, 0b10001110,
+                         0b10010011, 0b10010101, 0b10010110, 0b10011001, 0b10011010, 0b10011100, 0b10100011, 0b10100101,
+                         0b10100110, 0b10101001, 0b01011001, 0b10101100, 0b10110001, 0b10110010, 0b10110100, 0b11000011,
+                         0b11000101, 0b11000110, 0b11001001, 0b11001010, 0b11001100, 0b11010001, 0b11010010, 0b11010100], dtype=np.uint8)
+
+
+def encode_cmds(addresses, values, chip_id=0, n_sync=0):
+    '''
+        Register write commands (CMD_REGISTER, chip id, encode_cmd(address, value)) of many registers
+        as one contiguous uint8 buffer. Every write is followed by n_sync sync commands.
+        values can be one value for all addresses.
+    '''
+    addresses = np.asarray(addresses, dtype=np.int64).ravel()
+    values = np.broadcast_to(np.asarray(values, dtype=np.int64).ravel(), addresses.shape)
+    commands = np.empty((addresses.shape[0], 8 + 2 * n_sync), dtype=np.uint8)
+    commands[:, 0] = 0b01100110
+    commands[:, 1] = _CMD_SYMBOLS[chip_id]
+    commands[:, 2] = _CMD_SYMBOLS[addresses >> 5]
+    commands[:, 3] = _CMD_SYMBOLS[addresses & 0x1f]
+    commands[:, 4] = _CMD_SYMBOLS[values >> 11]
+    commands[:, 5] = _CMD_SYMBOLS[(values >> 6) & 0x1f]
+    commands[:, 6] = _CMD_SYMBOLS[(values >> 1) & 0x1f]
+    commands[:, 7] = _CMD_SYMBOLS[(values & 0x1) << 4]
+    commands[:, 8:] = np.tile([0b10000001, 0b01111110], n_sync)
+    return commands.ravel()
+
+
 class Register(dict):
     def __init__(self, chip, name, address, offset, size, default, value, mode, reset, description):
         self.log = logger.setup_derived_logger('TJ-Monopix2 - Register')
@@ -125,6 +153,13 @@ class Register(dict):
     def print_value(self):
         print(('{0} = 0b{1:0' + str(self['size']) + 'b} ({2:d})').format(self['name'], self['value'], self['value']))
 
+    def get_write_value(self):
+        ''' Value written to the register address, includes all registers at this address '''
+        wr_value = 0x0000
+        for reg in self.chip.registers.get_all_at_address(self['address']):
+            wr_value |= reg['value'] << reg['offset']
+        return wr_value
+
     def write(self, value=None, verify=False, write_ctr=0):
         if value is not None:
             value = self._assert_value(value)
@@ -132,11 +167,7 @@ class Register(dict):
         self.log.debug(('Writing value 0b{0:0' + str(self['size']) + 'b} to register {1}').format(self['value'], self['name']))
 
         if self['size'] <= 16:
-            wr_value = 0x0000
-            for reg in self.chip.registers.get_all_at_address(self['address']):
-                wr_value |= reg['value'] << reg['offset']
-
-            self.chip._write_register(self['address'], wr_value)
+            self.chip._write_register(self['address'], self.get_write_value())
         else:
             raise RuntimeError("Register size is too big, set with _write_register()")
 
@@ -151,11 +182,7 @@ class Register(dict):
             self.set(value)
 
         if self['size'] <= 16:
-            wr_value = 0x0000
-            for reg in self.chip.registers.get_all_at_address(self['address']):
-                wr_value |= reg['value'] << reg['offset']
-
-            return self.chip._write_register(self['address'], wr_value, write=False)
+            return self.chip._write_register(self['address'], self.get_write_value(), write=False)
         else:
             wr_value = eval('0b' + '0' * self['size'])
             indata = []
@@ -229,13 +256,20 @@ class RegisterObject(OrderedDict):
         Collect all registers that were changed in software and write to chip
         If force==True, write all software values to chip
         '''
-        indata = self.chip.write_sync(write=False)
-        for reg in self.values():
-            if (reg['mode'] != 1 or (not force and not reg.changed)) and 'PIXEL_PORTAL' not in reg['name']:
-                continue
+        regs = [reg for reg in self.values() if (reg['mode'] == 1 and (force or reg.changed)) or 'PIXEL_PORTAL' in reg['name']]
+        # Commands of the registers up to 16 bit encoded at once, followed by 16 syncs each
+        small_regs = [reg for reg in regs if reg['size'] <= 16]
+        commands = encode_cmds([reg['address'] for reg in small_regs], [reg.get_write_value() for reg in small_regs],
+                               chip_id=self.chip.chip_id, n_sync=16).reshape(-1, 8 + 2 * 16).tolist()
+        commands = dict(zip([reg['name'] for reg in small_regs], commands))
 
-            indata += self[reg['name']].get_write_command()
-            indata += self.chip.write_sync(write=False) * 16
+        indata = self.chip.write_sync(write=False)
+        for reg in regs:
+            if reg['name'] in commands:
+                indata += commands[reg['name']]
+            else:
+                indata += reg.get_write_command()
+                indata += self.chip.write_sync(write=False) * 16
 
             if len(indata) > 3500:
                 indata += self.chip.write_sync(write=False) * 16
@@ -300,91 +334,122 @@ class MaskObject(dict):
             self.was[name] = np.full(dimensions, props['default'])
             self[name] = np.full(dimensions, props['default'])
 
-        self.supported_mask_patterns = ['default']
+        self.supported_mask_patterns = list(SHIFT_PATTERNS)
+        # Mask shift pattern and row distance of the injected pixels used if shift() is called without them
+        self.shift_pattern = 'default'
+        self.mask_step = 4
 
-        # Initialize mask patterns to None and create pattern only on demand to save time
-        self.shift_patterns = dict.fromkeys(self.supported_mask_patterns)
+        # Create patterns only on demand to save time, key is pattern name and mask step
+        self.shift_patterns = {}
 
-        self.mask_cache = []
+        # Command data of mask shifts, replace with a cache in a directory to share it between scans
+        self.stream_cache = MaskStreamCache()
 
         super(MaskObject, self).__init__()
 
-    def _create_shift_pattern(self, pattern):
-        ''' Called when pattern is required '''
+    def _create_shift_pattern(self, pattern, mask_step):
+        ''' Called when pattern is required, returns the pattern and if all front-ends are shifted at the same time '''
         if pattern not in self.supported_mask_patterns:
             raise NotImplementedError('Mask pattern not supported:', pattern)
-        if not self.shift_patterns[pattern]:  # check if pattern is already created
-            if pattern == 'double':
-                self.shift_patterns['double'] = DoubleShiftPattern(self.dimensions, mask_step=4)
-            elif pattern == 'default':
-                self.shift_patterns['default'] = DoubleShiftPattern(self.dimensions, mask_step=4)  # default is double shift pattern
-
-    def get_mask_steps(self, pattern='default'):
-        fe_multiplier = 0
-        for _, cols in self.chip.flavor_cols.items():
+        pattern_class, parameters, parallel_frontends = SHIFT_PATTERNS[pattern]
+        if (pattern, mask_step) not in self.shift_patterns:  # check if pattern is already created
+            self.shift_patterns[(pattern, mask_step)] = pattern_class(self.dimensions, mask_step=mask_step, **parameters)
+        return self.shift_patterns[(pattern, mask_step)], parallel_frontends
+
+    def _get_frontend_masks(self, parallel_frontends):
+        ''' Name and column mask of the front-ends with enabled pixels, one combined mask if all front-ends are shifted at the same time '''
+        frontends = []
+        for fe, cols in self.chip.flavor_cols.items():
             fe_mask = np.zeros(self.dimensions, bool)
             fe_mask[cols[0]:cols[-1] + 1, :] = True
-            if np.any(np.logical_and(fe_mask, self['enable'])):
-                fe_multiplier += 1
-        self._create_shift_pattern(pattern)
-        return self.shift_patterns[pattern]._get_mask_steps() * fe_multiplier
-
-    def shift(self, masks=['enable'], pattern='default', cache=False, skip_empty=True):
+            if np.any(np.logical_and(fe_mask, self['enable'])):   # Only loop over frontends that have enabled columns
+                frontends.append((fe, fe_mask))
+        if parallel_frontends and frontends:
+            frontends = [('+'.join(fe for fe, _ in frontends), np.logical_or.reduce([fe_mask for _, fe_mask in frontends]))]
+        return frontends
+
+    def get_mask_steps(self, pattern=None, mask_step=None):
+        ''' Number of mask steps of shift() (including skipped steps) '''
+        shift_pattern, parallel_frontends = self._create_shift_pattern(pattern or self.shift_pattern, mask_step or self.mask_step)
+        return shift_pattern._get_mask_steps() * len(self._get_frontend_masks(parallel_frontends))
+
+    def get_mask_step_map(self, pattern=None, mask_step=None):
+        ''' Index of the mask step of shift() (including skipped steps) per pixel, -1 for pixels that are not shifted '''
+        shift_pattern, parallel_frontends = self._create_shift_pattern(pattern or self.shift_pattern, mask_step or self.mask_step)
+        step_map = np.full(self.dimensions, -1, dtype=np.int32)
+        step = 0
+        for _, fe_mask in self._get_frontend_masks(parallel_frontends):
+            shift_pattern.reset()
+            for pat in shift_pattern:
+                step_map[np.logical_and(pat, fe_mask)] = step
+                step += 1
+        return step_map
+
+    def _get_shift_key(self, masks, pattern, mask_step, skip_empty):
+        ''' Cache key of a mask shift, the command data also depends on the masks written by the last update() '''
+        names = sorted(self.keys())
+        return self.stream_cache.get_key([self[name] for name in names] + [self.was[name] for name in names],
+                                         names=names, masks=sorted(masks), pattern=SHIFT_PATTERNS[pattern], mask_step=mask_step,
+                                         skip_empty=skip_empty, flavor_cols=sorted((fe, list(cols)) for fe, cols in self.chip.flavor_cols.items()),
+                                         chip_id=self.chip.chip_id)
+
+    def shift(self, masks=['enable'], pattern=None, cache=False, skip_empty=True, mask_step=None):
         '''
-            This function is called from scan loops to loop over 1 FE at a time and
-            over the shifting masks as defined by the mask shift pattern
+            This function is called from scan loops to loop over 1 FE at a time (or all FEs at the same time,
+            see SHIFT_PATTERNS) and over the shifting masks as defined by the mask shift pattern.
+            pattern and mask_step default to the shift_pattern and mask_step attributes.
+
+            If cache is True, the command data of all mask steps is stored in the stream cache and
+            mask shifts with the same masks and settings only upload the stored command data. The masks
+            are not shifted in this case and no active pixels are returned.
         '''
 
         original_masks = {name: mask for name, mask in self.items()}
         active_pixels = []
 
-        self._create_shift_pattern(pattern)
+        pattern, mask_step = pattern or self.shift_pattern, mask_step or self.mask_step
+        shift_pattern, parallel_frontends = self._create_shift_pattern(pattern, mask_step)
 
         # Cache calculation to speed up repeated use
-        if cache and self.mask_cache:
-            for fe, data in self.mask_cache:
-                for d in data:
-                    self.chip.write_command(d)
-                if fe != 'reset':
-                    yield fe, active_pixels
-
-            for name, mask in original_masks.items():
-                self[name] = mask
-            return
-
-        for fe, cols in self.chip.flavor_cols.items():
-            fe_mask = np.zeros(self.dimensions, bool)
-            fe_mask[cols[0]:cols[-1] + 1, :] = True
-
-            if not np.any(np.logical_and(fe_mask, original_masks['enable'])):   # Only loop over frontends that have enabled columns
-                continue
-
+        if cache:
+            key = self._get_shift_key(masks, pattern, mask_step, skip_empty)
+            entry = self.stream_cache.load(key)
+            if entry is not None:
+                for fe, data in entry:
+                    for d in data:
+                        self.chip.write_command(d)
+                    if fe != 'reset':
+                        yield fe, active_pixels
+
+                for name, mask in original_masks.items():
+                    self.was[name][:] = mask[:]
+                return
+        steps = []
+
+        for fe, fe_mask in self._get_frontend_masks(parallel_frontends):
             # data = [self.chip.enable_core_col_clock(range(int(cols[0] / 8), int((cols[-1] - 1) / 8 + 1)), write=True)]   # Enable only one frontend at a time
-            data = []
 
-            self.shift_patterns[pattern].reset()
-            for pat in self.shift_patterns[pattern]:
+            shift_pattern.reset()
+            for pat in shift_pattern:
                 if isinstance(pat, np.ndarray):  # If DoubleShiftPattern or ClassicShiftPattern is used
                     for mask in masks:
                         self[mask] = np.logical_and(np.logical_and(original_masks[mask], pat), fe_mask)
                     if not np.any(self['enable'][:]) and skip_empty:   # Skip empty steps for speedup
-                        if cache:
-                            self.mask_cache.append(('skipped', []))
+                        steps.append(('skipped', []))
                         yield 'skipped', active_pixels
                         continue
                 else:  # If CrosstalkShiftPattern is used
                     for name, mask in pat.items():
                         self[name] = np.logical_and(np.logical_and(original_masks[name], mask), fe_mask)
-                data.extend(self.update())
-                if cache:
-                    self.mask_cache.append((fe, data))
-                    data = []
+                steps.append((fe, self.update()))
                 active_pixels = np.where(self['enable'][0:self.dimensions[0], 0:self.dimensions[1]])
                 yield fe, active_pixels
 
         for name, mask in original_masks.items():
             self[name] = mask
-        self.mask_cache.append(('reset', self.update()))
+        steps.append(('reset', self.update()))
+        if cache:
+            self.stream_cache.store(key, steps)
 
     def reset_all(self):
         for name, _ in self.items():
@@ -424,6 +489,45 @@ class MaskObject(dict):
         inj = np.logical_or.reduce(self['injection'], axis=0)[rowgroup * 16: (rowgroup + 1) * 16]
         return np.packbits(inj, bitorder='little').view(np.uint16)[0]
 
+    def _get_column_group_values(self, colgroups, rows):
+        ''' get_column_group_data() of many (column group, row) pairs '''
+        cols = colgroups[:, np.newaxis] * 4 + np.arange(4)
+        rows = rows[:, np.newaxis]
+        nibbles = np.where(self['enable'][cols, rows], self['tdac'][cols, rows] & 0x7, 0).astype(np.int64)
+        return (nibbles << (4 * np.arange(4))).sum(axis=1)
+
+    @staticmethod
+    def _unique_in_order(keys):
+        ''' Unique values in the order of their first occurrence '''
+        _, first = np.unique(keys, return_index=True)
+        return keys[np.sort(first)]
+
+    def _get_pixel_portal_commands(self, pix_to_write):
+        '''
+            Command blocks (row / column group, pixel portal, sync) of the column groups with changed pixels,
+            shape (n, 18). The column groups are in the order of their first changed pixel.
+        '''
+        keys = self._unique_in_order(pix_to_write[:, 0] // 4 * self.dimensions[1] + pix_to_write[:, 1])
+        colgroups, rows = keys // self.dimensions[1], keys % self.dimensions[1]
+        values = self._get_column_group_values(colgroups, rows)
+
+        # The pixel portal register is written with all registers at its address (see Register.get_write_command)
+        portal = self.chip.registers['PIXEL_PORTAL']
+        other_value = 0
+        for reg in self.chip.registers.get_all_at_address(portal['address']):
+            if reg is not portal:
+                other_value |= reg['value'] << reg['offset']
+        if np.any(values != np.append(portal['value'], values[:-1])):
+            portal.changed = True
+        portal['value'] = int(values[-1])
+
+        addresses = np.column_stack((np.full(keys.shape[0], 17), np.full(keys.shape[0], portal['address'])))
+        register_values = np.column_stack(((colgroups & 0x7f) << 9 | (rows & 0x1ff), other_value | (values << portal['offset'])))
+        commands = np.empty((keys.shape[0], 18), dtype=np.uint8)
+        commands[:, :16] = encode_cmds(addresses, register_values, chip_id=self.chip.chip_id).reshape(-1, 16)
+        commands[:, 16:] = self.chip.CMD_SYNC
+        return commands
+
     def update(self, force=False):
         ''' Write the actual pixel register configuration
 
@@ -446,42 +550,36 @@ class MaskObject(dict):
         data = []
         indata = self.chip.write_sync(write=False) * 10
         if len(pix_to_write) > 0:
-            last_coords = (-1, -1)
-            written = set()
-            for (col, row) in pix_to_write:
-                colgroup = int(col / 4)
-
-                # Speedup
-                if (colgroup, row) in written:
-                    continue
-
-                indata += self.chip._write_register(17, (colgroup & 0x7f) << 9 | (row & 0x1ff), write=False)  # Write colgroup and row at the same time for speedup
-                indata += self.chip.registers["PIXEL_PORTAL"].get_write_command(self.get_column_group_data(colgroup, row))
-                indata += self.chip.write_sync(write=False)
-                last_coords = (col, row)
-                written.add((colgroup, row))
-                if len(indata) > 4000:  # Write command to chip before it gets too long
+            # Write colgroup and row at the same time for speedup, one block per column group and row
+            commands = self._get_pixel_portal_commands(pix_to_write)
+            block_size = commands.shape[1]
+            stream = commands.ravel()
+            start = 0
+            while start < stream.shape[0]:
+                # Write command to chip before it gets too long (more than 4000 bytes)
+                n_blocks = min((4000 - len(indata)) // block_size + 1, (stream.shape[0] - start) // block_size)
+                indata += stream[start:start + n_blocks * block_size].tolist()
+                start += n_blocks * block_size
+                if len(indata) > 4000:
                     self.chip.write_command(indata)
                     data.append(indata)
                     indata = self.chip.write_sync(write=False)
             self.chip.write_command(indata)
             data.append(indata)
         if len(inj_to_write) > 0:
-            last_coords = (-1, -1)
-            written = set()
-            for (col, row) in inj_to_write:
-                colgroup = int(col / 16)
-                rowgroup = int(row / 16)
-
-                # Speedup
-                if (colgroup, rowgroup) in written:
-                    continue
-
-                indata += self.chip._write_register(82 + colgroup, self.get_inj_column_group_data(colgroup))
-                indata += self.chip._write_register(114 + rowgroup, self.get_inj_row_group_data(rowgroup))
+            n_rowgroups = self.dimensions[1] // 16
+            keys = self._unique_in_order(inj_to_write[:, 0] // 16 * n_rowgroups + inj_to_write[:, 1] // 16)
+            colgroups, rowgroups = keys // n_rowgroups, keys % n_rowgroups
+            inj_col_data = np.packbits(np.logical_or.reduce(self['injection'], axis=1), bitorder='little').view(np.uint16)
+            inj_row_data = np.packbits(np.logical_or.reduce(self['injection'], axis=0), bitorder='little').view(np.uint16)
+            col_commands = encode_cmds(82 + colgroups, inj_col_data[colgroups], chip_id=self.chip.chip_id).reshape(-1, 8).tolist()
+            row_commands = encode_cmds(114 + rowgroups, inj_row_data[rowgroups], chip_id=self.chip.chip_id).reshape(-1, 8).tolist()
+            for col_command, row_command in zip(col_commands, row_commands):
+                self.chip.write_command(col_command)
+                indata += col_command
+                self.chip.write_command(row_command)
+                indata += row_command
                 indata += self.chip.write_sync(write=False)
-                last_coords = (col, row)
-                written.add((colgroup, rowgroup))
                 if len(indata) > 4000:  # Write command to chip before it gets too long
                     self.chip.write_command(indata)
                     data.append(indata)
@@ -523,7 +621,7 @@ class ShiftPatternBase(object):
         raise NotImplementedError('You have to define the mask at a given step')
 
     def __next__(self):
-        if self.current_step >= (self.dimensions[0] * self.mask_step) - 1:
+        if self.current_step >= self._get_mask_steps() - 1:
             raise StopIteration
         else:
             self.current_step += 1
@@ -546,6 +644,50 @@ class DoubleShiftPattern(ShiftPatternBase):
         return np.roll(np.roll(self.base_mask, step // self.dimensions[0], 1), step % self.dimensions[0], 0)
 
 
+class InterleavedShiftPattern(ShiftPatternBase):
+    '''
+        Enables pixels along every col_step-th column with specified row distance (mask_step),
+        i.e. dimensions[0] / col_step columns at the same time.
+
+        The injection is enabled per column and per row, so the injected pixels are all
+        combinations of injected columns and rows. All columns of a step have the same rows,
+        no other pixels than the enabled ones are injected.
+        Reduces the number of mask steps by a factor of dimensions[0] / col_step compared to
+        the DoubleShiftPattern with the same mask_step.
+    '''
+
+    def __init__(self, dimensions, mask_step, col_step=128):
+        self.col_step = col_step
+        super(InterleavedShiftPattern, self).__init__(dimensions, mask_step)
+
+    def _get_mask_steps(self):
+        return self.col_step * self.mask_step
+
+    def make_first_mask(self):
+        mask = np.zeros(self.dimensions, bool)
+        mask[::self.col_step, ::self.mask_step] = True
+        return mask
+
+    def make_mask_for_step(self, step):
+        return np.roll(np.roll(self.base_mask, step // self.col_step, 1), step % self.col_step, 0)
+
+
+# Supported mask shift patterns: pattern class, parameters and if all front-ends are shifted at the same time
+# (number of mask steps for n front-ends with enabled pixels, 512 x 512 pixels).
+# The scan time is given by the number of mask steps with injections, empty steps are skipped at almost no cost.
+SHIFT_PATTERNS = {
+    # One column at a time, one front-end after the other: n * 512 * mask_step steps
+    'default': (DoubleShiftPattern, {}, False),
+    'double': (DoubleShiftPattern, {}, False),
+    # One column at a time, all front-ends together: 512 * mask_step steps, n times less reported and skipped steps than default.
+    # The steps with injections are the same as for default, the scan time is not reduced.
+    'parallel': (DoubleShiftPattern, {}, True),
+    # Four columns (one every 128 columns) at a time, all front-ends together: 128 * mask_step steps (4 * n times less than default).
+    # 4 times less steps with injections (scan time) and 4 times more injected pixels per step
+    'interleaved': (InterleavedShiftPattern, {'col_step': 128}, True),
+}
+
+
 class TJMonoPix2(object):
 
     """ Map hardware IDs for board identification """
@@ -633,6 +775,7 @@ class TJMonoPix2(object):
                 self.masks.disable_mask[pix[0], pix[1]] = False
 
         self.debug = 0
+        self._injection_programs = {}
 
     def get_sn(self):
         return self.chip_sn
@@ -868,6 +1011,8 @@ class TJMonoPix2(object):
     def write_command(self, data, repetitions=1, wait_for_done=True, wait_for_ready=False):
         '''
             Write data to the command encoder.
+            Only the bytes that differ from the command memory content are uploaded (see cmd.upload()),
+            repeated commands (e.g. the same injection in every mask step) just restart the command encoder.
 
             Parameters:
             ----------
@@ -893,8 +1038,7 @@ class TJMonoPix2(object):
             while (not self.daq['cmd'].is_done()):
                 pass
 
-        self.daq['cmd'].set_data(data)
-        self.daq['cmd'].set_size(len(data))
+        self.daq['cmd'].upload(data)
         self.daq['cmd'].set_repetitions(repetitions)
         self.daq['cmd'].start()
 
@@ -945,6 +1089,34 @@ class TJMonoPix2(object):
 
         return indata
 
+    def write_registers(self, addresses, values, n_sync=1, write=True):
+        '''
+            Write many registers with one command upload
+
+            Parameters:
+            ----------
+                addresses : array like
+                    Addresses of the registers
+                values : array like or int
+                    Values to write into the registers, one value per address or one value for all
+                n_sync : int
+                    Number of sync commands after every register write
+
+            Returns:
+            ----------
+                indata : list
+                    Command data, a list of commands if it does not fit into one command upload
+        '''
+        data = encode_cmds(addresses, values, chip_id=self.chip_id, n_sync=n_sync)
+        chunk_size = (4000 // (8 + 2 * n_sync)) * (8 + 2 * n_sync)
+        indata = [data[i:i + chunk_size].tolist() for i in range(0, data.shape[0], chunk_size)]
+        if len(indata) == 1:
+            indata = indata[0]
+
+        if write and indata:
+            self.write_command(indata)
+        return indata
+
     def _read_register(self, address, write=True):
         '''
             Sends read command to register with data
@@ -1022,13 +1194,19 @@ class TJMonoPix2(object):
 
     def inject(self, PulseStartCnfg=1, PulseStopCnfg=1500, repetitions=1, latency=1400, write=True, reset_bcid=False):
         # PulseStopCnfg is in 320 MHz clock units
-        indata = self.write_sync(write=False) * 4
-        indata += self.write_cal(PulseStartCnfg=PulseStartCnfg, PulseStopCnfg=PulseStopCnfg, write=False, reset_bcid=reset_bcid)  # Injection
-        indata += self.write_sync(write=False) * latency
+        # The command sequence is built once per setting. Commands written in between (e.g. the masks) overwrite
+        # the start of the command memory, only these bytes are uploaded again.
+        key = (PulseStartCnfg, PulseStopCnfg, latency, reset_bcid)
+        indata = self._injection_programs.get(key)
+        if indata is None:
+            indata = self.write_sync(write=False) * 4
+            indata += self.write_cal(PulseStartCnfg=PulseStartCnfg, PulseStopCnfg=PulseStopCnfg, write=False, reset_bcid=reset_bcid)  # Injection
+            indata += self.write_sync(write=False) * latency
+            self._injection_programs[key] = indata
 
         if write:
             self.write_command(indata, repetitions=repetitions)
-        return indata
+        return list(indata)
 
 
 if __name__ == '__main__':
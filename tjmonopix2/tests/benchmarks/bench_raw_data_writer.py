@@ -0,0 +1,113 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Sustained raw data write rate with the raw data written in the readout process (RawDataBatch)
+    and in a separate writer process (RawDataWriter).
+
+    A readout thread passes readouts of hit data to the writer as fast as possible while the main
+    thread does pure python work (like mask updates and injections in a scan) that competes for the GIL.
+    Reported are the written words/s including the final flush and the rate of the main thread work.
+
+    Usage: python -m tjmonopix2.tests.benchmarks.bench_raw_data_writer [-t duration] [-w words per readout]
+'''
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.analysis import raw_data_generator as rdg
+from tjmonopix2.system.raw_data_writer import RawDataBatch, RawDataWriter
+from tjmonopix2.system.scan_base import FILTER_RAW_DATA, FILTER_TABLES, MetaTable
+
+
+def get_readouts(n_readouts, n_words, seed=0):
+    ''' Readouts of synthetic hit data, compresses like real data '''
+    _, raw_data = rdg.generate_raw_data(n_words // 2, n_clusters=1., cluster_size=2., tlu_rate=1., seed=seed)
+    raw_data = np.resize(raw_data, n_readouts * n_words)
+    return np.split(raw_data, n_readouts)
+
+
+def _create_file(filename):
+    h5_file = tb.open_file(filename, mode='w')
+    raw_data_earray = h5_file.create_earray(h5_file.root, name='raw_data', atom=tb.UIntAtom(), shape=(0,), title='raw_data', filters=FILTER_RAW_DATA)
+    meta_data_table = h5_file.create_table(h5_file.root, name='meta_data', description=MetaTable, title='meta_data', filters=FILTER_TABLES)
+    return h5_file, raw_data_earray, meta_data_table
+
+
+def run(use_writer, readouts, duration, filename):
+    h5_file, raw_data_earray, meta_data_table = _create_file(filename)
+    if use_writer:
+        h5_file.close()
+        writer = RawDataWriter(filename)
+        writer.start()
+        write, flush = writer.write, writer.flush
+    else:
+        batch = RawDataBatch()
+
+        def write(data_tuple, scan_param_id):
+            if batch.add(data_tuple, scan_param_id):
+                batch.write(raw_data_earray, meta_data_table)
+
+        def flush():
+            batch.write(raw_data_earray, meta_data_table)
+
+    stop = threading.Event()
+    n_words = [0]
+
+    def readout():
+        i = 0
+        while not stop.is_set():
+            raw_data = readouts[i % len(readouts)]
+            now = time.time()
+            write((raw_data, now, now, 0, i // 100, 0.), i // 100)
+            n_words[0] += raw_data.shape[0]
+            i += 1
+
+    thread = threading.Thread(target=readout)
+    start = time.time()
+    thread.start()
+    n_work = 0
+    while time.time() - start < duration:  # Python work of the scan loop
+        sum(i * i for i in range(1000))
+        n_work += 1
+    stop.set()
+    thread.join()
+    flush()
+    elapsed = time.time() - start
+    if use_writer:
+        writer.close()
+    else:
+        h5_file.close()
+
+    with tb.open_file(filename, 'r') as in_file:
+        assert in_file.root.raw_data.nrows == n_words[0]
+    return {'words_per_second': n_words[0] / elapsed, 'work_per_second': n_work / elapsed, 'file_size': os.path.getsize(filename)}
+
+
+def main(duration=10., n_words=100000):
+    readouts = get_readouts(16, n_words)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for use_writer in (False, True):
+            name = 'writer process' if use_writer else 'readout process'
+            results[name] = run(use_writer, readouts, duration, os.path.join(tmp_dir, 'raw_data_%d.h5' % use_writer))
+            print('%-16s %10.3g words/s  %8.1f main thread loops/s  %6.1f MB' % (name, results[name]['words_per_second'], results[name]['work_per_second'], results[name]['file_size'] / 1e6))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the raw data writing with and without writer process')
+    parser.add_argument('-t', '--duration', type=float, default=10., help='Duration per run [s]')
+    parser.add_argument('-w', '--words', type=int, default=100000, help='Words per readout')
+    args = parser.parse_args()
+    main(duration=args.duration, n_words=args.words)
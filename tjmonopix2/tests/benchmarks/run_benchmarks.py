@@ -0,0 +1,270 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+'''
+    Benchmarks of the data path with fixed synthetic data sets.
+
+    Every benchmark has a setup function that creates the data set (not timed) and returns the timed
+    function and the number of processed items. The function is run several times and the best and median
+    time is reported. The results are stored as JSON together with the machine and software versions,
+    so that results of different versions can be compared with --compare.
+
+    Usage: python -m tjmonopix2.tests.benchmarks.run_benchmarks [-k filter] [-o results.json] [--compare old.json]
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+from scipy.special import erf
+
+from tjmonopix2.analysis import raw_data_generator as rdg
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(unit, max_repeat=None):
+    ''' Register a benchmark setup function, unit is the name of the processed items '''
+    def decorator(setup):
+        BENCHMARKS[setup.__name__] = (setup, unit, max_repeat)
+        return setup
+    return decorator
+
+
+def _get_raw_data(scale):
+    return rdg.generate_raw_data(int(200000 * scale), n_clusters=1., cluster_size=2., tlu_rate=1., tdc_rate=0.1, seed=0)
+
+
+@benchmark('words')
+def interpreter_interpret(scale, tmp_dir):
+    from tjmonopix2.analysis import analysis_utils as au
+    from tjmonopix2.analysis.interpreter import RawDataInterpreter
+    _, raw_data = _get_raw_data(scale)
+    hit_buffer = np.zeros(raw_data.shape[0] * 3, dtype=au.hit_dtype)
+
+    def run():
+        RawDataInterpreter().interpret(raw_data, hit_buffer, 0)
+    return run, raw_data.shape[0]
+
+
+@benchmark('words')
+def online_histogram(scale, tmp_dir):
+    from tjmonopix2.analysis import online as oa
+    _, raw_data = _get_raw_data(scale)
+    occ_hist = np.zeros((512, 512), dtype=np.uint32)
+
+    def run():
+        oa.histogram(raw_data, occ_hist, None, oa.get_decoder_state())
+    return run, raw_data.shape[0]
+
+
+@benchmark('words')
+def analysis_analyze_data(scale, tmp_dir):
+    from tjmonopix2.analysis.analysis import Analysis
+    _, raw_data = _get_raw_data(scale)
+    raw_data_file = os.path.join(tmp_dir, 'analyze_data.h5')
+    rdg.write_raw_data_file(raw_data_file, raw_data)
+
+    def run():
+        with Analysis(raw_data_file=raw_data_file) as a:
+            a.analyze_data()
+    return run, raw_data.shape[0]
+
+
+@benchmark('S-curves', max_repeat=1)
+def fit_scurves_multithread(scale, tmp_dir):
+    ''' Full chip, the first pixels have S-curves, the others no hits '''
+    from tjmonopix2.analysis import analysis_utils as au
+    rng = np.random.default_rng(0)
+    n_pixels, n_injections = int(4096 * scale), 100
+    charges = np.arange(0, 100, 2.)
+    threshold, noise = rng.normal(50, 5, n_pixels), rng.normal(3, 0.3, n_pixels)
+    probability = 0.5 * (1 + erf((charges - threshold[:, np.newaxis]) / (np.sqrt(2) * noise[:, np.newaxis])))
+    scurves = np.zeros((512 * 512, charges.shape[0]))
+    scurves[:n_pixels] = rng.binomial(n_injections, probability)
+
+    def run():
+        au.fit_scurves_multithread(scurves, charges, n_injections)
+    return run, scurves.shape[0]
+
+
+def _get_chip():
+    from tjmonopix2.system.emulator import DAQEmulator
+    from tjmonopix2.system.tjmonopix2 import TJMonoPix2
+    return TJMonoPix2(DAQEmulator(bench_config={}, source=[]), config=None)
+
+
+@benchmark('mask updates')
+def mask_update(scale, tmp_dir):
+    chip = _get_chip()
+    rng = np.random.default_rng(0)
+    n_updates = max(2, int(4 * scale))  # consecutive masks differ
+    masks = [rng.random((512, 512)) < 0.5 for _ in range(n_updates)]
+
+    def run():
+        for mask in masks:
+            chip.masks['enable'][:] = mask
+            chip.masks['injection'][:] = ~mask
+            chip.masks.update()
+    return run, n_updates
+
+
+@benchmark('commands')
+def encode_cmd(scale, tmp_dir):
+    from tjmonopix2.system.tjmonopix2 import encode_cmd
+    rng = np.random.default_rng(0)
+    n_commands = int(100000 * scale)
+    addresses, values = rng.integers(0, 256, n_commands).tolist(), rng.integers(0, 2 ** 16, n_commands).tolist()
+
+    def run():
+        for address, value in zip(addresses, values):
+            encode_cmd(address, value)
+    return run, n_commands
+
+
+@benchmark('hits')
+def clustering(scale, tmp_dir):
+    from pixel_clusterizer.clusterizer import HitClusterizer
+    hits, _ = _get_raw_data(scale)
+    cluster_hits = np.zeros(hits.shape[0], dtype=[('event_number', '<i8'), ('frame', '<u1'), ('column', '<u2'), ('row', '<u2'), ('charge', '<u2')])
+    cluster_hits['event_number'] = hits['event']
+    cluster_hits['column'] = hits['col'] + 1
+    cluster_hits['row'] = hits['row'] + 1
+    cluster_hits['charge'] = (hits['te'].astype(np.int16) - hits['le']) & 0x7f
+    clusterizer = HitClusterizer(column_cluster_distance=2, row_cluster_distance=2, frame_cluster_distance=2, ignore_same_hits=True)
+    clusterizer.cluster_hits(cluster_hits[:1000])  # Compile
+
+    def run():
+        clusterizer.cluster_hits(cluster_hits)
+    return run, hits.shape[0]
+
+
+@benchmark('hits')
+def plotting_histograms(scale, tmp_dir):
+    ''' Histogram passes of the plotting scripts (hit map, ToT map and spectrum, per pixel S-curves) '''
+    hits, _ = _get_raw_data(scale)
+    col, row = hits['col'], hits['row']
+    tot = (hits['te'].astype(np.int16) - hits['le']) & 0x7f
+    charge = np.random.default_rng(0).integers(0, 50, hits.shape[0])
+
+    def run():
+        np.histogram2d(col, row, bins=[512, 512], range=[[0, 512], [0, 512]])
+        np.histogram2d(col, row, bins=[512, 512], range=[[0, 512], [0, 512]], weights=tot)
+        np.histogram(tot, bins=128, range=[-0.5, 127.5])
+        np.histogram2d(col, row, bins=[32, 32], range=[[0, 512], [0, 512]])
+        np.histogramdd((col, row, charge), bins=[64, 64, 50], range=[[0, 64], [0, 64], [-0.5, 49.5]])
+    return run, hits.shape[0]
+
+
+def _threshold_scan(scale, tmp_dir, **scan_config):
+    ''' Threshold scan of the first columns with the emulator answering the injections, 80 charges '''
+    import yaml
+    from tjmonopix2.scans.scan_threshold import ThresholdScan, scan_configuration
+    from tjmonopix2.system.scan_base import TESTBENCH_DEFAULT_FILE
+    with open(TESTBENCH_DEFAULT_FILE) as f:
+        bench_config = yaml.full_load(f)
+    bench_config['general'].update({'readout_system': 'emulator', 'output_directory': tmp_dir})
+    bench_config['analysis']['skip'] = True
+    bench_config['emulator']['injection'] = {'threshold': 20., 'threshold_spread': 1.5, 'noise': 1., 'delay': 0.001, 'seed': 0}
+    n_columns = max(1, int(8 * scale))
+    scan_config = dict(scan_configuration, start_column=0, stop_column=n_columns, n_injections=50, VCAL_HIGH=80, VCAL_LOW_start=80, VCAL_LOW_stop=0,
+                       VCAL_LOW_step=-1, load_tdac_from=None, **scan_config)
+
+    def run():
+        with ThresholdScan(scan_config=scan_config, bench_config=bench_config) as scan:
+            scan.start()
+    return run, n_columns * 512 * 80
+
+
+@benchmark('pixel charges', max_repeat=1)
+def threshold_scan(scale, tmp_dir):
+    return _threshold_scan(scale, tmp_dir)
+
+
+@benchmark('pixel charges', max_repeat=1)
+def threshold_scan_adaptive(scale, tmp_dir):
+    ''' Same pixel charge combinations as threshold_scan, the injected mask steps are logged by the scan '''
+    return _threshold_scan(scale, tmp_dir, adaptive=True)
+
+
+def run_benchmark(setup, scale=1., repeat=5, min_time=0., warm_up=True):
+    ''' Run the timed function of a benchmark repeat times (at least min_time seconds in total) '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        func, n_items = setup(scale, tmp_dir)
+        if warm_up:
+            func()  # numba compilation, caches
+        times = []
+        start = time.perf_counter()
+        while len(times) < repeat or time.perf_counter() - start < min_time:
+            t = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t)
+    return {'n_items': n_items, 'repeat': len(times), 'min': min(times), 'median': float(np.median(times)),
+            'mean': float(np.mean(times)), 'std': float(np.std(times)), 'items_per_second': n_items / min(times)}
+
+
+def get_machine_info():
+    ''' Machine and software versions of the benchmark run '''
+    import numba
+    import tables as tb
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'node': platform.node(), 'machine': platform.machine(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'system': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__, 'numba': numba.__version__,
+            'tables': tb.__version__, 'commit': commit, 'date': datetime.datetime.now().isoformat()}
+
+
+def compare(results, reference):
+    ''' Print the speed of the results relative to the reference results '''
+    print('%-28s %14s %14s %8s' % ('benchmark', 'reference [s]', 'this [s]', 'speedup'))
+    for name, result in results['benchmarks'].items():
+        if name in reference['benchmarks']:
+            t_ref = reference['benchmarks'][name]['min']
+            print('%-28s %14.4g %14.4g %7.2fx' % (name, t_ref, result['min'], t_ref / result['min']))
+
+
+def main(filter=None, scale=1., repeat=5, min_time=0., output_file=None, reference_file=None):
+    results = {'machine': get_machine_info(), 'scale': scale, 'benchmarks': OrderedDict()}
+    for name, (setup, unit, max_repeat) in BENCHMARKS.items():
+        if filter and filter not in name:
+            continue
+        if max_repeat is None:
+            result = run_benchmark(setup, scale=scale, repeat=repeat, min_time=min_time)
+        else:  # slow benchmarks without numba compilation
+            result = run_benchmark(setup, scale=scale, repeat=min(repeat, max_repeat), warm_up=False)
+        result['unit'] = unit
+        results['benchmarks'][name] = result
+        print('%-28s %10.4g s (median %10.4g s)  %10.3g %s/s' % (name, result['min'], result['median'], result['items_per_second'], unit))
+
+    if output_file:
+        with open(output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    if reference_file:
+        with open(reference_file) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the data path with synthetic data')
+    parser.add_argument('-k', '--filter', help='Only run benchmarks with this string in the name')
+    parser.add_argument('-s', '--scale', type=float, default=1., help='Scale factor of the data set sizes')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Minimum number of timed runs per benchmark')
+    parser.add_argument('-t', '--min_time', type=float, default=0., help='Minimum timed duration per benchmark [s]')
+    parser.add_argument('-o', '--output_file', help='Store the results in this JSON file')
+    parser.add_argument('-c', '--compare', dest='reference_file', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+    main(filter=args.filter, scale=args.scale, repeat=args.repeat, min_time=args.min_time, output_file=args.output_file, reference_file=args.reference_file)
@@ -0,0 +1,177 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis.interpreter import RawDataInterpreter
+from tjmonopix2.scans.shift_and_inject import shift_and_inject, shift_and_inject_scan_params
+from tjmonopix2.system.emulator import DAQEmulator, EmulatedFifo
+from tjmonopix2.system.fifo_readout import FifoReadout
+from tjmonopix2.system.tjmonopix2 import TJMonoPix2
+
+
+def _read_all(fifo, timeout=5.):
+    data, deadline = [], time.time() + timeout
+    while not fifo.exhausted and time.time() < deadline:
+        data.append(fifo.get_data())
+    data.append(fifo.get_data())
+    return np.concatenate(data)
+
+
+def test_replay_raw_data_file(tmp_path) -> None:
+    raw_data = np.arange(2500, dtype=np.uint32)
+    filename = str(tmp_path / 'raw_data.h5')
+    with tb.open_file(filename, 'w') as out_file:
+        out_file.create_earray(out_file.root, name='raw_data', obj=raw_data)
+
+    daq = DAQEmulator(bench_config={'emulator': {'raw_data_file': filename, 'loop': False}})
+    daq.init()
+    assert daq['FIFO']['FIFO_SIZE'] == 0  # Receiver disabled, no data
+    daq.rx_channels['rx0'].set_en(True)
+    assert np.array_equal(_read_all(daq['FIFO']), raw_data)
+
+
+def test_fifo_rate_and_bursts() -> None:
+    source = (np.full(100, i, dtype=np.uint32) for i in range(1000))
+    fifo = EmulatedFifo(source, rate=2e5, burst_period=0.1, duty_cycle=0.5)
+    time.sleep(0.2)
+    n_words = fifo.get_data().shape[0]
+    assert 1.5e4 <= n_words <= 3e4  # 0.1 s on time
+
+    fifo = EmulatedFifo([np.arange(1000, dtype=np.uint32)], rate=1e9, depth=100)
+    time.sleep(0.01)
+    assert fifo.get_data().shape[0] == 100
+    assert fifo.n_lost_words == 900
+
+
+def test_register_read_back() -> None:
+    daq = DAQEmulator(bench_config={}, source=[])
+    chip = TJMonoPix2(daq, config=None)
+    chip.registers['ITHR'].write(64)
+    chip.registers['VCASP'].write(93)
+    chip.registers['ITHR'].write(65)
+    assert chip.registers['ITHR'].read() == 65
+    assert chip.registers['VCASP'].read() == 93
+    assert daq['FIFO'].get_data().shape[0] == 0
+
+
+def test_command_memory_reuse() -> None:
+    daq = DAQEmulator(bench_config={}, source=[])
+    chip = TJMonoPix2(daq, config=None)
+
+    indata = chip.inject(PulseStartCnfg=1, PulseStopCnfg=1500, repetitions=10, latency=1400)
+    uploaded = daq['cmd'].n_uploaded_bytes
+    assert uploaded == len(indata)
+    chip.inject(PulseStartCnfg=1, PulseStopCnfg=1500, repetitions=10, latency=1400)
+    assert daq['cmd'].n_uploaded_bytes == uploaded  # Same command: no upload
+    chip.registers['ITHR'].write(64)
+    chip.inject(PulseStartCnfg=1, PulseStopCnfg=1500, repetitions=10, latency=1400)
+    assert daq['cmd'].n_uploaded_bytes - uploaded < 30  # Only the bytes overwritten by the register write
+    assert list(daq['cmd']._memory[:len(indata)]) == indata
+    chip.inject(PulseStartCnfg=2, PulseStopCnfg=1500, repetitions=10, latency=1400)
+    assert list(daq['cmd']._memory[:len(indata)]) == chip.inject(PulseStartCnfg=2, PulseStopCnfg=1500, latency=1400, write=False)
+    assert chip.registers['ITHR'].read() == 64
+
+
+def test_command_memory_shared() -> None:
+    ''' Chips on one command encoder share the shadow of the command memory '''
+    daq = DAQEmulator(bench_config={}, source=[])
+    chip_0, chip_1 = TJMonoPix2(daq, chip_id=0, config=None), TJMonoPix2(daq, chip_id=1, config=None)
+
+    def memory(n):
+        return list(daq['cmd']._memory[:n])
+
+    inj_0, inj_1 = chip_0.inject(repetitions=10), chip_1.inject(repetitions=10)
+    assert inj_0 != inj_1 and memory(len(inj_1)) == inj_1
+    chip_0.inject(repetitions=10)
+    assert memory(len(inj_0)) == inj_0
+    chip_1.registers['ITHR'].write(64)
+    uploaded = daq['cmd'].n_uploaded_bytes
+    chip_0.inject(repetitions=10)
+    assert memory(len(inj_0)) == inj_0 and daq['cmd'].n_uploaded_bytes - uploaded < 30
+    assert chip_0.registers['ITHR'].read() == 64
+
+    daq['cmd'].set_data([0] * 10, addr=5)  # Direct write
+    chip_0.inject(repetitions=10)
+    assert memory(len(inj_0)) == inj_0
+    daq['cmd'].reset()  # Memory content unknown
+    uploaded = daq['cmd'].n_uploaded_bytes
+    chip_0.inject(repetitions=10)
+    assert memory(len(inj_0)) == inj_0 and daq['cmd'].n_uploaded_bytes - uploaded == len(inj_0)
+
+
+def test_write_registers() -> None:
+    daq = DAQEmulator(bench_config={}, source=[])
+    chip = TJMonoPix2(daq, config=None)
+
+    addresses, values = np.arange(18, 82), np.arange(64) * 1000
+    indata = chip.write_registers(addresses, values, write=False)
+    expected = []
+    for address, value in zip(addresses, values):
+        expected += chip._write_register(int(address), int(value), write=False) + chip.write_sync(write=False)
+    assert indata == expected
+
+    uploaded = daq['cmd'].n_uploaded_bytes
+    chip.write_registers(addresses, values)
+    assert np.array_equal(daq['cmd'].registers[18:82], values)
+    assert daq['cmd'].n_uploaded_bytes - uploaded <= len(indata)  # One upload
+    indata = chip.write_registers(np.add.outer([155, 171, 187, 203], np.arange(16)), 0xffff, n_sync=300)
+    assert len(indata) == 11 and all(len(data) <= 4000 and len(data) % 608 == 0 for data in indata)  # Whole register writes per upload
+    assert np.all(daq['cmd'].registers[155:219] == 0xffff)
+
+
+def test_synthetic_source() -> None:
+    daq = DAQEmulator(bench_config={'emulator': {'synthetic': {'n_events': 100, 'seed': 0}}})
+    daq.rx_channels['rx0'].set_en(True)
+    assert daq['FIFO'].get_data().shape[0] > 0
+
+
+def test_mask_outer_loop_occupancy() -> None:
+    ''' Scan parameter loop inside of the mask steps gives the same occupancy as the regular order '''
+    vcal_low_range = [120, 110, 100, 90]
+
+    def scan(mask_outer_loop):
+        daq = DAQEmulator(bench_config={'emulator': {'injection': {'threshold': 25., 'threshold_spread': 5., 'noise': 3., 'delay': 0.05, 'seed': 0}}})
+        daq.rx_channels['rx0'].set_en(True)
+        chip = TJMonoPix2(daq, config=None)
+        chip.registers['VH'].write(140)
+        chip.masks['enable'][:] = False
+        chip.masks['injection'][:] = False
+        chip.masks['enable'][0:2, 0:4] = True
+        chip.masks['injection'][0:2, 0:4] = True
+        chip.masks.update(force=True)
+        fifo_readout = FifoReadout(daq)
+        readouts = []
+        if mask_outer_loop:
+            def set_vcal_low(scan_param_id):
+                chip.registers['VL'].write(vcal_low_range[scan_param_id])
+            fifo_readout.start(callback=readouts.append, scan_param_id=0)
+            shift_and_inject_scan_params(SimpleNamespace(chip=chip, set_scan_param_id=fifo_readout.set_scan_param_id), n_injections=100,
+                                         scan_param_ids=range(len(vcal_low_range)), set_scan_param=set_vcal_low)
+            fifo_readout.stop()
+        else:
+            for scan_param_id, vcal_low in enumerate(vcal_low_range):
+                chip.registers['VL'].write(vcal_low)
+                fifo_readout.start(callback=readouts.append, scan_param_id=scan_param_id)
+                shift_and_inject(SimpleNamespace(chip=chip), n_injections=100)
+                fifo_readout.stop()
+
+        occ_hist = np.zeros((512, 512, len(vcal_low_range)), dtype=np.uint32)
+        interpreter = RawDataInterpreter()
+        for data, _, _, _, scan_param_id, _ in readouts:
+            hits = interpreter.interpret(data, np.zeros(data.shape[0] * 3, dtype=au.hit_dtype), scan_param_id)
+            np.add.at(occ_hist, (hits['col'], hits['row'], scan_param_id), 1)
+        return occ_hist
+
+    occ_hist = scan(mask_outer_loop=False)
+    assert np.all(occ_hist[0:2, 0:4, -1] > 0) and np.any(occ_hist[0:2, 0:4] < 100) and occ_hist[2:].sum() == 0
+    assert np.array_equal(scan(mask_outer_loop=True), occ_hist)
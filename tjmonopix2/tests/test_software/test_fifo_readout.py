@@ -0,0 +1,240 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import collections
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from tjmonopix2.system.fifo_readout import FifoReadout, ReadoutQueue
+
+
+class FakeFifo(dict):
+    def __init__(self):
+        super().__init__(FIFO_SIZE=0, RESET=0)
+        self.words = collections.deque()
+
+    def __getitem__(self, name):
+        if name == 'FIFO_SIZE':
+            return len(self.words) * 4  # bytes
+        return super().__getitem__(name)
+
+    def get_data(self):
+        n_words = len(self.words)
+        return np.array([self.words.popleft() for _ in range(n_words)], dtype=np.uint32)
+
+
+class FakeRx(object):
+    name = 'rx0'
+
+    def reset(self):
+        pass
+
+    def get_decoder_error_counter(self):
+        return 0
+
+    def get_lost_data_counter(self):
+        return 0
+
+
+class FakeDaq(dict):
+    def __init__(self):
+        super().__init__(FIFO=FakeFifo())
+        self.rx_channels = {'rx0': FakeRx()}
+
+
+def test_scan_param_id_tagging() -> None:
+    daq = FakeDaq()
+    fifo_readout = FifoReadout(daq)
+    readouts = []
+
+    fifo_readout.start(callback=readouts.append, scan_param_id=3)
+    daq['FIFO'].words.extend([1, 2, 3])
+    fifo_readout.set_scan_param_id(4)
+    daq['FIFO'].words.extend([4, 5])
+    fifo_readout.set_scan_param_id(5)
+    daq['FIFO'].words.extend([6])
+    fifo_readout.stop()
+
+    words = {}
+    for data, _, _, _, scan_param_id, _ in readouts:
+        words.setdefault(scan_param_id, []).extend(data.tolist())
+    assert words == {3: [1, 2, 3], 4: [4, 5], 5: [6]}
+
+
+def test_continuous_readout_drain() -> None:
+    daq = FakeDaq()
+    fifo_readout = FifoReadout(daq, readout_interval=0.5, continuous=True)
+    readouts = []
+
+    def slow_callback(data_tuple):
+        time.sleep(0.01)
+        readouts.append(data_tuple)
+
+    fifo_readout.start(callback=slow_callback, scan_param_id=0)
+    daq['FIFO'].words.extend([1, 2, 3])
+    assert fifo_readout.drain()
+    assert sum([readout[0].tolist() for readout in readouts], []) == [1, 2, 3]  # Data of the step handled
+    fifo_readout.set_scan_param_id(1)
+    daq['FIFO'].words.extend([4, 5])
+    assert fifo_readout.drain()
+    fifo_readout.stop()
+
+    # The readout with the new scan parameter id starts with an empty marker readout
+    tagged = [readout[0].tolist() for readout in readouts if readout[4] == 1]
+    assert tagged[0] == [] and sum(tagged, []) == [4, 5]
+
+
+def test_continuous_readout_drain_steady_data() -> None:
+    daq = FakeDaq()
+    fifo_readout = FifoReadout(daq, readout_interval=0.5, continuous=True)
+    readouts = []
+    stop = threading.Event()
+
+    def source():  # Data that never stops, e.g. noisy pixels
+        word = 0
+        while not stop.is_set():
+            daq['FIFO'].words.append(word)
+            word += 1
+            time.sleep(0.0001)
+
+    thread = threading.Thread(target=source)
+    fifo_readout.start(callback=readouts.append, scan_param_id=0)
+    thread.start()
+    try:
+        time.sleep(0.05)
+        for _ in range(3):
+            start = time.time()
+            assert fifo_readout.drain(timeout=5.)
+            assert time.time() - start < 1.
+    finally:
+        stop.set()
+        thread.join()
+        fifo_readout.stop()
+    words = np.concatenate([readout[0] for readout in readouts])
+    assert np.array_equal(words, np.arange(words.shape[0]))  # No data lost or reordered
+
+
+def test_adaptive_interval() -> None:
+    fifo_readout = FifoReadout(FakeDaq(), adaptive_interval=True, min_interval=0.001, max_interval=0.2, target_words=1000)
+
+    fifo_readout._adapt_interval(0, 0.05)
+    assert fifo_readout.current_interval == 0.2  # No data: longest interval
+    for _ in range(20):
+        fifo_readout._adapt_interval(500, 0.05)  # 10 kHz
+    assert np.isclose(fifo_readout.current_interval, 0.1, rtol=0.01)
+    fifo_readout._adapt_interval(5000, 0.1)
+    assert fifo_readout.current_interval == 0.001  # FIFO fill above target: back-to-back reads
+
+    readouts = []
+    fifo_readout.start(callback=readouts.append)
+    fifo_readout.daq['FIFO'].words.extend(range(2000))
+    fifo_readout.stop()
+    assert sum(len(readout[0]) for readout in readouts) == 2000
+    assert all(0.001 <= readout[5] <= 0.2 for readout in readouts)
+
+
+def _readout(value):
+    return (np.array([value], dtype=np.uint32), 0., 0., 0, 0)
+
+
+def test_readout_queue() -> None:
+    readout_queue = ReadoutQueue(maxsize=2)
+    received = []
+
+    def consumer():
+        while True:
+            item = readout_queue.get()
+            if item is None:
+                break
+            received.append((item[0][0], time.time()))
+
+    thread = threading.Thread(target=consumer)
+    thread.start()
+    start = time.time()
+    readout_queue.put(_readout(1))
+    time.sleep(0.05)
+    assert received and received[0][0] == 1 and received[0][1] - start < 0.05  # No polling delay
+    for value in range(2, 10):
+        readout_queue.put(_readout(value))
+    readout_queue.put(None)
+    thread.join(timeout=5)
+    assert [value for value, _ in received] == list(range(1, 10))
+
+    readout_queue.put(_readout(1))
+    readout_queue.put(_readout(2))
+    putter = threading.Thread(target=readout_queue.put, args=(_readout(3), ))
+    putter.start()
+    time.sleep(0.05)
+    assert putter.is_alive() and len(readout_queue) == 2  # Full queue blocks
+    assert readout_queue.get()[0][0] == 1
+    putter.join(timeout=5)
+    assert not putter.is_alive() and len(readout_queue) == 2
+    readout_queue.clear()
+    with pytest.raises(IndexError):
+        readout_queue.get(timeout=0.01)
+
+
+def test_readout_queue_policies(tmp_path) -> None:
+    data = [np.arange(i * 10, i * 10 + 10, dtype=np.uint32) for i in range(4)]  # 40 bytes each
+
+    readout_queue = ReadoutQueue(max_bytes=100, policy='drop')
+    assert [readout_queue.put((d, 0., 0., 0, 0)) for d in data] == [True, True, False, False]
+    status = readout_queue.get_status()
+    assert status['readouts'] == 2 and status['bytes'] == 80
+    assert status['dropped_readouts'] == 2 and status['dropped_words'] == 20
+
+    readout_queue = ReadoutQueue(max_bytes=100, policy='spill', spill_dir=str(tmp_path))
+    for i, d in enumerate(data):
+        readout_queue.put((d, 0., 0., 0, i))
+    status = readout_queue.get_status()
+    assert status['bytes'] == 80 and status['spilled_bytes'] == 80 and status['spilled_readouts'] == 2
+    assert len(list(tmp_path.iterdir())) == 2
+    for i, d in enumerate(data):
+        item = readout_queue.get()
+        assert np.array_equal(item[0], d) and item[4] == i
+    assert readout_queue.get_status()['spilled_bytes'] == 0
+    assert not list(tmp_path.iterdir())
+
+    # A readout larger than max_bytes fills the queue, the next readouts are spilled without waiting
+    readout_queue.put((np.zeros(100, dtype=np.uint32), 0., 0., 0, 0))
+    putter = threading.Thread(target=readout_queue.put, args=((data[0], 0., 0., 0, 1), ))
+    putter.start()
+    putter.join(timeout=1)
+    assert not putter.is_alive()
+    assert readout_queue.get_status()['spilled_readouts'] == 3
+    readout_queue.clear()
+
+    readout_queue = ReadoutQueue(max_bytes=100, policy='block')
+    readout_queue.put((data[0], 0., 0., 0, 0))
+    readout_queue.put((data[1], 0., 0., 0, 0))
+    putter = threading.Thread(target=readout_queue.put, args=((data[2], 0., 0., 0, 0), ))
+    putter.start()
+    time.sleep(0.05)
+    assert putter.is_alive()
+    readout_queue.get()
+    putter.join(timeout=5)
+    assert readout_queue.get_status()['bytes'] == 80
+
+    with pytest.raises(ValueError):
+        ReadoutQueue(policy='unknown')
+
+
+def test_data_buffer() -> None:
+    daq = FakeDaq()
+    fifo_readout = FifoReadout(daq, readout_interval=0.01)
+    fifo_readout.start(fill_buffer=True)
+    daq['FIFO'].words.extend(range(10))
+    time.sleep(0.1)
+    fifo_readout.stop(timeout=1)
+    data = fifo_readout.data
+    assert isinstance(data, collections.deque)
+    assert np.array_equal(np.concatenate([item[0] for item in data]), np.arange(10))
+    assert fifo_readout.data is data and len(fifo_readout.buffer) == 0
+    data.clear()
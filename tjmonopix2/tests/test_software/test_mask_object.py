@@ -0,0 +1,192 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import os
+
+import numpy as np
+import pytest
+
+from tjmonopix2.system.emulator import DAQEmulator
+from tjmonopix2.system.mask_cache import MaskStreamCache
+from tjmonopix2.system.tjmonopix2 import SHIFT_PATTERNS, DoubleShiftPattern, MaskObject, TJMonoPix2
+
+
+def _reference_update(masks, force=False):
+    ''' Command generation of MaskObject.update() with one loop iteration per pixel '''
+    masks._find_changes()
+    if force:
+        inj_write_mask = np.ones(masks.dimensions, bool)
+        pix_write_mask = np.ones(masks.dimensions, bool)
+    else:
+        inj_write_mask = masks.inj_to_write
+        pix_write_mask = masks.pix_to_write
+    inj_to_write = np.column_stack((np.where(inj_write_mask)))
+    pix_to_write = np.column_stack((np.where(pix_write_mask)))
+
+    data = []
+    indata = masks.chip.write_sync(write=False) * 10
+    if len(pix_to_write) > 0:
+        written = set()
+        for (col, row) in pix_to_write:
+            colgroup = int(col / 4)
+            if (colgroup, row) in written:
+                continue
+            indata += masks.chip._write_register(17, (colgroup & 0x7f) << 9 | (row & 0x1ff), write=False)
+            indata += masks.chip.registers["PIXEL_PORTAL"].get_write_command(masks.get_column_group_data(colgroup, row))
+            indata += masks.chip.write_sync(write=False)
+            written.add((colgroup, row))
+            if len(indata) > 4000:
+                masks.chip.write_command(indata)
+                data.append(indata)
+                indata = masks.chip.write_sync(write=False)
+        masks.chip.write_command(indata)
+        data.append(indata)
+    if len(inj_to_write) > 0:
+        written = set()
+        for (col, row) in inj_to_write:
+            colgroup = int(col / 16)
+            rowgroup = int(row / 16)
+            if (colgroup, rowgroup) in written:
+                continue
+            indata += masks.chip._write_register(82 + colgroup, masks.get_inj_column_group_data(colgroup))
+            indata += masks.chip._write_register(114 + rowgroup, masks.get_inj_row_group_data(rowgroup))
+            indata += masks.chip.write_sync(write=False)
+            written.add((colgroup, rowgroup))
+            if len(indata) > 4000:
+                masks.chip.write_command(indata)
+                data.append(indata)
+                indata = masks.chip.write_sync(write=False)
+        masks.chip.write_command(indata)
+        data.append(indata)
+
+    for name, mask in masks.items():
+        masks.was[name][:] = mask[:]
+    return data
+
+
+def _get_chip():
+    chip = TJMonoPix2(DAQEmulator(bench_config={}, source=[]), config=None)
+    commands = []
+    chip.write_command = lambda data, *args, **kwargs: commands.append(list(data))
+    return chip, commands
+
+
+def _set_masks(chip, seed, fraction):
+    rng = np.random.default_rng(seed)
+    chip.masks['enable'][:] = rng.random(chip.masks.dimensions) < fraction
+    chip.masks['injection'][:] = rng.random(chip.masks.dimensions) < fraction
+    chip.masks['tdac'][:] = rng.integers(0, 8, chip.masks.dimensions)
+
+
+@pytest.mark.parametrize('fraction', [0., 0.0001, 0.01, 0.5])
+def test_update_command_stream(fraction) -> None:
+    chip, commands = _get_chip()
+    ref_chip, ref_commands = _get_chip()
+    for step, force in enumerate([True, False]):
+        for c in (chip, ref_chip):
+            _set_masks(c, seed=step, fraction=fraction)
+        data = chip.masks.update(force=force)
+        ref_data = _reference_update(ref_chip.masks, force=force)
+        assert commands == ref_commands
+        assert data == ref_data
+        assert chip.registers['PIXEL_PORTAL']['value'] == ref_chip.registers['PIXEL_PORTAL']['value']
+        assert chip.registers['PIXEL_PORTAL'].changed == ref_chip.registers['PIXEL_PORTAL'].changed
+
+
+def test_update_shift_steps() -> None:
+    chip, commands = _get_chip()
+    ref_chip, ref_commands = _get_chip()
+    for c in (chip, ref_chip):
+        c.masks['tdac'][:] = np.random.default_rng(0).integers(0, 8, c.masks.dimensions)
+    for _, pattern in zip(range(10), DoubleShiftPattern((512, 512), mask_step=4)):
+        for c in (chip, ref_chip):
+            c.masks['enable'][:] = pattern
+            c.masks['injection'][:] = pattern
+        assert chip.masks.update() == _reference_update(ref_chip.masks)
+    assert commands == ref_commands
+
+
+def _get_shift_chip(cache_dir, n_cols=4):
+    chip, commands = _get_chip()
+    chip.masks.stream_cache = MaskStreamCache(cache_dir, max_entries=2)
+    chip.masks['enable'][:n_cols] = True
+    chip.masks['injection'][:n_cols] = True
+    chip.masks['tdac'][:] = np.random.default_rng(0).integers(0, 8, chip.masks.dimensions)
+    chip.masks.update(force=True)
+    del commands[:]
+
+    # Command data returned by update(), the stream without the extra writes of the injection registers
+    updates = []
+
+    def update(force=False):
+        data = MaskObject.update(chip.masks, force=force)
+        updates.extend(data)
+        return data
+    chip.masks.update = update
+    return chip, commands, updates
+
+
+def test_shift_stream_cache(tmp_path) -> None:
+    chip, _, updates = _get_shift_chip(str(tmp_path))
+    steps = [fe for fe, _ in chip.masks.shift(masks=['enable', 'injection'], cache=True)]
+    assert len(os.listdir(tmp_path)) == 1
+
+    # Same masks in another scan: command upload only
+    other_chip, commands, other_updates = _get_shift_chip(str(tmp_path))
+    assert [fe for fe, _ in other_chip.masks.shift(masks=['enable', 'injection'], cache=True)] == steps
+    assert commands == updates
+    assert not other_updates
+    for name, mask in other_chip.masks.items():
+        assert np.array_equal(other_chip.masks.was[name], mask)
+
+    # Different masks, different pattern: new entries, the least recently used entry is removed
+    other_chip.masks['tdac'][0, 0] ^= 1
+    assert [fe for fe, _ in other_chip.masks.shift(masks=['enable', 'injection'], cache=True)] == steps
+    assert other_updates
+    assert len(os.listdir(tmp_path)) == 2
+    chip.masks.stream_cache.load(chip.masks._get_shift_key(['enable', 'injection'], 'default', 4, True))
+    other_chip.masks['tdac'][0, 1] ^= 1
+    list(other_chip.masks.shift(masks=['enable', 'injection'], cache=True))
+    assert len(os.listdir(tmp_path)) == 2
+    assert chip.masks.stream_cache.load(chip.masks._get_shift_key(['enable', 'injection'], 'default', 4, True)) is not None
+
+
+def test_shift_memory_cache() -> None:
+    chip, commands, updates = _get_shift_chip(None)
+    steps = [fe for fe, _ in chip.masks.shift(masks=['enable', 'injection'], cache=True)]
+    n_updates = len(updates)
+    del commands[:]
+    assert [fe for fe, _ in chip.masks.shift(masks=['enable', 'injection'], cache=True)] == steps
+    assert commands == updates
+    assert len(updates) == n_updates
+
+
+@pytest.mark.parametrize('pattern, mask_step', [(pattern, 4) for pattern in SHIFT_PATTERNS] + [('interleaved', 2)])
+def test_shift_patterns(pattern, mask_step) -> None:
+    chip, _ = _get_chip()
+    cols = [0, 1, 130, 230, 460, 500]  # All front-ends
+    chip.masks['enable'][cols, :] = True
+    chip.masks['injection'][cols, :] = True
+    n_steps = chip.masks.get_mask_steps(pattern=pattern, mask_step=mask_step)
+    step_map = chip.masks.get_mask_step_map(pattern=pattern, mask_step=mask_step)
+    original_injection = chip.masks['injection'].copy()
+
+    injected = np.zeros(chip.masks.dimensions, int)
+    steps = 0
+    for fe, _ in chip.masks.shift(masks=['enable', 'injection'], pattern=pattern, mask_step=mask_step):
+        steps += 1
+        if fe == 'skipped':
+            continue
+        injection = chip.masks['injection']
+        # Injection is enabled per column and row: no other pixels than the shifted ones are injected
+        assert np.array_equal(np.logical_and.outer(injection.any(axis=1), injection.any(axis=0)), injection)
+        assert np.array_equal(chip.masks['enable'], injection)
+        assert np.array_equal(np.logical_and(step_map == steps - 1, original_injection), injection)
+        injected += injection
+    assert steps == n_steps
+    assert np.array_equal(injected, chip.masks['injection'].astype(int))  # Every pixel once
+    assert n_steps == {'default': 4 * 2048, 'double': 4 * 2048, 'parallel': 2048, 'interleaved': 128 * mask_step}[pattern]
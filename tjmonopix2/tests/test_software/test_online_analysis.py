@@ -0,0 +1,282 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import time
+
+import numpy as np
+
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis import online as oa
+
+
+def _bin2gray(value):
+    return value ^ (value >> 1)
+
+
+def _hit_symbols(col, row, le=0, te=1):
+    le_gray, te_gray = _bin2gray(le), _bin2gray(te)
+    return [(col >> 1) & 0xff,
+            (le_gray << 1) | (te_gray >> 6),
+            ((te_gray & 0x3f) << 2) | ((col & 0x01) << 1) | (row >> 8),
+            row & 0xff]
+
+
+def _encode_symbols(symbols):
+    ''' Pack 9 bit symbols into TJ-Monopix2 data words, padded with IDLE '''
+    symbols = symbols + [0x13c] * (-len(symbols) % 3)
+    symbols = np.array(symbols, dtype=np.uint32).reshape(-1, 3)
+    return 0x40000000 | (symbols[:, 0] << 18) | (symbols[:, 1] << 9) | symbols[:, 2]
+
+
+def _encode_hits(cols, rows, le=0, te=1):
+    ''' Encode hits as TJ-Monopix2 data words, one frame per hit '''
+    symbols = []
+    for col, row in zip(cols, rows):
+        symbols += [0x1bc] + _hit_symbols(col, row, le, te) + [0x17c]
+    return _encode_symbols(symbols)
+
+
+def test_scurve_histogramming() -> None:
+    hist_scurve = oa.ScurveHistogramming(n_scan_params=3)
+    try:
+        hist_scurve.add(_encode_hits([1, 300, 511], [0, 256, 511]), meta_data={'scan_param_id': 0})
+        hist_scurve.add(_encode_hits([300, 300], [256, 256]), meta_data={'scan_param_id': 2})
+        hist = hist_scurve.get(timeout=5, reset=False).copy()
+    finally:
+        hist_scurve.close()
+
+    assert hist.shape == (512, 512, 3)
+    assert hist.sum() == 5
+    assert hist[1, 0, 0] == 1
+    assert hist[511, 511, 0] == 1
+    assert hist[300, 256, 0] == 1
+    assert hist[300, 256, 2] == 2
+
+
+def test_scurve_histogramming_untagged() -> None:
+    ''' Readouts without scan parameter id are skipped, tagged readouts are still histogrammed '''
+    hist_scurve = oa.ScurveHistogramming(n_scan_params=2)
+    try:
+        hist_scurve.add(_encode_hits([1], [2]), meta_data={'scan_param_id': 0})
+        hist_scurve.add(_encode_hits([3, 3], [4, 4]))
+        hist_scurve.add(_encode_hits([5], [6]), meta_data={'timestamp_stop': time.time()})
+        hist_scurve.add(_encode_hits([1, 7], [2, 8]), meta_data={'scan_param_id': 1})
+        hist = hist_scurve.get(timeout=5, reset=False).copy()
+    finally:
+        hist_scurve.close()
+
+    assert hist.sum() == 3
+    assert hist[1, 2, 0] == 1 and hist[1, 2, 1] == 1 and hist[7, 8, 1] == 1
+
+
+def test_scurve_maps() -> None:
+    n_injections = 100
+    x = np.arange(0, 50, 2)
+    thr = np.array([[20., 30.], [10., 40.]])
+    sigma = np.array([[2., 3.], [1.5, 4.]])
+    occ_hist = np.round(au.scurve(x[np.newaxis, np.newaxis, :], n_injections, thr[..., np.newaxis], sigma[..., np.newaxis]))
+
+    threshold_map, noise_map = oa.get_scurve_maps(occ_hist, x, n_injections)
+    assert np.allclose(threshold_map, thr, atol=1.1)  # Fit less estimate is biased by half a step
+    assert np.allclose(noise_map, sigma, rtol=0.2)
+    # Vectorized noise calculation agrees with 1D calculation
+    assert np.isclose(noise_map[1, 1], au.get_noise(x, occ_hist[1, 1], n_injections))
+    # Decreasing charge order gives the same result
+    threshold_map_rev, _ = oa.get_scurve_maps(occ_hist[..., ::-1], x[::-1], n_injections)
+    assert np.allclose(threshold_map_rev, threshold_map)
+
+    assert not oa.is_saturated(occ_hist, n_injections, n_steps=15)
+    assert oa.is_saturated(occ_hist, n_injections)
+    # A dead pixel does not prevent saturation if enough pixels saturated
+    assert oa.is_saturated(occ_hist, n_injections, min_fraction=0.75, sel=np.array([[True, True], [True, True]]))
+
+
+def test_ring_buffer() -> None:
+    ring = oa.RawDataRingBuffer(size=16, max_chunks=4)
+    raw_data = _encode_hits([10, 20, 30], [1, 2, 3])  # 6 words
+    assert ring.read() is None and ring.empty()
+
+    # Fill, consume and write again so that the third chunk wraps around
+    assert ring.write(raw_data, tag=0)
+    assert ring.write(raw_data, tag=1)
+    segments, tag, _, _, _ = ring.read()
+    assert tag == 0 and len(segments) == 1 and np.array_equal(segments[0], raw_data)
+    ring.release()
+    assert ring.write(raw_data, tag=2)
+    ring.read()
+    ring.release()
+    segments, tag, _, _, _ = ring.read()
+    assert tag == 2 and len(segments) == 2
+    assert np.array_equal(np.concatenate(segments), raw_data)
+
+    # Decoding the two segments gives the same histogram as the whole readout
+    hist = np.zeros((512, 512), dtype=np.uint32)
+    kwargs = (None, oa.get_decoder_state())
+    for segment in segments:
+        kwargs = oa.histogram(segment, hist, *kwargs)
+    assert hist.sum() == 3 and hist[20, 2] == 1
+
+    # Full buffer: back-pressure and overflow are counted, data is dropped
+    assert ring.write(raw_data, tag=3)
+    assert not ring.write(raw_data, tag=4, timeout=0.01)
+    assert not ring.write(np.zeros(17, dtype=np.uint32))
+    status = ring.get_status()
+    assert status['overflow_chunks'] == 2
+    assert status['overflow_words'] == 23
+    assert status['back_pressure'] == 2
+    assert status['fill'] == 12 and status['max_fill'] == 12
+    ring.release()
+    assert ring.read()[1] == 3
+
+
+def test_multi_worker_histogramming() -> None:
+    rng = np.random.default_rng(0)
+    symbols, expected = [], np.zeros((512, 512), dtype=np.uint32)
+    for _ in range(500):  # Frames with several hits, not aligned to the 32 bit words
+        cols, rows = rng.integers(0, 512, size=(2, rng.integers(1, 4)))
+        symbols.append(0x1bc)
+        for col, row in zip(cols, rows):
+            symbols += _hit_symbols(col, row)
+            expected[col, row] += 1
+        symbols += [0x17c] + [0x13c] * rng.integers(0, 3)
+    raw_data = _encode_symbols(symbols)
+    assert oa.get_frame_boundary_symbols(raw_data[:1]) == (0x1bc, raw_data[0] & 0x1ff)
+    assert oa.get_frame_boundary_symbols(raw_data[:0]) == (-1, -1)
+
+    hist_occ = oa.OccupancyHistogramming(n_workers=3)
+    try:
+        for readout in np.split(raw_data, np.sort(rng.choice(raw_data.shape[0], 200, replace=False))):
+            hist_occ.add(readout)
+        hist = hist_occ.get(timeout=10)
+        status = hist_occ.get_status()
+    finally:
+        hist_occ.close()
+
+    assert np.array_equal(hist, expected)
+    assert all(s['max_fill'] > 0 for s in status)  # All workers got data
+
+
+def test_double_buffered_reset() -> None:
+    hist_occ = oa.OccupancyHistogramming()
+    try:
+        hist_occ.add(_encode_hits([1, 2], [3, 4]))
+        hist = hist_occ.get(timeout=5)
+        assert hist.sum() == 2 and hist[1, 3] == 1
+        assert hist_occ.get(timeout=5).sum() == 0
+        hist_occ.add(_encode_hits([5], [6]))
+        hist_occ.reset(timeout=5)
+        hist_occ.add(_encode_hits([7, 7], [8, 8]))
+        hist = hist_occ.get(timeout=5, reset=False)
+        assert hist.sum() == 2 and hist[7, 8] == 2
+        assert all(not buffer.any() for buffer in hist_occ._hists[0] if buffer is not hist)  # Inactive buffer is empty
+    finally:
+        hist_occ.close()
+
+
+def test_tot_histogramming() -> None:
+    raw_data = np.concatenate([_encode_hits([10, 10, 20], [5, 5, 6], le=3, te=10),
+                               _encode_hits([10], [5], le=120, te=2)])  # ToT wraps around
+
+    hits = oa.get_hit_buffer(None, raw_data.shape[0])
+    state = oa.get_decoder_state()
+    n_hits = oa.decode(raw_data[:3], hits, state)  # Hit split between readouts
+    n_hits += oa.decode(raw_data[3:], hits[n_hits:], state)
+    assert n_hits == 4
+    assert np.array_equal(hits['col'][:4], [10, 10, 20, 10]) and np.array_equal(hits['te'][:4], [10, 10, 10, 2])
+
+    hist_tot, hist_spectrum = oa.TotHistogramming(), oa.TotSpectrumHistogramming()
+    try:
+        for h in [hist_tot, hist_spectrum]:
+            h.add(raw_data)
+        tot = hist_tot.get(timeout=5)
+        spectrum = hist_spectrum.get(timeout=5)
+    finally:
+        hist_tot.close()
+        hist_spectrum.close()
+
+    mean_tot = oa.get_mean_tot(tot)
+    assert tot[10, 5, 1] == 3 and tot[20, 6, 1] == 1
+    assert np.isclose(mean_tot[10, 5], (7 + 7 + 10) / 3.) and mean_tot[20, 6] == 7
+    assert np.isnan(mean_tot[0, 0])
+    assert spectrum.shape == (128,) and spectrum[7] == 3 and spectrum[10] == 1
+
+
+def test_tickets() -> None:
+    hist_occ = oa.OccupancyHistogramming(n_workers=2)
+    try:
+        assert hist_occ.is_done()
+        first = hist_occ.add(_encode_hits([1], [1]))
+        second = hist_occ.add(_encode_hits([2] * 1000, [2] * 1000))
+        assert second == first + 1
+        assert hist_occ.wait(until=first, timeout=5)
+        hist = hist_occ.get(reset=False, timeout=5)  # Waits for all added readouts
+        assert hist_occ.is_done(second)
+        assert hist[1, 1] == 1 and hist[2, 2] == 1000
+    finally:
+        hist_occ.close()
+
+
+def test_metrics() -> None:
+    hist_occ = oa.OccupancyHistogramming(n_workers=2)
+    try:
+        metrics = hist_occ.get_metrics()
+        assert metrics['readouts'] == 0 and np.isnan(metrics['latency_p50'])
+        raw_data = _encode_hits([1, 2, 3], [4, 5, 6])
+        for _ in range(10):
+            hist_occ.add(raw_data, meta_data={'timestamp_stop': time.time() - 1.})
+        hist_occ.get(timeout=5)
+        metrics = hist_occ.log_metrics()
+    finally:
+        hist_occ.close()
+
+    assert metrics['queue_words'] == 0 and metrics['queue_readouts'] == 0
+    assert metrics['readouts'] == 10 and metrics['words'] == 10 * raw_data.shape[0]
+    assert metrics['words_per_second'] > 0
+    assert 0 <= metrics['latency_p50'] <= metrics['latency_p99']
+    assert 1. <= metrics['lag_p50'] < 10.
+
+
+class _FailingHistogramming(oa.OnlineHistogrammingBase):
+    ''' Counts the data words, fails for readouts with more than 10 words '''
+
+    def __init__(self):
+        super().__init__(shape=(1, ))
+        self.init()
+
+    def analysis_function(self, raw_data, hist):
+        if raw_data.shape[0] > 10:
+            raise ValueError('Readout too long')
+        hist[0] += raw_data.shape[0]
+        return ()
+
+
+def test_tagged_readouts_without_scan_param_id() -> None:
+    ''' Histogrammers that do not use the scan parameter id get tagged readouts as raw data '''
+    hist_occ = oa.OccupancyHistogramming()
+    try:
+        hist_occ.add(_encode_hits([1, 2], [3, 4]), meta_data={'scan_param_id': 1})
+        hist_occ.add(_encode_hits([1], [3]))
+        hist = hist_occ.get(timeout=5, reset=False)
+    finally:
+        hist_occ.close()
+
+    assert hist.sum() == 3 and hist[1, 3] == 2 and hist[2, 4] == 1
+
+
+def test_worker_error(caplog) -> None:
+    ''' An analysis error skips the readout and is reported, the worker continues '''
+    hist_fail = _FailingHistogramming()
+    try:
+        hist_fail.add(_encode_hits([1], [1]))
+        hist_fail.add(_encode_hits([1] * 10, [1] * 10))
+        hist_fail.add(_encode_hits([1], [1]), meta_data={'scan_param_id': 0})
+        hist = hist_fail.get(timeout=5, reset=False).copy()
+    finally:
+        hist_fail.close()
+
+    assert hist[0] == 2 * _encode_hits([1], [1]).shape[0]
+    assert 'Online analysis failed for 1 readouts' in caplog.text
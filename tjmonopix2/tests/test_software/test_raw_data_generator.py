@@ -0,0 +1,79 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis import raw_data_generator as rdg
+from tjmonopix2.analysis.analysis import Analysis
+from tjmonopix2.analysis.interpreter import RawDataInterpreter
+
+
+def _interpret(raw_data):
+    interpreter = RawDataInterpreter()
+    hits = interpreter.interpret(raw_data, np.zeros(raw_data.shape[0] * 3, dtype=au.hit_dtype), 0)
+    return interpreter, hits
+
+
+def test_round_trip_interpreter() -> None:
+    hits, raw_data = rdg.generate_raw_data(2000, n_clusters=1.5, cluster_size=3., seed=0,
+                                           tlu_rate=1., tdc_rate=0.5, timestamp_rate=0.2)
+    interpreter, interpreted = _interpret(raw_data)
+    assert interpreter.get_error_count() == 0
+    assert interpreter.get_n_triggers() == 2000
+
+    pixel_hits = interpreted[interpreted['col'] < 1022]
+    for name in ['col', 'row', 'le', 'te']:
+        assert np.array_equal(pixel_hits[name], hits[name])
+    # One frame per event with hits
+    frame = np.cumsum(np.bincount(hits['event'], minlength=2000) > 0) - 1
+    assert np.array_equal(pixel_hits['token_id'], frame[hits['event']])
+    # TLU word with the event number before every frame
+    tlu = interpreted[interpreted['col'] == 1023]
+    assert np.array_equal(tlu['token_id'], np.arange(2000))
+    assert interpreter.get_n_tdc() == np.count_nonzero(interpreted['col'] == 1022)
+    hist_occ = np.zeros((512, 512), dtype=np.uint32)
+    np.add.at(hist_occ, (hits['col'], hits['row']), 1)
+    assert np.array_equal(interpreter.get_histograms()[0][:, :, 0], hist_occ)
+
+
+def test_edge_cases() -> None:
+    hits = rdg.generate_hits(100, n_clusters=0.)
+    assert hits.shape[0] == 0
+    assert rdg.encode_events(hits, n_events=100).shape[0] == 0
+
+    hits = np.zeros(2, dtype=rdg.hit_dtype)
+    hits['event'] = [1, 1]
+    hits['col'], hits['row'] = [0, 511], [511, 0]
+    hits['le'], hits['te'] = [127, 0], [0, 127]
+    raw_data = rdg.encode_events(hits, n_events=3)
+    assert raw_data.shape[0] == 4  # SOF + 8 hit symbols + EOF, padded
+    interpreted = _interpret(raw_data)[1]
+    assert interpreted[['col', 'row', 'le', 'te']].tolist() == [(0, 511, 127, 0), (511, 0, 0, 127)]
+
+
+def test_write_raw_data_file(tmp_path) -> None:
+    filename = str(tmp_path / 'synthetic.h5')
+    hits_0, raw_data_0 = rdg.generate_raw_data(1000, seed=1, cluster_size=2.)
+    hits_1, raw_data_1 = rdg.generate_raw_data(1000, seed=2, cluster_size=2.)
+    rdg.write_raw_data_file(filename, [raw_data_0, raw_data_1], readout_words=500, scan_config={'n_injections': 100})
+
+    with tb.open_file(filename, 'r') as in_file:
+        meta_data = in_file.root.meta_data[:]
+        assert in_file.root.raw_data.nrows == raw_data_0.shape[0] + raw_data_1.shape[0]
+        assert np.all(meta_data['data_length'] <= 500)
+        assert np.array_equal(meta_data['index_start'][1:], meta_data['index_stop'][:-1])
+        assert set(meta_data['scan_param_id']) == {0, 1}
+
+    with Analysis(raw_data_file=filename) as a:
+        assert a.scan_config['n_injections'] == 100
+        a.analyze_data()
+    with tb.open_file(filename[:-3] + '_interpreted.h5', 'r') as in_file:
+        hits = in_file.root.Dut[:]
+    assert np.array_equal(hits['col'], np.concatenate([hits_0['col'], hits_1['col']]))
+    assert np.array_equal(hits['scan_param_id'], np.repeat([0, 1], [hits_0.shape[0], hits_1.shape[0]]))
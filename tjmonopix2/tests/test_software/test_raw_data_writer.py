@@ -0,0 +1,80 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.system.raw_data_writer import RawDataBatch, RawDataWriter
+from tjmonopix2.system.scan_base import MetaTable
+
+
+def _readout(start, n_words, scan_param_id=0):
+    return (np.arange(start, start + n_words, dtype=np.uint32), float(start), float(start + 1), 0, scan_param_id, 0.05)
+
+
+def _create_file(filename):
+    h5_file = tb.open_file(filename, 'w')
+    raw_data_earray = h5_file.create_earray(h5_file.root, name='raw_data', atom=tb.UInt32Atom(), shape=(0,))
+    meta_data_table = h5_file.create_table(h5_file.root, name='meta_data', description=MetaTable)
+    return h5_file, raw_data_earray, meta_data_table
+
+
+def test_raw_data_batch(tmp_path) -> None:
+    h5_file, raw_data_earray, meta_data_table = _create_file(str(tmp_path / 'raw_data.h5'))
+    with h5_file:
+
+        batch = RawDataBatch(max_words=100, max_time=1e6)
+        assert not batch.add(_readout(0, 40), 0)
+        assert not batch.add(_readout(40, 0), 0)
+        assert batch.add(_readout(40, 60, scan_param_id=1), 1)
+        batch.write(raw_data_earray, meta_data_table)
+        assert len(batch) == 0 and batch.n_words == 0
+
+        batch.add(_readout(100, 10, scan_param_id=2), 2)
+        batch.write(raw_data_earray, meta_data_table)
+        batch.write(raw_data_earray, meta_data_table)  # Empty batch
+
+        assert np.array_equal(raw_data_earray[:], np.arange(110, dtype=np.uint32))
+        meta_data = meta_data_table[:]
+        assert meta_data['index_start'].tolist() == [0, 40, 40, 100]
+        assert meta_data['index_stop'].tolist() == [40, 40, 100, 110]
+        assert meta_data['data_length'].tolist() == [40, 0, 60, 10]
+        assert meta_data['scan_param_id'].tolist() == [0, 0, 1, 2]
+        assert meta_data['timestamp_start'].tolist() == [0., 40., 40., 100.]
+        assert np.allclose(meta_data['readout_interval'], 0.05)
+
+    # Write every readout
+    assert RawDataBatch(max_words=0).add(_readout(0, 1), 0)
+    assert RawDataBatch(max_time=0).add(_readout(0, 1), 0)
+
+
+def test_raw_data_writer(tmp_path) -> None:
+    filename = str(tmp_path / 'raw_data.h5')
+    _create_file(filename)[0].close()
+
+    writer = RawDataWriter(filename, ring_size=2 ** 10, batch_words=300, batch_interval=1e6)
+    writer.start()
+    try:
+        for i in range(20):  # More data than fits into the ring buffer
+            assert writer.write(_readout(i * 100, 100, scan_param_id=i // 10), i // 10)
+        writer.flush(timeout=30.)
+        assert writer.nrows == 2000
+        writer.append_table('metrics', np.ones(2, dtype=[('words', np.int64)]), title='Metrics')
+        writer.write(_readout(2000, 50, scan_param_id=2), 2)
+    finally:
+        writer.close(timeout=30.)
+    assert writer.process is None
+
+    with tb.open_file(filename, 'r') as h5_file:
+        assert np.array_equal(h5_file.root.raw_data[:], np.arange(2050, dtype=np.uint32))
+        meta_data = h5_file.root.meta_data[:]
+        assert meta_data.shape[0] == 21
+        assert np.array_equal(meta_data['index_start'], np.arange(21) * 100)
+        assert np.array_equal(meta_data['scan_param_id'], np.arange(21) // 10)
+        assert np.array_equal(meta_data['timestamp_start'], np.arange(21) * 100.)
+        assert np.allclose(meta_data['readout_interval'], 0.05)
+        assert h5_file.root.metrics[:]['words'].tolist() == [1, 1]
@@ -0,0 +1,113 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import numpy as np
+import tables as tb
+
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis import online as oa
+from tjmonopix2.analysis import raw_data_generator as rdg
+from tjmonopix2.analysis.analysis import Analysis
+from tjmonopix2.analysis.threshold_cache import ThresholdCache
+from tjmonopix2.scans.scan_threshold import ThresholdScan
+
+
+def test_fit_scurve_start_values() -> None:
+    n_injections = 100
+    x = np.arange(0, 100, 1.)
+    y = np.round(au.scurve(x, n_injections, 42.3, 2.1))
+
+    mu, sigma, _ = au.fit_scurve(y, x, n_injections, sigma_0=1.)
+    mu_ws, sigma_ws, _ = au.fit_scurve(y, x, n_injections, sigma_0=2., mu_0=42., fit_window=10.)
+    assert np.isclose(mu_ws, 42.3, atol=0.1) and np.isclose(sigma_ws, 2.1, atol=0.2)
+    assert np.isclose(mu_ws, mu, atol=0.05) and np.isclose(sigma_ws, sigma, atol=0.05)
+
+    # Wrong start values fall back to fit of the full range
+    mu_fb, sigma_fb, _ = au.fit_scurve(y, x, n_injections, sigma_0=2., mu_0=80., fit_window=5.)
+    assert np.isclose(mu_fb, mu) and np.isclose(sigma_fb, sigma)
+
+
+def test_fit_adaptive_scan(tmp_path) -> None:
+    ''' Coarse scan of all pixels and fine scan within the threshold windows like ThresholdScan(adaptive=True) '''
+    rng = np.random.default_rng(0)
+    n_injections = 100
+    charges = np.arange(0., 102., 2.)
+    coarse_ids = np.arange(0, charges.shape[0], 4)
+    sel = np.zeros((512, 512), dtype=bool)
+    sel[:4, :5] = True
+    mu = np.where(sel, rng.uniform(30., 70., sel.shape), 0.)
+    sigma = np.where(sel, rng.uniform(1.5, 3., sel.shape), 1.)
+
+    def inject(scan_param_id, pixels):
+        occ = rng.binomial(n_injections, au.scurve(charges[scan_param_id], 1., mu[pixels], sigma[pixels]))
+        hits = np.zeros(occ.sum(), dtype=rdg.hit_dtype)
+        hits['event'] = np.arange(hits.shape[0])
+        hits['col'], hits['row'] = np.repeat(np.nonzero(pixels)[0], occ), np.repeat(np.nonzero(pixels)[1], occ)
+        hits['te'] = 10
+        occ_hist[pixels, scan_param_id] = occ
+        return rdg.encode_events(hits)
+
+    occ_hist = np.zeros((512, 512, charges.shape[0]), dtype=np.uint32)
+    injected = np.zeros(occ_hist.shape, dtype=bool)
+    raw_data = [np.zeros(0, dtype=np.uint32)] * charges.shape[0]
+    for scan_param_id in coarse_ids:
+        injected[..., scan_param_id] = sel
+        raw_data[scan_param_id] = inject(scan_param_id, sel)
+    threshold, noise = oa.get_scurve_maps(occ_hist[..., coarse_ids], charges[coarse_ids], n_injections)
+    step_map = np.repeat(np.arange(512)[:, np.newaxis], 512, axis=1)  # One mask step per column
+    steps, step_low, step_high = ThresholdScan._get_step_windows(step_map[sel], threshold[sel], noise[sel],
+                                                                 coarse_step=charges[coarse_ids[1]] - charges[coarse_ids[0]])
+    for scan_param_id in np.setdiff1d(np.arange(charges.shape[0]), coarse_ids):
+        fine_steps = steps[(step_low <= charges[scan_param_id]) & (charges[scan_param_id] <= step_high)]
+        injected[..., scan_param_id] = sel & np.isin(step_map, fine_steps)
+        raw_data[scan_param_id] = inject(scan_param_id, injected[..., scan_param_id])
+    assert not np.all(injected[sel])
+    assert np.all(injected[:4, :5].all(axis=1) == injected[:4, :5].any(axis=1))  # Whole mask steps are injected or skipped
+
+    filename = str(tmp_path / 'adaptive_threshold_scan.h5')
+    scan_params = np.zeros(charges.shape[0], dtype=[('scan_param_id', np.uint32), ('vcal_high', np.float32), ('vcal_low', np.float32)])
+    scan_params['scan_param_id'] = np.arange(charges.shape[0])
+    scan_params['vcal_high'], scan_params['vcal_low'] = 140, 140 - charges
+    rdg.write_raw_data_file(filename, raw_data, scan_id='threshold_scan', scan_config={'n_injections': n_injections}, scan_params=scan_params)
+    with tb.open_file(filename, 'a') as h5_file:
+        h5_file.create_carray(h5_file.root.configuration_out.scan, name='injected', obj=injected)
+
+    with Analysis(raw_data_file=filename) as a:
+        a.analyze_data()
+        hist_occ, _ = a.get_scurve_hist()
+        threshold_map, noise_map, _ = a.fit_scurves()
+    # S-curves filled with 0 below and n_injections above the windows
+    assert np.array_equal(hist_occ[injected], occ_hist[injected])
+    outside = sel[..., np.newaxis] & ~injected
+    assert np.all(hist_occ[outside] == np.where(charges > mu[..., np.newaxis], n_injections, 0)[outside])
+    assert np.allclose(threshold_map[sel], mu[sel], atol=0.5)
+    assert np.allclose(noise_map[sel], sigma[sel], atol=0.5)
+    threshold, noise = oa.get_scurve_maps(hist_occ, charges, n_injections)
+    assert np.allclose(threshold[sel], mu[sel], atol=2.5)
+
+
+def test_threshold_cache(tmp_path) -> None:
+    cache = ThresholdCache(str(tmp_path), chip_sn='W8R13', max_entries=2)
+    tdac = np.full((512, 512), 4, dtype=np.uint8)
+    registers = {'ITHR': 64, 'IBIAS': 100, 'VL': 30}
+    assert cache.load(registers, tdac) is None
+
+    cache.store(registers, tdac, np.full((512, 512), 20.), np.full((512, 512), 1.))
+    cache.store(dict(registers, ITHR=30), tdac, np.full((512, 512), 10.), np.full((512, 512), 2.))
+
+    threshold, noise = cache.load(dict(registers, VL=40), tdac)  # VL is not relevant
+    assert np.all(threshold == 20.) and np.all(noise == 1.)
+    threshold, _ = cache.load(dict(registers, ITHR=40), tdac)  # Most similar settings
+    assert np.all(threshold == 10.)
+    tdac_tuned = tdac.copy()
+    tdac_tuned[0, 0] = 3
+    threshold, _ = cache.load(dict(registers, ITHR=40), tdac_tuned)
+    assert np.all(threshold == 10.)
+
+    cache.store(dict(registers, ITHR=50), tdac, np.full((512, 512), 15.), np.full((512, 512), 2.))
+    threshold, _ = cache.load(registers, tdac)  # Oldest entry removed
+    assert np.all(threshold == 15.)
@@ -0,0 +1,47 @@
+#
+# ------------------------------------------------------------
+# Copyright (c) All rights reserved
+# SiLab, Institute of Physics, University of Bonn
+# ------------------------------------------------------------
+#
+
+import numpy as np
+
+from tjmonopix2.analysis import analysis_utils as au
+from tjmonopix2.analysis.tot_calibration import TotCalibration, fit_tot_calibration
+
+
+def test_tot_calibration(tmp_path) -> None:
+    n_injections = 100
+    charges = np.arange(10., 140., 10.)
+    a = np.array([[0.3, 0.25], [0.4, 0.2]])
+    b = np.array([[2., 3.], [1., 4.]])
+    c = np.array([[20., 10.], [30., 5.]])
+    t = np.array([[15., 20.], [12., 25.]])
+    with np.errstate(divide='ignore'):
+        tot = a[..., np.newaxis] * charges + b[..., np.newaxis] - c[..., np.newaxis] / (charges - t[..., np.newaxis])
+    hist_hits = np.where(charges > t[..., np.newaxis] + 5, n_injections, 0)
+    hist_tot = np.where(hist_hits > 0, tot * n_injections, 0)
+    hist_hits[1, 1] = 0  # Pixel without data
+
+    fit = fit_tot_calibration(hist_hits, hist_tot, charges, n_injections, threshold=t)
+    sel = np.array([[True, True], [True, False]])
+    for fitted, expected in zip(fit, [a, b, c, t]):
+        assert np.allclose(fitted[sel], expected[sel])
+        assert np.isnan(fitted[1, 1])
+
+    calibration = TotCalibration(*[np.pad(p, ((0, 510), (0, 510))) for p in fit])
+    calibration.store(str(tmp_path / 'calibration.h5'))
+    calibration = TotCalibration.load(str(tmp_path / 'calibration.h5'))
+
+    hits = np.zeros(3, dtype=au.hit_dtype)
+    hits['col'], hits['row'] = [0, 1, 1], [0, 0, 1]
+    hits['le'] = 10
+    expected_tot = np.array([tot[0, 0, 5], tot[1, 0, 8], 10.])
+    hits['te'] = 10 + np.round(expected_tot)
+    hits_charge = calibration.add_charge(hits)
+    assert hits_charge.dtype == au.hit_charge_dtype
+    assert np.all(hits_charge['col'] == hits['col'])
+    assert np.allclose(hits_charge['charge'][:2], calibration.get_charge([0, 1], [0, 0], np.round(expected_tot[:2])))
+    assert np.isclose(hits_charge['charge'][0], charges[5], atol=3) and np.isclose(hits_charge['charge'][1], charges[8], atol=3)
+    assert np.isnan(hits_charge['charge'][2])